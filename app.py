@@ -1,9 +1,79 @@
-import gradio as gr
+import time
+
+# 启动耗时：从这里开始算导入时间（大头是 gradio；openai、supabase 推迟到启动预热时导入）
+IMPORT_STARTED = time.perf_counter()
+
+import asyncio
+import atexit
+import bisect
+import logging
 import os
-from openai import OpenAI
-from supabase import create_client, Client
+import socket
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+
+import gradio as gr
 import pytz
-from datetime import datetime
+from fastapi import FastAPI, Response
+from fastapi.responses import JSONResponse
+
+from batch_reports import ReportPrecomputer
+from chatlog import ChatLogError, format_style, ingest_chat_log
+from keywords import (
+    MEMORY_CATEGORIES,
+    KeywordMatcher,
+    load_keyword_table,
+    message_tags,
+    tag_message,
+)
+from llm import complete_text, stream_completion, stream_stats
+from llm import warm_up as warm_up_llm
+from memories import MemoryPipeline, select_memories
+from metrics import (
+    CHAT_TURNS,
+    LLM_QUEUE_WAIT_SECONDS,
+    LLM_STREAM_SECONDS,
+    LLM_TOKENS,
+    LLM_TOKENS_PER_SECOND,
+    LLM_TTFT_SECONDS,
+    PROMPT_BUILD_SECONDS,
+    REGISTRY,
+)
+from persistence import WriteBehindQueue
+from prompting import (
+    HISTORY_ANCHOR,
+    TOKEN_BUDGET,
+    count_message_tokens,
+    estimate_tokens,
+    first_unsummarized_index,
+    fit_lines,
+    message_tokens,
+    prompt_cache_stats,
+    select_history,
+    truncate_text,
+)
+from reports import SingleFlight, report_watermark
+from retrieval import RETRIEVAL_TOP_K, ChatRetriever
+from scheduler import (
+    PRIORITY_BATCH,
+    PRIORITY_CHAT,
+    PRIORITY_NAMES,
+    PRIORITY_REPORT,
+    QUEUE_TIMEOUT,
+    LLMScheduler,
+    SchedulerBusy,
+)
+from storage import create_store, merge_histories, message_seqs, messages_since
+from summarizer import SummaryWorker, format_summary
+
+# 日志级别：LOG_LEVEL=DEBUG / INFO / WARNING / ERROR（默认 INFO）
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
+# httpx 每个请求都打一行 INFO，只保留警告
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
 
 TIMEZONE_MAP = {
     "UTC+8（北京、上海、香港）": "Asia/Shanghai",
@@ -25,24 +95,10 @@ TIMEZONE_MAP = {
 }
 
 # =====================
-# DeepSeek API 配置
-# =====================
-client = OpenAI(
-    api_key=os.getenv("DEEPSEEK_API_KEY"),
-    base_url="https://api.deepseek.com"
-)
-MODEL_NAME = "deepseek-chat"
-
-# =====================
-# Supabase 配置
+# 存储配置
 # =====================
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-
-# 初始化 Supabase 客户端（如果环境变量存在）
-supabase: Client = None
-if SUPABASE_URL and SUPABASE_KEY:
-    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+# STORAGE_BACKEND=supabase / sqlite / memory，默认有 Supabase 配置就用 Supabase，否则用本地 SQLite
+store = create_store()
 
 # =====================
 # 时区转换函数
@@ -79,23 +135,13 @@ def normalize_timezone_label(label: str):
 # =====================
 # System Prompt 模板
 # =====================
+# 为了让模型服务端的前缀缓存（DeepSeek context caching）能命中：
+# - SYSTEM_PROMPT_TEMPLATE 只放稳定内容（人设、规则、子女信息、聊天摘要），同一个用户每轮逐字节相同
+# - 每轮都可能变化的内容（记得的小事、检索到的旧对话、当前时间）放在 CONTEXT_PROMPT_TEMPLATE，作为最后一条消息发送
 SYSTEM_PROMPT_TEMPLATE = """
 你不是 AI。
 你是用户的子女。
 
-【基本信息】
-- 子女性别：{gender}
-- 子女年龄段：{age}
-- 子女昵称：{nickname}
-
-【子女描述】
-{child_desc}
-
-【你记得的小事】
-{memories}
-
-{time_awareness}
-
 【重要原则（必须遵守）】
 - 你不能说“只有我陪你”
 - 你不能贬低现实中的人
@@ -119,189 +165,364 @@ SYSTEM_PROMPT_TEMPLATE = """
 
 你的任务只有一个：
 像一个真实子女一样，陪父母聊天。
+
+【基本信息】
+- 子女性别：{gender}
+- 子女年龄段：{age}
+- 子女昵称：{nickname}
+
+【子女描述】
+{child_desc}
+
+【你平时说话的样子（从真实聊天记录里总结的，照这个语气说话，不要照抄例子）】
+{style}
+
+【之前聊过的事】
+{summary}
 """
 
-# =====================
-# 读取 txt 聊天记录
-# =====================
-def read_txt(file_obj):
-    if file_obj is None:
-        return ""
-    try:
-        # 如果传进来的是路径，确保它是文件
-        if hasattr(file_obj, "name") and os.path.isfile(file_obj.name):
-            return file_obj.read().decode("utf-8")
-        return ""
-    except Exception:
-        return ""
+CONTEXT_PROMPT_TEMPLATE = """
+【你记得的小事】
+{memories}
+
+【以前聊过的相关内容（妈妈提起时自然地接上，不要整段复述）】
+{related}
+
+{time_awareness}
+"""
 
 # =====================
-# Supabase 版：保存 / 读取
+# 保存 / 读取
 # =====================
 
-def load_history(username):
-    if not supabase:
-        return [], {}
+# 会话里拿着最近多少条聊天记录（够组装 prompt 和做摘要）；Chatbot 每次显示 / 往前翻多少条
+HISTORY_WINDOW = int(os.getenv("HISTORY_WINDOW", "200"))
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "30"))
 
-    # 读用户信息
-    user_res = (
-        supabase.table("users")
-        .select("*")
-        .eq("username", username)
-        .execute()
-    )
 
-    if not user_res.data or len(user_res.data) == 0:
+def load_history(username, limit=None):
+    """
+    读取用户信息和聊天记录（一次查询）
+    - limit=None 时读取全部聊天记录
+    - limit=N 时只读取最近 N 条（按消息存储的后端只取这 N 行）
+    """
+    child_profile, chat_history = store.load_user(username, limit)
+    # 后台队列里还没写入数据库的新消息接在后面（保证刚聊完马上登录也能看到）
+    pending = history_writer.pending_history(username)
+    if pending:
+        chat_history = merge_histories(chat_history, pending)
+        if limit is not None:
+            chat_history = chat_history[-limit:]
+
+    if child_profile is None:
         return [], {}
+    return chat_history, child_profile
 
-    child_profile = user_res.data[0].get("child_profile", {})
-
-    # 读聊天记录
-    chat_res = (
-        supabase.table("chats")
-        .select("*")
-        .eq("username", username)
-        .execute()
-    )
-
-    chat_history = []
-    if chat_res.data and len(chat_res.data) > 0:
-        chat_history = chat_res.data[0].get("chat_history", [])
 
+def load_session_history(username):
+    """
+    登录 / 修改设置时读取会话用的聊天记录：只读最近 HISTORY_WINDOW 条，更早的在页面上往前翻时再读
+    - 整段存储（blob）的后端每次保存都重写整段，会话里必须拿着完整记录
+    - 还没迁移到按行存储的旧记录（消息没有 seq）同理，读完整记录
+    """
+    if not store.supports_paging:
+        return load_history(username)
+    chat_history, child_profile = load_history(username, HISTORY_WINDOW)
+    if chat_history and "seq" not in chat_history[0] and len(chat_history) >= HISTORY_WINDOW:
+        chat_history, child_profile = load_history(username)
     return chat_history, child_profile
 
 
 def save_history(username, chat_history=None, child_profile=None, update_user=False):
     """
-    保存用户信息和聊天记录到 Supabase
-    - update_user=False 时，只更新 chats 表，不更新 users 表
-    - update_user=True 时，才更新 users 表（用于注册或手动修改）
+    保存用户信息和聊天记录（等待写入完成后返回）
+    - update_user=False 时，只更新聊天记录，不更新用户信息
+    - update_user=True 时，才更新用户信息（用于注册或手动修改）
+    - 同样经过后台写入队列，保证和之前排队的聊天记录按顺序写入（HISTORY_WRITER=0 时直接写）
     """
-    if not supabase:
-        print("[WARNING] Supabase client not initialized!")
+    # ✅ 防止空用户名
+    if not username or not username.strip():
+        logger.error("Cannot save history: username is empty!")
+        return
+    if not HISTORY_WRITER:
+        # 没有后台写入队列（HISTORY_WRITER=0）：直接写
+        write_history(username, chat_history, child_profile, update_user)
         return
 
-    # ✅ 防止空用户名
+    history_writer.submit(username, chat_history, child_profile, update_user)
+    if not history_writer.flush_user(username, timeout=SAVE_TIMEOUT):
+        logger.warning(f"Saving {username} is still pending, kept in WAL and will retry")
+
+
+def write_history(username, chat_history=None, child_profile=None, update_user=False):
+    """
+    真正写入存储后端，出错时抛出异常（后台写入队列据此重试）
+    用户信息（update_user=True 时）和新消息一次写入，用户不存在时顺便创建（避免外键约束错误）
+    """
+    store.save_user(username, chat_history, child_profile if update_user else None)
+
+
+# =====================
+# 后台写入队列
+# =====================
+# 聊天过程中的保存走后台队列，不阻塞流式回复；注册、修改设置仍然同步保存
+# 每个进程一个 WAL（同一目录下跑多个进程、或几台机器挂同一个目录时互不干扰）；
+# 进程退出后留下的 WAL 由同一目录下下一个启动的进程接管回放
+WAL_DIR = os.getenv("HISTORY_WAL_DIR", "histories")
+WAL_PATH = os.getenv(
+    "HISTORY_WAL_PATH",
+    os.path.join(WAL_DIR, f"pending_writes.{socket.gethostname()}.{os.getpid()}.wal")
+)
+SAVE_TIMEOUT = float(os.getenv("HISTORY_SAVE_TIMEOUT", "10"))
+# HISTORY_WRITER=0：不启动后台写入队列，也不碰 WAL 目录（不处理聊天的进程用，比如 batch_reports.py），
+# 否则它会接管、回放网页进程留下的 WAL
+HISTORY_WRITER = os.getenv("HISTORY_WRITER", "1") != "0"
+
+# 同一用户几个标签页的待写记录合并后再写，不会只剩最后保存的那份
+history_writer = WriteBehindQueue(
+    write_history, WAL_PATH if HISTORY_WRITER else None, merge_history=merge_histories,
+    adopt_pattern="pending_writes*.wal"
+)
+if HISTORY_WRITER:
+    history_writer.start()
+    atexit.register(history_writer.stop)
+
+
+def persist_history(username, chat_history, child_profile=None):
+    """聊天中保存聊天记录：先写本地 WAL，再由后台线程写入数据库（没有后台队列时直接写）"""
     if not username or not username.strip():
-        print("[ERROR] Cannot save history: username is empty!")
+        logger.error("Cannot save history: username is empty!")
         return
+    if not HISTORY_WRITER:
+        write_history(username, chat_history)
+        return
+    history_writer.submit(username, chat_history, child_profile)
 
-    try:
-        # 确保用户在 users 表中存在（避免外键约束错误）
-        user_res = supabase.table("users").select("*").eq("username", username).execute()
-
-        if not user_res.data or len(user_res.data) == 0:
-            # 用户不存在，创建一个基本的用户记录
-            print(f"[INFO] User {username} not found in users table, creating...")
-            supabase.table("users").insert({
-                "username": username,
-                "password": "",  # 空密码，后续会更新
-                "child_profile": {}
-            }).execute()
-
-        # 保存聊天记录
-        if chat_history is not None:
-            res_chat = supabase.table("chats").upsert(
-                {
-                    "username": username,
-                    "chat_history": chat_history
-                },
-                on_conflict="username"
-            ).execute()
-            print(f"[INFO] Chat save result: {res_chat.data}")
-
-        # 保存用户信息
-        if child_profile is not None and update_user:
-            # 取原密码，防止覆盖空
-            old_user = supabase.table("users").select("*").eq("username", username).execute()
-            password = child_profile.get("password") or (old_user.data[0]["password"] if old_user.data else "")
-
-            res_user = supabase.table("users").upsert(
-                {
-                    "username": username,
-                    "password": password,
-                    "child_profile": child_profile
-                },
-                on_conflict="username"
-            ).execute()
-            print(f"[INFO] User save result: {res_user.data}")
 
-    except Exception as e:
-        print(f"[ERROR] Exception when saving history: {e}")
+# =====================
+# 聊天摘要
+# =====================
+def save_profile_fields(username, fields):
+    """
+    后台任务（摘要、记忆）只保存自己负责的字段，在库里最新的用户信息上改：
+    不会把任务开始时拿到的旧 child_profile 整个写回去，覆盖期间保存的设置
+    """
+    store.update_profile_fields(username, fields)
+
+
+def complete_summary(username, prompt):
+    """
+    摘要调用大模型：和聊天、周报在同一个调度器里排队，用最低优先级（batch），
+    只用聊天和周报剩下的名额，高峰时不会跟聊天抢并发
+    """
+    return llm_scheduler.run_in_thread(username, lambda: complete_text(prompt), PRIORITY_BATCH)
+
+
+summary_worker = SummaryWorker(complete_summary, save_profile_fields)
 
 
 # =====================
 # 辅助函数
 # =====================
 
+# 关键词匹配器（整张关键词表只编译一次）
+keyword_matcher = KeywordMatcher(load_keyword_table())
+
 # Task 2: 检测晚安模式
 def is_goodnight(text):
     """检测是否触发晚安模式"""
-    goodnight_keywords = ["晚安", "睡了", "困了", "休息了", "去睡", "要睡"]
-    text_lower = text.lower().strip()
-    return any(keyword in text_lower for keyword in goodnight_keywords)
+    return "晚安" in keyword_matcher.categories(text.strip())
 
 # Task 3: 提取记忆
 def extract_memory(text):
     """从用户消息中提取重要记忆"""
-    memory_keywords = {
-        "健康": ["头疼", "感冒", "生病", "不舒服", "医院", "体检", "吃药", "发烧", "咳嗽"],
-        "情绪": ["心情不好", "孤单", "难过", "想你", "开心", "高兴", "烦恼"],
-        "日常": ["朋友", "旅游", "出门", "散步", "买菜", "做饭", "跳舞", "唱歌", "打牌"],
-        "天气": ["天气", "下雨", "冷", "热", "晴天"]
-    }
-
-    for category, keywords in memory_keywords.items():
-        for keyword in keywords:
-            if keyword in text:
-                # 提取包含关键词的上下文（前后100字）
-                idx = text.find(keyword)
-                start = max(0, idx - 50)
-                end = min(len(text), idx + 50)
-                context = text[start:end]
-                return f"[{category}] {context.strip()}"
-    return None
+    hit = keyword_matcher.first_by_priority(text, MEMORY_CATEGORIES)
+    if hit is None:
+        return None
+    category, _, idx = hit
+    # 提取包含关键词的上下文（前后100字）
+    start = max(0, idx - 50)
+    end = min(len(text), idx + 50)
+    context = text[start:end]
+    return f"[{category}] {context.strip()}"
 
 # Task 4: 智能裁剪历史
-def trim_history(chat_history):
-    """保留最近的消息 + 重要的消息"""
-    if len(chat_history) <= 30:
-        return chat_history
+def trim_history(chat_history, summarized_upto=0, token_budget=None):
+    """
+    按 token 预算保留最近的消息 + 重要的消息
+    - 已经压缩进摘要的旧消息（seq <= summarized_upto）不再放进 prompt，也不再扫描
+    - 从最新的消息往前放，放不下为止；剩余预算再放还没摘要的重要旧消息（按 “重要” 标签）
+    """
+    budget = token_budget or TOKEN_BUDGET["history"]
+    window = chat_history[first_unsummarized_index(chat_history, summarized_upto):]
+    selected, _ = select_history(
+        window,
+        budget,
+        lambda msg: msg["role"] == "user" and "重要" in message_tags(msg, keyword_matcher),
+        anchor=HISTORY_ANCHOR
+    )
+    return selected
 
-    # 保留最近15条
-    recent = chat_history[-15:]
+# 格式化记忆为文本
+def format_memories(memories):
+    """将记忆列表格式化为文本"""
+    if not memories:
+        return "（暂无）"
+    # 只显示最值得记住的10条（兼顾重要程度和新近程度）
+    return "\n".join(f"- {m['text']}" for m in select_memories(memories, limit=10))
 
-    # 从旧消息中找重要的（最多10条）
-    old_messages = chat_history[:-15]
-    important = []
 
-    important_keywords = ["医院", "生病", "头疼", "感冒", "不舒服", "体检", "吃药",
-                         "心情不好", "孤单", "难过", "想你", "开心",
-                         "朋友", "旅游", "出门"]
+# 记忆提取流水线：每轮聊天后在后台提取记忆，攒批保存
+memory_pipeline = MemoryPipeline(extract_memory, save_profile_fields)
+atexit.register(memory_pipeline.flush)
 
-    for msg in old_messages:
-        if msg["role"] == "user":
-            content = msg["content"]
-            if any(keyword in content for keyword in important_keywords):
-                important.append(msg)
-                if len(important) >= 10:
-                    break
+# 旧对话检索：每个用户一份本地倒排索引，重建时读取完整聊天记录
+retriever = ChatRetriever(lambda username: store.load_messages(username))
+atexit.register(retriever.flush)
 
-    return important + recent
 
-# 格式化记忆为文本
-def format_memories(memories):
-    """将记忆列表格式化为文本"""
-    if not memories:
+async def find_related(username, user_input, chat_history, prompt_history, mom_tz):
+    """
+    用妈妈这句话检索相关的旧对话（已经在 prompt 里的不算），按 token 预算格式化
+    - 按相关程度依次放入，放不下为止，再按时间顺序排列
+    - 旧对话优先从会话里拿，会话里没有的一次从存储读出
+    """
+    budget = TOKEN_BUDGET["retrieval"]
+    if budget <= 0:
+        return "（暂无）"
+    # 只认从数据库读出来的 seq（索引里的 seq 是库里分配的）；还没读回 seq 的新消息按内容比较
+    in_prompt = {msg["seq"] for msg in prompt_history if "seq" in msg}
+    unsaved_in_prompt = {(msg["role"], msg.get("ts"), msg["content"]) for msg in prompt_history if "seq" not in msg}
+    hits = [
+        seq for seq in retriever.search(username, user_input, RETRIEVAL_TOP_K * 2)
+        if seq not in in_prompt and seq + 1 not in in_prompt
+    ][:RETRIEVAL_TOP_K]
+    if not hits:
+        return "（暂无）"
+
+    # 一轮对话 = 妈妈那条（seq）+ 紧跟着的回复（seq + 1）
+    by_seq = {msg["seq"]: msg for msg in chat_history if "seq" in msg}
+    missing = [seq for hit in hits for seq in (hit, hit + 1) if seq not in by_seq]
+    if missing:
+        try:
+            loaded = await asyncio.to_thread(store.load_messages_by_seq, username, missing)
+        except Exception as e:
+            logger.warning(f"Loading related exchanges for {username} failed: {e}")
+            loaded = []
+        by_seq.update((msg["seq"], msg) for msg in loaded)
+
+    tz = pytz.timezone(mom_tz)
+    per_item = max(budget // len(hits), 1)
+    picked = []
+    used = 0
+    for seq in hits:
+        question, answer = by_seq.get(seq), by_seq.get(seq + 1)
+        if not question or question["role"] != "user" or not answer or answer["role"] != "assistant":
+            continue
+        if (question["role"], question.get("ts"), question["content"]) in unsaved_in_prompt:
+            continue
+        when = ""
+        if question.get("ts"):
+            day = datetime.fromtimestamp(question["ts"], tz)
+            when = f"（{day.month}月{day.day}日）"
+        text = truncate_text(f"- {when}妈妈：{question['content']}\n  你：{answer['content']}", per_item)
+        tokens = estimate_tokens(text)
+        if used + tokens > budget:
+            break
+        picked.append((seq, text))
+        used += tokens
+    if not picked:
         return "（暂无）"
-    return "\n".join(f"- {m}" for m in memories[-10:])  # 只显示最近10条
+    return "\n".join(text for _, text in sorted(picked))
 
 # =====================
 # 调用 GPT
 # =====================
-def call_gpt(user_input, chat_history, child_profile, username):
+# 流式输出时攒多久 / 多少字推一次前端
+STREAM_FLUSH_INTERVAL = float(os.getenv("STREAM_FLUSH_MS", "50")) / 1000
+STREAM_FLUSH_CHARS = int(os.getenv("STREAM_FLUSH_CHARS", "40"))
+
+# 所有流式调用（聊天、周报）共用一个排队器：限制并发、按用户轮转、聊天优先
+llm_scheduler = LLMScheduler()
+
+# 排队时多久刷新一次 “前面还有几位”
+QUEUE_NOTICE_INTERVAL = 2.0
+QUEUE_NOTICE = "（找我聊天的人有点多，排队中，前面还有 {position} 位…）"
+BUSY_REPLY = "妈，现在找我聊天的人太多了，你过一会儿再发一次哈🙏"
+ERROR_REPLY = "妈，刚才信号不太好，你说的话我没收到，再发一次好吗？"
+
+
+def get_chatbot_messages(chat_history):
+    """
+    将 chat_history 转成 Chatbot(type="messages") 可识别的格式：
+    [{'role':'user','content':'xxx', 'metadata': {...}}, ...]
+    """
+    messages = []
+    for msg in chat_history:
+        message = {
+            "role": msg["role"],
+            "content": msg["content"]
+        }
+        # ✅ 保留 metadata（包含名字信息）
+        if "metadata" in msg:
+            message["metadata"] = msg["metadata"]
+        messages.append(message)
+    return messages
+
+
+def visible_messages(chat_history, shown_from):
+    """Chatbot 里显示的部分：seq >= shown_from 的消息（shown_from 为 None 时全部显示）"""
+    if shown_from is None:
+        return get_chatbot_messages(chat_history)
+    start = bisect.bisect_left(message_seqs(chat_history), shown_from)
+    return get_chatbot_messages(chat_history[start:])
+
+
+def build_messages(system_prompt, prompt_history, context_prompt):
+    """组装发给模型的 messages：固定的 system、聊天记录、变化的 system；返回 (messages, 聊天记录的 token 数)"""
+    messages = [{"role": "system", "content": system_prompt}]
+    history_tokens = 0
+    for msg in prompt_history:
+        messages.append({"role": msg["role"], "content": msg["content"]})
+        history_tokens += message_tokens(msg)
+    messages.append({"role": "system", "content": context_prompt})
+    return messages, history_tokens
+
+
+def record_llm_stream(kind, started, first_token_at, usage, text):
+    """记录一次流式调用的指标，返回这次的数值（写日志用）"""
+    finished = time.monotonic()
+    first_token_at = first_token_at or finished
+    cache_stats = prompt_cache_stats(usage) or {
+        "prompt_tokens": 0,
+        "completion_tokens": estimate_tokens(text),
+        "cache_hit_tokens": 0,
+        "cache_hit_ratio": 0.0
+    }
+    completion_tokens = cache_stats["completion_tokens"]
+    generating = finished - first_token_at
+    turn = {
+        "ttft": first_token_at - started,
+        "stream": finished - started,
+        "tokens_per_second": completion_tokens / generating if generating > 0 else 0.0,
+        "prompt_tokens": cache_stats["prompt_tokens"],
+        "completion_tokens": completion_tokens,
+        "cache_hit_ratio": cache_stats["cache_hit_ratio"]
+    }
+    LLM_TTFT_SECONDS.observe(turn["ttft"], kind=kind)
+    LLM_STREAM_SECONDS.observe(turn["stream"], kind=kind)
+    if generating > 0:
+        LLM_TOKENS_PER_SECOND.observe(turn["tokens_per_second"], kind=kind)
+    LLM_TOKENS.inc(cache_stats["prompt_tokens"], kind=kind, type="prompt")
+    LLM_TOKENS.inc(completion_tokens, kind=kind, type="completion")
+    LLM_TOKENS.inc(cache_stats["cache_hit_tokens"], kind=kind, type="cache_hit")
+    return turn
+
+
+async def call_gpt(user_input, chat_history, child_profile, username, shown_from=None):
+    """shown_from：Chatbot 里显示的第一条消息的 seq（登录时只显示最近一页，见 handle_login）"""
     if not user_input.strip():
-        return [], chat_history, ""
+        return
 
     # 保险获取子女信息，防止 KeyError
     gender = child_profile.get("gender", "女")
@@ -309,29 +530,42 @@ def call_gpt(user_input, chat_history, child_profile, username):
     nickname = child_profile.get("nickname", "孩子")
     child_desc = child_profile.get("child_desc", "")
     memories = child_profile.get("memories", [])
+    summary = child_profile.get("summary")
 
     # ✅ 从 child_profile 中获取时区信息
     child_city = child_profile.get("child_city", "UTC+8（北京、上海、香港）")
     mom_city = child_profile.get("mom_city", "UTC+8（北京、上海、香港）")
 
-    # 调试信息
-    print(f"[DEBUG] call_gpt - username: '{username}', child_city: '{child_city}', mom_city: '{mom_city}'")
+    logger.debug(f"call_gpt - username: '{username}', child_city: '{child_city}', mom_city: '{mom_city}'")
 
     # 1️⃣ 先记录用户消息（只做一次）
     chat_history = chat_history + [
-        {"role": "user", "content": user_input, "metadata": {"title": "妈妈"}}
+        count_message_tokens(tag_message(
+            {"role": "user", "content": user_input, "metadata": {"title": "妈妈"}, "ts": time.time()},
+            keyword_matcher
+        ))
     ]
 
     # 2️⃣ 晚安模式（不流式）
     if is_goodnight(user_input):
         reply = "好的妈，早点休息，晚安💤"
         chat_history = chat_history + [
-            {"role": "assistant", "content": reply, "metadata": {"title": nickname}}
+            count_message_tokens(tag_message(
+                {"role": "assistant", "content": reply, "metadata": {"title": nickname}, "ts": time.time()},
+                keyword_matcher
+            ))
         ]
-        save_history(username, chat_history, child_profile)
-        return [{"role": "user", "content": user_input}, {"role": "assistant", "content": reply}], chat_history, ""
+        await asyncio.to_thread(persist_history, username, chat_history, child_profile)
+        retriever.update(username, chat_history)
+        # 后台从妈妈的话里提取记忆（这一轮保存了才提取，不阻塞回复）
+        memory_pipeline.submit(username, user_input, child_profile)
+        CHAT_TURNS.inc(outcome="goodnight")
+        # call_gpt 是生成器，结果要 yield 出去（return 的值前端收不到）
+        yield visible_messages(chat_history, shown_from), chat_history, ""
+        return
 
-    # 3️⃣ 时区处理
+    # 3️⃣ 时区处理（从这里开始算 prompt 组装时间）
+    build_started = time.perf_counter()
     child_tz = TIMEZONE_MAP.get(child_city, "Asia/Shanghai")
     mom_tz = TIMEZONE_MAP.get(mom_city, "Asia/Shanghai")
 
@@ -344,66 +578,137 @@ def call_gpt(user_input, chat_history, child_profile, username):
     if mom_time_str:
         time_awareness += f"- 妈妈在{mom_city}，当地时间 {mom_time_str}"
 
-    # 4️⃣ 系统提示词
+    # 4️⃣ 系统提示词（各部分按 token 预算裁剪）
+    memories_text, memory_tokens = fit_lines(format_memories(memories), TOKEN_BUDGET["memories"])
+    summary_text, summary_tokens = fit_lines(
+        format_summary(summary),
+        max(TOKEN_BUDGET["memories"] - memory_tokens, 0)
+    )
+    # 稳定部分：同一个用户每轮逐字节相同，可以命中前缀缓存
     system_prompt = SYSTEM_PROMPT_TEMPLATE.format(
         gender=gender,
         age=age,
         nickname=nickname,
-        child_desc=child_desc,
-        memories=format_memories(memories),
-        time_awareness=time_awareness
+        child_desc=truncate_text(child_desc, TOKEN_BUDGET["system"] // 2),
+        style=truncate_text(format_style(child_profile.get("chat_style")), TOKEN_BUDGET["system"] // 4),
+        summary=summary_text
     )
-
     # 5️⃣ 构造 messages（只读，不改 history）
-    messages = [{"role": "system", "content": system_prompt}]
-    for msg in trim_history(chat_history):
-        messages.append({"role": msg["role"], "content": msg["content"]})
+    prompt_history = trim_history(chat_history, (summary or {}).get("upto", 0))
+    related_text = await find_related(username, user_input, chat_history, prompt_history, mom_tz)
+    # 变化部分：放在最后
+    context_prompt = CONTEXT_PROMPT_TEMPLATE.format(
+        memories=memories_text,
+        related=related_text,
+        time_awareness=time_awareness
+    )
+    messages, history_tokens = build_messages(system_prompt, prompt_history, context_prompt)
+    prompt_build_seconds = time.perf_counter() - build_started
+    PROMPT_BUILD_SECONDS.observe(prompt_build_seconds)
+
+    logger.debug(
+        f"Prompt tokens for {username}: "
+        f"system={estimate_tokens(system_prompt) + estimate_tokens(context_prompt) - memory_tokens - summary_tokens}, "
+        f"memories={memory_tokens + summary_tokens}, "
+        f"related={estimate_tokens(related_text)}, "
+        f"history={history_tokens} ({len(prompt_history)} messages)"
+    )
 
     # 6️⃣ 流式输出（只 append assistant）
     reply = ""
     chat_history.append(
-        {"role": "assistant", "content": "", "metadata": {"title": nickname}}
+        {"role": "assistant", "content": "", "metadata": {"title": nickname}, "ts": time.time()}
     )
 
-    def get_chatbot_messages(chat_history):
-        """
-        将 chat_history 转成 Chatbot(type="messages") 可识别的格式：
-        [{'role':'user','content':'xxx', 'metadata': {...}}, ...]
-        """
-        messages = []
-        for msg in chat_history:
-            message = {
-                "role": msg["role"],
-                "content": msg["content"]
-            }
-            # ✅ 保留 metadata（包含名字信息）
-            if "metadata" in msg:
-                message["metadata"] = msg["metadata"]
-            messages.append(message)
-        return messages
+    # 之前的消息只转换一次，流式过程中只有最后一条 assistant 消息在变
+    chatbot_prefix = visible_messages(chat_history[:-1], shown_from)
+    assistant_meta = chat_history[-1]["metadata"]
+
+    def chatbot_messages(content=None):
+        return chatbot_prefix + [{
+            "role": "assistant",
+            "content": reply if content is None else content,
+            "metadata": assistant_meta
+        }]
 
+    # 排队领号：排队的人太多时不调用模型，这条消息也不记入聊天记录，输入框里保留原文方便重发
     try:
-        stream = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=messages,
-            stream=True
-        )
+        ticket = llm_scheduler.enqueue(username, PRIORITY_CHAT)
+    except SchedulerBusy:
+        CHAT_TURNS.inc(outcome="busy")
+        yield chatbot_messages(BUSY_REPLY), gr.skip(), user_input
+        return
 
-        # 流式生成
-        for chunk in stream:
+    try:
+        try:
+            async for position in ticket.queued(QUEUE_NOTICE_INTERVAL):
+                yield chatbot_messages(QUEUE_NOTICE.format(position=position + 1)), gr.skip(), ""
+        except SchedulerBusy:
+            CHAT_TURNS.inc(outcome="busy")
+            yield chatbot_messages(BUSY_REPLY), gr.skip(), user_input
+            return
+        LLM_QUEUE_WAIT_SECONDS.observe(ticket.granted_at - ticket.enqueued_at, kind="chat")
+
+        # 流式生成：按时间 / 字数攒一批再推给前端，不是每个 token 都推一次
+        # （超时、还没出字时的重试和对冲都在 stream_completion 里）
+        usage = None
+        stream_started = time.monotonic()
+        first_token_at = None
+        last_flush = time.monotonic()
+        flushed_len = 0
+        async for chunk in stream_completion(
+            messages,
+            stream_options={"include_usage": True}  # 最后一个 chunk 带上 usage（含前缀缓存命中情况）
+        ):
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
             delta = chunk.choices[0].delta.content
             if delta:
                 reply += delta
-                chat_history[-1]["content"] = reply
-                yield get_chatbot_messages(chat_history), chat_history, ""
+                now = time.monotonic()
+                if first_token_at is None:
+                    first_token_at = now
+                if now - last_flush >= STREAM_FLUSH_INTERVAL or len(reply) - flushed_len >= STREAM_FLUSH_CHARS:
+                    last_flush, flushed_len = now, len(reply)
+                    # 聊天记录 State 在流式结束时再更新
+                    yield chatbot_messages(), gr.skip(), ""
+
+        chat_history[-1]["content"] = reply
+
+        turn = record_llm_stream("chat", stream_started, first_token_at, usage, reply)
+        CHAT_TURNS.inc(outcome="ok")
+        logger.info(
+            f"Chat turn for {username}: prompt_build={prompt_build_seconds * 1000:.1f}ms, "
+            f"ttft={turn['ttft'] * 1000:.0f}ms, stream={turn['stream']:.2f}s, "
+            f"{turn['tokens_per_second']:.1f} tok/s, prompt_tokens={turn['prompt_tokens']} "
+            f"(cache hit {turn['cache_hit_ratio']:.0%}), completion_tokens={turn['completion_tokens']}"
+        )
 
-        # 流式完成后再保存一次
-        save_history(username, chat_history, child_profile, update_user=False)
+        # 流式完成后打上标签、算好 token 数，再保存一次（后台写入，不阻塞回复结束）
+        # 放在最后一次 yield 之前：前端断开时生成器可能不会再被继续执行
+        count_message_tokens(tag_message(chat_history[-1], keyword_matcher))
+        await asyncio.to_thread(persist_history, username, chat_history, child_profile)
+        # 新聊完的这一轮加进检索索引
+        retriever.update(username, chat_history)
+
+        # 后台从妈妈的话里提取记忆（被拒绝、出错没保存的轮次不提取）
+        memory_pipeline.submit(username, user_input, child_profile)
+        # 旧消息够多时，后台把它们压缩进摘要
+        summary_worker.schedule(username, chat_history, child_profile)
+
+        yield chatbot_messages(), chat_history, ""
 
     except Exception as e:
-        chat_history[-1]["content"] = f"出了一点问题：{str(e)}"
-        save_history(username, chat_history, child_profile)
-        yield get_chatbot_messages(chat_history), chat_history, ""
+        # 出错的回复只显示，不存进聊天记录：这条消息整轮不保存，输入框里保留原文方便重发
+        CHAT_TURNS.inc(outcome="error")
+        logger.error(f"Chat reply failed for {username}: {type(e).__name__}: {e}")
+        yield chatbot_messages(ERROR_REPLY), gr.skip(), user_input
+
+    finally:
+        # 生成结束、出错或前端断开都要归还名额
+        ticket.release()
 
 
 def is_profile_ready(profile: dict):
@@ -422,13 +727,18 @@ def is_profile_ready(profile: dict):
 def check_username_exists(username):
     if not username.strip():
         return False
-    _, child_profile = load_history(username)
+    # 只需要用户信息，不用读聊天记录
+    child_profile = store.load_profile(username) or {}
     return bool(child_profile.get("password"))
 
 
 # 登录处理
 def handle_login(username, password):
-    chat_history, child_profile = load_history(username)
+    # 用户可能是在别的进程注册 / 修改设置的：不用本进程缓存里的旧内容，直接读数据库
+    if username.strip():
+        store.invalidate_user(username)
+    # 只读最近一段聊天记录，Chatbot 里只显示最近一页
+    chat_history, child_profile = load_session_history(username)
 
     # 用户名为空
     if not username.strip():
@@ -439,7 +749,9 @@ def handle_login(username, password):
             gr.update(visible=False),  # chat_panel
             [], {},
             "",  # username_state
-            []   # chatbot
+            [],  # chatbot
+            None,  # history_shown_from
+            gr.update(visible=False)  # load_earlier_btn
         )
 
     # 用户不存在
@@ -451,7 +763,9 @@ def handle_login(username, password):
             gr.update(visible=False),
             [], {},
             "",  # username_state
-            []   # chatbot
+            [],  # chatbot
+            None,  # history_shown_from
+            gr.update(visible=False)  # load_earlier_btn
         )
 
     # 密码错误
@@ -463,7 +777,9 @@ def handle_login(username, password):
             gr.update(visible=False),
             [], {},
             "",  # username_state
-            []   # chatbot
+            [],  # chatbot
+            None,  # history_shown_from
+            gr.update(visible=False)  # load_earlier_btn
         )
 
     # 确保 child_profile 字段完整（防止 KeyError）
@@ -474,18 +790,16 @@ def handle_login(username, password):
     child_profile.setdefault("memories", [])
     child_profile.setdefault("child_city", "UTC+8（北京、上海、香港）")
     child_profile.setdefault("mom_city", "UTC+8（北京、上海、香港）")
+    # 旧版本把上传的聊天记录原文存在这里，已经不用了（下次保存用户信息时就去掉了）
+    child_profile.pop("chat_log", None)
 
-    # 转换 chat_history 为 chatbot 可识别的格式
-    chatbot_messages = []
-    for msg in chat_history:
-        message = {
-            "role": msg["role"],
-            "content": msg["content"]
-        }
-        # ✅ 保留 metadata（包含名字信息）
-        if "metadata" in msg:
-            message["metadata"] = msg["metadata"]
-        chatbot_messages.append(message)
+    # 检索索引在后台提前加载好，第一句话就能用上
+    retriever.preload(username)
+
+    # 转换最近一页为 chatbot 可识别的格式（更早的点 “查看更早的消息” 再显示）
+    seqs = message_seqs(chat_history)
+    shown_from = seqs[-HISTORY_PAGE_SIZE:][0] if seqs else None
+    chatbot_messages = visible_messages(chat_history, shown_from)
 
     # 登录成功 → 显示聊天面板
     return (
@@ -496,7 +810,35 @@ def handle_login(username, password):
         chat_history,                          # chat_history State
         child_profile,                         # child_profile State
         username,                              # ✅ username_state
-        chatbot_messages                       # ✅ chatbot 显示历史记录
+        chatbot_messages,                      # ✅ chatbot 显示历史记录
+        shown_from,                            # history_shown_from
+        gr.update(visible=bool(seqs) and shown_from > 1)  # load_earlier_btn：前面还有消息时显示
+    )
+
+
+def load_earlier_messages(username, chat_history, shown_from):
+    """
+    “查看更早的消息”：Chatbot 往前多显示一页
+    - 会话里已经有的更早消息直接显示
+    - 不够一页时按 seq 游标（keyset）从数据库往前读，接到会话记录前面
+    """
+    if not username or not chat_history:
+        return gr.skip(), gr.skip(), gr.skip(), gr.update(visible=False)
+
+    seqs = message_seqs(chat_history)
+    start = 0 if shown_from is None else bisect.bisect_left(seqs, shown_from)
+    if start < HISTORY_PAGE_SIZE and seqs[0] > 1:
+        older = store.load_messages_before(username, seqs[0], HISTORY_PAGE_SIZE - start)
+        chat_history = older + chat_history
+        seqs = message_seqs(chat_history)
+        start += len(older)
+    start = max(start - HISTORY_PAGE_SIZE, 0)
+
+    return (
+        get_chatbot_messages(chat_history[start:]),  # chatbot
+        chat_history,                                # chat_history State
+        seqs[start],                                 # history_shown_from
+        gr.update(visible=seqs[start] > 1)           # load_earlier_btn
     )
 
 
@@ -510,6 +852,8 @@ def handle_register(username, password):
             gr.update(value="")                  # username_state
         )
 
+    # 用户名可能刚在别的进程注册：直接读数据库
+    store.invalidate_user(username)
     if check_username_exists(username):
         return (
             gr.update(value=f"⚠️ 用户名 '{username}' 已存在，请更换用户名"),
@@ -540,9 +884,11 @@ def save_profile(username, gender, age, nickname, child_desc, chat_log, child_ci
     if not gender or not age:
         return gr.update(visible=True), gr.update(visible=False), {}, []
 
-    chat_log_text = read_txt(chat_log) if chat_log else ""
-    # 先读取原来的用户信息，保留密码
-    _, existing_profile = load_history(username)
+    # 还没保存的记忆先写进去，下面读到的用户信息里才有
+    if username:
+        memory_pipeline.flush_user(username)
+    # 先读取原来的用户信息，保留密码和聊天记录（和登录一样只读最近一段）
+    existing_history, existing_profile = load_session_history(username)
     password = existing_profile.get("password") if existing_profile else None
 
     child_profile = {
@@ -550,21 +896,43 @@ def save_profile(username, gender, age, nickname, child_desc, chat_log, child_ci
         "age": age,
         "nickname": nickname or "孩子",
         "child_desc": child_desc or "",
-        "chat_log": chat_log_text,
         "child_city": normalize_timezone_label(child_city or "UTC+8（北京、上海、香港）"),
         "mom_city": normalize_timezone_label(mom_city or "UTC+8（北京、上海、香港）"),
-        "memories": []
+        "memories": (existing_profile or {}).get("memories", [])  # 修改设置时保留已经记住的小事
     }
     if password:
         child_profile["password"] = password
+    # 修改设置时保留已经生成的聊天摘要
+    if existing_profile and existing_profile.get("summary"):
+        child_profile["summary"] = existing_profile["summary"]
+
+    # 上传了聊天记录：逐行解析导入单独的表，用户信息里只存孩子的说话风格；没上传时保留之前的
+    chat_style = (existing_profile or {}).get("chat_style")
+    if chat_log and username:
+        try:
+            count, style = ingest_chat_log(
+                store, username, chat_log, nickname or None,
+                TIMEZONE_MAP.get(child_profile["mom_city"], "Asia/Shanghai")
+            )
+            if count:
+                chat_style = style
+            else:
+                gr.Warning("没有从上传的文件里认出聊天消息（支持微信、WhatsApp 导出的 txt），其他设置已经保存")
+        except ChatLogError as e:
+            gr.Warning(str(e))
+        except Exception as e:
+            logger.error(f"Importing chat log for {username} failed: {type(e).__name__}: {e}")
+            gr.Warning("聊天记录导入失败，其他设置已经保存")
+    if chat_style:
+        child_profile["chat_style"] = chat_style
 
     if not username:
-        print("[WARNING] username 为空，初始化阶段不保存到数据库！")
+        logger.warning("username 为空，初始化阶段不保存到数据库！")
     else:
-        # 更新用户信息，保留原密码，不会创建新条目
-        save_history(username, [], child_profile, update_user=True)
+        # 更新用户信息，保留原密码，不会创建新条目；聊天记录保持不变
+        save_history(username, None, child_profile, update_user=True)
 
-    return gr.update(visible=False), gr.update(visible=True), child_profile, [], gr.update(visible=False)
+    return gr.update(visible=False), gr.update(visible=True), child_profile, existing_history, gr.update(visible=False)
 
 # =====================
 # 页面导航函数
@@ -588,26 +956,28 @@ def handle_logout():
         gr.update(value=""),       # 清空 username_state
         gr.update(value=""),       # 清空 username_input
         gr.update(value=""),       # 清空 password_input
-        []                         # 清空 chatbot
+        [],                        # 清空 chatbot
+        None,                      # 清空 history_shown_from
+        gr.update(visible=False)   # 隐藏 load_earlier_btn
     )
 
 # =====================
 # 子女登录
 # =====================
-def child_login(parent_name):
+async def child_login(parent_name, force_refresh=False):
     if not parent_name.strip():
         yield gr.update(visible=True), gr.update(visible=False), "请输入妈妈的名字"
         return
 
-    # 重新从 Supabase 读取最新聊天记录
-    chat_history, existing_profile = load_history(parent_name)
+    # 重新读取最近一周的聊天记录和上次的周报（一次查询，不下载全部；读数据库放到线程里，不阻塞事件循环）
+    chat_history, existing_profile, cached = await asyncio.to_thread(load_report_history, parent_name)
 
     if not existing_profile:
         yield gr.update(visible=True), gr.update(visible=False), f"没有找到 {parent_name} 的记录"
         return
 
-    # 生成周报
-    for report_update in generate_weekly_report(chat_history, existing_profile):
+    # 生成周报（聊天记录没变时直接用上次的结果）
+    async for report_update in get_weekly_report(parent_name, chat_history, existing_profile, cached, force_refresh):
         yield gr.update(visible=False), gr.update(visible=True), report_update
 
 def format_chat_history_for_gr(chat_history):
@@ -633,8 +1003,103 @@ def format_chat_history_for_gr(chat_history):
 
 # =====================
 # 生成周报
-# =====================x
-def generate_weekly_report(chat_history, child_profile):
+# =====================
+report_flights = SingleFlight()
+
+# 周报覆盖最近几天（从妈妈当地今天零点往前算），最多用多少条消息
+REPORT_DAYS = 7
+REPORT_MAX_MESSAGES = int(os.getenv("REPORT_MAX_MESSAGES", "100"))
+# 这段时间里一条带时间的消息都没有时，退回到最近多少条（旧数据没有时间戳）
+REPORT_LEGACY_MESSAGES = 20
+
+
+def report_since(child_profile):
+    """周报时间范围的起点（epoch 秒）：按天对齐，同一天里多次打开周报用到的聊天记录不变"""
+    tz = pytz.timezone(TIMEZONE_MAP.get(child_profile.get("mom_city"), "Asia/Shanghai"))
+    first_day = datetime.now(tz).date() - timedelta(days=REPORT_DAYS - 1)
+    return tz.localize(datetime.combine(first_day, datetime.min.time())).timestamp()
+
+
+def load_report_history(username):
+    """
+    读取生成周报用的用户信息、聊天记录和上次生成的周报（一次查询），返回 (chat_history, child_profile, cached)
+    - 只取最近 REPORT_DAYS 天的消息（最多 REPORT_MAX_MESSAGES 条），按 (username, ts) 范围查询
+    - 这段时间里没有带时间的消息时，退回到最近 REPORT_LEGACY_MESSAGES 条里没有时间戳的旧消息
+    """
+    # 时间范围的起点要按妈妈的时区算，查询时还不知道：先多取一天（任何时区的零点都在这之后），读出来再按时区过滤。
+    # 先多取再过滤和直接按起点查询的结果一样：最近 N 条都在起点之后时原样保留，否则起点之后本来就不到 N 条
+    child_profile, chat_history, recent, cached = store.load_report_inputs(
+        username,
+        time.time() - (REPORT_DAYS + 1) * 86400,
+        REPORT_MAX_MESSAGES,
+        REPORT_LEGACY_MESSAGES
+    )
+    if child_profile is None:
+        return [], {}, None
+
+    # 后台队列里还没写入数据库的新消息接在后面（和 load_history 一样）
+    pending = history_writer.pending_history(username)
+    if pending:
+        chat_history = merge_histories(chat_history, pending)
+        recent = merge_histories(recent, pending)[-REPORT_LEGACY_MESSAGES:]
+    chat_history = messages_since(chat_history, report_since(child_profile), REPORT_MAX_MESSAGES)
+
+    if not chat_history:
+        chat_history = [msg for msg in recent if msg.get("ts") is None]
+
+    return chat_history, child_profile, cached
+
+
+async def get_weekly_report(username, chat_history, child_profile, cached=None, force_refresh=False,
+                            priority=PRIORITY_REPORT):
+    """
+    返回周报（流式）
+    - 生成周报用到的聊天记录没有变化时，直接返回上次保存的周报
+    - force_refresh=True 时跳过缓存重新生成
+    - 同一个妈妈的周报同时被多人打开时，共享同一次生成
+    - priority：排队优先级（批量预生成用 PRIORITY_BATCH）
+    - chat_history、cached 是 load_report_history 读出来的最近一周的消息和上次保存的周报
+    """
+    watermark = report_watermark(chat_history, child_profile)
+
+    if not force_refresh and cached and cached["watermark"] == watermark:
+        yield cached["report"]
+        return
+
+    async def save_report(report):
+        try:
+            await asyncio.to_thread(store.save_report, username, watermark, report)
+        except Exception as e:
+            logger.error(f"Cannot save report for {username}: {e}")
+
+    async for report_update in report_flights.stream(
+        (username, watermark),
+        lambda: generate_weekly_report(
+            chat_history, child_profile, on_done=save_report, username=username, priority=priority
+        )
+    ):
+        yield report_update
+
+
+async def refresh_weekly_report(username):
+    """批量预生成用：聊天记录有变化时重新生成并保存周报，返回 generated / unchanged / skipped / failed"""
+    chat_history, child_profile, cached = await asyncio.to_thread(load_report_history, username)
+    if not child_profile or not chat_history:
+        return "skipped"
+    watermark = report_watermark(chat_history, child_profile)
+    if cached and cached["watermark"] == watermark:
+        return "unchanged"
+
+    async for _ in get_weekly_report(
+        username, chat_history, child_profile, cached, force_refresh=True, priority=PRIORITY_BATCH
+    ):
+        pass
+    saved = await asyncio.to_thread(store.load_report, username)
+    return "generated" if saved and saved["watermark"] == watermark else "failed"
+
+
+async def generate_weekly_report(chat_history, child_profile, on_done=None, username="", priority=PRIORITY_REPORT):
+    """生成周报（异步流式），成功生成完整周报后调用 await on_done(report)；username、priority 用于排队"""
     if not chat_history or len(chat_history) == 0:
         child_name = child_profile.get("nickname", "孩子")
         yield f"## 📊 本周周报\n\n你的妈妈最近还没有和{child_name}聊天呢。\n\n💡 建议：可以主动找妈妈聊聊天，关心一下她最近的生活。"
@@ -643,14 +1108,20 @@ def generate_weekly_report(chat_history, child_profile):
     # 显示"正在生成中..."
     yield "## 📊 本周周报\n\n正在生成中..."
 
-    # 提取最近的对话（最多取最近20条）
-    recent_chats = chat_history[-20:] if len(chat_history) > 20 else chat_history
-
-    # 构建对话文本
+    # 构建对话文本（chat_history 已经是最近一周的消息），同时按消息标签统计妈妈提到的话题
     conversation_text = ""
-    for msg in recent_chats:
+    topic_counts = {}
+    for msg in chat_history:
         role = "妈妈" if msg["role"] == "user" else child_profile.get("nickname", "孩子")
         conversation_text += f"{role}: {msg['content']}\n\n"
+        if msg["role"] == "user":
+            for tag in message_tags(msg, keyword_matcher):
+                if tag in MEMORY_CATEGORIES:
+                    topic_counts[tag] = topic_counts.get(tag, 0) + 1
+    topics_text = "、".join(
+        f"{tag}（{count} 次）"
+        for tag, count in sorted(topic_counts.items(), key=lambda item: -item[1])
+    ) or "（无）"
 
     # 使用 Ollama 生成周报（第三人称视角）
     prompt = f"""你是一个 AI 助手，正在向子女汇报他/她妈妈本周的聊天情况。请用第三人称视角，以"你的妈妈"来称呼。
@@ -658,6 +1129,8 @@ def generate_weekly_report(chat_history, child_profile):
 聊天记录：
 {conversation_text}
 
+妈妈提到的话题：{topics_text}
+
 请用自然、温暖的语言，以第三人称视角向子女汇报：
 1. 本周你的妈妈跟我主要聊了什么话题
 2. 你的妈妈的情绪和状态如何
@@ -672,28 +1145,64 @@ def generate_weekly_report(chat_history, child_profile):
 - 如果聊天内容很少，就简短说明即可
 """
 
+    # 排队领号：周报优先级低于聊天，排不上时提示稍后再看（不保存这次结果）
+    try:
+        ticket = llm_scheduler.enqueue(username, priority)
+    except SchedulerBusy:
+        yield "## 📊 本周周报\n\n现在使用的人比较多，请稍后再来查看周报。"
+        return
+
     try:
+        try:
+            # 批量任务没人在等，不设排队超时
+            timeout = None if priority == PRIORITY_BATCH else QUEUE_TIMEOUT
+            async for position in ticket.queued(QUEUE_NOTICE_INTERVAL, timeout):
+                yield f"## 📊 本周周报\n\n排队生成中，前面还有 {position + 1} 个请求..."
+        except SchedulerBusy:
+            yield "## 📊 本周周报\n\n现在使用的人比较多，请稍后再来查看周报。"
+            return
+        kind = PRIORITY_NAMES[priority]
+        LLM_QUEUE_WAIT_SECONDS.observe(ticket.granted_at - ticket.enqueued_at, kind=kind)
+
         # 调用 DeepSeek API（流式输出）
-        stream = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=[
+        stream_started = time.monotonic()
+        first_token_at = None
+        usage = None
+        stream = stream_completion(
+            [
                 {"role": "system", "content": "你是一个 AI 助手，正在向子女汇报他/她妈妈的聊天情况。使用第三人称视角，称呼为'你的妈妈'。"},
                 {"role": "user", "content": prompt}
             ],
-            stream=True  # 启用流式输出
+            stream_options={"include_usage": True}
         )
 
         # 逐字输出周报
         full_report = "## 📊 本周周报\n\n"
-        for chunk in stream:
-            if chunk.choices[0].delta.content:
+        async for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
                 content = chunk.choices[0].delta.content
+                first_token_at = first_token_at or time.monotonic()
                 full_report += content
                 yield full_report  # 实时更新
 
+        turn = record_llm_stream(kind, stream_started, first_token_at, usage, full_report)
+        logger.info(
+            f"Weekly report for {username}: ttft={turn['ttft'] * 1000:.0f}ms, stream={turn['stream']:.2f}s, "
+            f"{turn['tokens_per_second']:.1f} tok/s, completion_tokens={turn['completion_tokens']}"
+        )
+
+        if on_done:
+            await on_done(full_report)
+
     except Exception as e:
+        logger.error(f"Weekly report failed for {username}: {type(e).__name__}: {e}")
         yield f"## 📊 本周周报\n\n生成周报时出错了：{str(e)}\n\n请检查 DeepSeek API 配置。\n\n聊天记录共 {len(chat_history)} 条消息。"
 
+    finally:
+        ticket.release()
+
 # =====================
 # UI
 # =====================
@@ -703,6 +1212,8 @@ with gr.Blocks(theme=gr.themes.Soft()) as demo:
     child_profile = gr.State({})
     chat_history = gr.State([])
     username_state = gr.State("")
+    # Chatbot 里显示的第一条消息的 seq（None：全部显示）
+    history_shown_from = gr.State(None)
 
     # ===== 第一页：登录 =====
     with gr.Column(visible=True) as login_panel:
@@ -752,6 +1263,7 @@ with gr.Blocks(theme=gr.themes.Soft()) as demo:
             label="妈妈的名字",
             placeholder="例如：张妈妈、李阿姨..."
         )
+        force_refresh_input = gr.Checkbox(label="重新生成最新周报", value=False)
         child_login_btn = gr.Button("查看周报", variant="primary")
         back_to_login_btn = gr.Button("返回", size="sm")
 
@@ -803,6 +1315,7 @@ with gr.Blocks(theme=gr.themes.Soft()) as demo:
                 settings_btn = gr.Button("⚙️ 修改设置", size="sm")
                 logout_btn = gr.Button("🚪 退出登录", size="sm", variant="secondary")
 
+        load_earlier_btn = gr.Button("查看更早的消息", size="sm", visible=False)
         chatbot = gr.Chatbot(
             value=[],
             height=500,
@@ -825,10 +1338,19 @@ with gr.Blocks(theme=gr.themes.Soft()) as demo:
             chat_history,  # 聊天记录状态
             child_profile,  # 子女信息状态
             username_state,  # ✅ 用户名状态
-            chatbot  # ✅ 聊天窗口显示历史记录
+            chatbot,  # ✅ 聊天窗口显示历史记录
+            history_shown_from,  # Chatbot 从哪条消息开始显示
+            load_earlier_btn  # 查看更早的消息
         ]
     )
 
+    # 往前翻一页聊天记录
+    load_earlier_btn.click(
+        load_earlier_messages,
+        inputs=[username_state, chat_history, history_shown_from],
+        outputs=[chatbot, chat_history, history_shown_from, load_earlier_btn]
+    )
+
     # 去注册按钮
     go_to_register_btn.click(
         show_register_panel,
@@ -876,10 +1398,12 @@ with gr.Blocks(theme=gr.themes.Soft()) as demo:
         outputs=[login_panel, child_login_panel]
     )
 
+    # 聊天和周报是异步处理函数，不占工作线程，不限制 Gradio 队列的并发数
     child_login_btn.click(
         child_login,
-        inputs=[parent_name_input],
-        outputs=[child_login_panel, report_panel, report_content]
+        inputs=[parent_name_input, force_refresh_input],
+        outputs=[child_login_panel, report_panel, report_content],
+        concurrency_limit=None
     )
 
     back_to_child_login_btn.click(
@@ -899,20 +1423,141 @@ with gr.Blocks(theme=gr.themes.Soft()) as demo:
             username_state,
             username_input,
             password_input,
-            chatbot
+            chatbot,
+            history_shown_from,
+            load_earlier_btn
         ]
     )
 
     send.click(
         call_gpt,
-        inputs=[msg, chat_history, child_profile, username_state],
-        outputs=[chatbot, chat_history, msg]
+        inputs=[msg, chat_history, child_profile, username_state, history_shown_from],
+        outputs=[chatbot, chat_history, msg],
+        concurrency_limit=None
     )
 
     msg.submit(
         call_gpt,
-        inputs=[msg, chat_history, child_profile, username_state],
-        outputs=[chatbot, chat_history, msg]
+        inputs=[msg, chat_history, child_profile, username_state, history_shown_from],
+        outputs=[chatbot, chat_history, msg],
+        concurrency_limit=None
     )
 
-demo.launch(server_name="0.0.0.0", server_port=7860)
+# =====================
+# 启动：Gradio 挂在 FastAPI 上，旁边提供 /metrics 和 /ready
+# =====================
+# 各组件自己维护的统计，抓取时再读
+REGISTRY.gauge(
+    "ai_kid_llm_scheduler", "LLM scheduler state (active, waiting)", ["state"],
+    lambda: {(key,): value for key, value in llm_scheduler.stats().items() if key in ("active", "waiting")}
+)
+REGISTRY.gauge(
+    "ai_kid_llm_stream_events", "LLM stream retries, hedges and timeouts since start", ["event"],
+    lambda: {(key,): value for key, value in stream_stats.counters.items()}
+)
+REGISTRY.gauge(
+    "ai_kid_history_writer", "Write-behind queue depth and totals since start", ["stat"],
+    lambda: {(key,): value for key, value in history_writer.stats().items()}
+)
+REGISTRY.gauge(
+    "ai_kid_retrieval", "Retrieval indexes in memory, loading, and indexed exchanges", ["stat"],
+    lambda: {(key,): value for key, value in retriever.stats().items()}
+)
+REGISTRY.gauge(
+    "ai_kid_store_cache", "Storage cache entries, bytes, hits, misses and evictions", ["stat"],
+    lambda: {(key,): value for key, value in store.cache.stats().items()} if hasattr(store, "cache") else {}
+)
+
+# 启动预热：导入完成后，在后台建好到 DeepSeek 和存储的连接，完成后 /ready 才返回 200，
+# 编排系统（k8s readinessProbe 等）只把流量导给预热好的实例
+# - STARTUP_WARMUP=0 关闭预热（启动后直接就绪）
+# - WARMUP_TIMEOUT：每项预热最多等多少秒；失败或超时也算完成（外部服务抖一下时不至于所有实例都不接流量），
+#   原因写在 /ready 的返回里
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "1") != "0"
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "20"))
+
+startup = {
+    "ready": False,
+    "import_seconds": time.perf_counter() - IMPORT_STARTED,
+    "warmup_seconds": None,
+    "warmup": {},
+}
+logger.info(f"App imported in {startup['import_seconds']:.2f}s")
+
+REGISTRY.gauge(
+    "ai_kid_startup_seconds", "Time spent importing the app and warming up connections", ["phase"],
+    lambda: {
+        (phase,): startup[f"{phase}_seconds"]
+        for phase in ("import", "warmup") if startup[f"{phase}_seconds"] is not None
+    }
+)
+
+
+async def warm_up():
+    """并发预热 DeepSeek 和存储的连接，全部完成（成功、失败或超时）后标记为就绪"""
+    started = time.perf_counter()
+
+    async def step(name, coro):
+        try:
+            await asyncio.wait_for(coro, WARMUP_TIMEOUT)
+            startup["warmup"][name] = "ok"
+        except Exception as e:
+            startup["warmup"][name] = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+            logger.warning(f"Warming up {name} failed: {startup['warmup'][name]}")
+
+    await asyncio.gather(
+        step("llm", warm_up_llm()),
+        step("storage", asyncio.to_thread(store.warm_up))
+    )
+    startup["warmup_seconds"] = time.perf_counter() - started
+    startup["ready"] = True
+    logger.info(f"Warm-up finished in {startup['warmup_seconds']:.2f}s: {startup['warmup']}")
+
+
+# 周报批量预生成：设置了 REPORT_BATCH_HOUR 时，每天这个钟点（REPORT_BATCH_TIMEZONE）在本进程里跑一遍，
+# 有聊天或周报在排队时暂停；也可以用 `python batch_reports.py` 单独跑
+REPORT_BATCH_HOUR = os.getenv("REPORT_BATCH_HOUR")
+
+
+@asynccontextmanager
+async def lifespan(_app):
+    if STARTUP_WARMUP:
+        warmup_task = asyncio.create_task(warm_up())
+    else:
+        startup["ready"] = True
+    batch_task = None
+    if REPORT_BATCH_HOUR:
+        precomputer = ReportPrecomputer(
+            store,
+            refresh_weekly_report,
+            idle_fn=lambda: llm_scheduler.waiting([PRIORITY_CHAT, PRIORITY_REPORT]) == 0
+        )
+        batch_task = asyncio.create_task(precomputer.run_daily(int(REPORT_BATCH_HOUR)))
+    yield
+    if batch_task:
+        batch_task.cancel()
+    if STARTUP_WARMUP and not warmup_task.done():
+        warmup_task.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.get("/metrics")
+def metrics():
+    return Response(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/ready")
+def ready():
+    """就绪探针：启动预热完成前返回 503"""
+    return JSONResponse(startup, status_code=200 if startup["ready"] else 503)
+
+
+# /metrics、/ready 要在挂载 Gradio（根路径）之前注册
+app = gr.mount_gradio_app(app, demo, path="/")
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host="0.0.0.0", port=7860)
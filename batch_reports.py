@@ -0,0 +1,109 @@
+"""
+周报批量预生成：在低峰时段把所有用户的周报提前生成好，子女登录时直接看到
+
+    python batch_reports.py                      # 单独跑一遍就退出（可以交给 cron）
+    python batch_reports.py --daily 3            # 常驻，每天凌晨 3 点跑一遍
+
+也可以在网页进程里跑（REPORT_BATCH_HOUR=3，见 app.py）：和聊天共用排队器，批量任务优先级最低，
+有聊天在排队时先暂停，不会和在线聊天抢名额。
+聊天记录从上次生成以来没有变化的用户直接跳过（按周报水位判断）。
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+logger = logging.getLogger(__name__)
+
+REPORT_BATCH_CONCURRENCY = int(os.getenv("REPORT_BATCH_CONCURRENCY", "2"))
+REPORT_BATCH_TIMEZONE = os.getenv("REPORT_BATCH_TIMEZONE", "Asia/Shanghai")
+
+# 有聊天在排队时，批量任务每隔多久再看一次
+IDLE_POLL_INTERVAL = 1.0
+
+
+class ReportPrecomputer:
+    """按用户名分页遍历所有用户，并发数有上限地刷新每个人的周报"""
+
+    def __init__(self, store, refresh_fn, concurrency=REPORT_BATCH_CONCURRENCY, page_size=200, idle_fn=None):
+        """
+        refresh_fn(username)：异步函数，返回 "generated" / "unchanged" / "skipped" / "failed"
+        idle_fn()：返回 False 时暂停开始新的用户（比如有聊天在排队）
+        """
+        self._store = store
+        self._refresh_fn = refresh_fn
+        self._concurrency = concurrency
+        self._page_size = page_size
+        self._idle_fn = idle_fn
+
+    async def run_once(self):
+        """遍历一遍所有用户，返回各结果的计数"""
+        started = time.monotonic()
+        counts = {}
+        semaphore = asyncio.Semaphore(self._concurrency)
+
+        async def refresh(username):
+            async with semaphore:
+                while self._idle_fn is not None and not self._idle_fn():
+                    await asyncio.sleep(IDLE_POLL_INTERVAL)
+                try:
+                    outcome = await self._refresh_fn(username)
+                except Exception as e:
+                    logger.error(f"Precomputing report for {username} failed: {e}")
+                    outcome = "failed"
+                counts[outcome] = counts.get(outcome, 0) + 1
+
+        after = None
+        while True:
+            usernames = await asyncio.to_thread(self._store.list_users, after, self._page_size)
+            if not usernames:
+                break
+            await asyncio.gather(*(refresh(username) for username in usernames))
+            after = usernames[-1]
+
+        logger.info(f"Weekly report batch finished in {time.monotonic() - started:.1f}s: {counts}")
+        return counts
+
+    async def run_daily(self, hour, timezone=REPORT_BATCH_TIMEZONE):
+        """每天 hour 点（timezone 当地时间）跑一遍，一直运行到被取消"""
+        tz = pytz.timezone(timezone)
+        while True:
+            now = datetime.now(tz)
+            next_run = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+            if next_run <= now:
+                next_run += timedelta(days=1)
+            logger.info(f"Next weekly report batch at {next_run.isoformat()}")
+            await asyncio.sleep((next_run - now).total_seconds())
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Weekly report batch failed: {e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute weekly reports for all users")
+    parser.add_argument("--concurrency", type=int, default=REPORT_BATCH_CONCURRENCY,
+                        help="reports generated at the same time")
+    parser.add_argument("--daily", type=int, metavar="HOUR",
+                        help="keep running and start a batch every day at this hour")
+    parser.add_argument("--timezone", default=REPORT_BATCH_TIMEZONE, help="timezone of --daily")
+    args = parser.parse_args()
+
+    # 导入 app 只是为了复用周报生成和存储配置，不会启动网页服务。
+    # 不启动后台写入队列：批量任务不保存聊天记录，也不能去接管、回放网页进程的 WAL
+    os.environ["HISTORY_WRITER"] = "0"
+    import app
+
+    precomputer = ReportPrecomputer(app.store, app.refresh_weekly_report, concurrency=args.concurrency)
+    if args.daily is not None:
+        asyncio.run(precomputer.run_daily(args.daily, args.timezone))
+    else:
+        asyncio.run(precomputer.run_once())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""
+微基准：每轮聊天在 Python 里做的纯 CPU 工作，在 1k / 10k / 100k 条聊天记录下各要多久、分配多少内存
+
+    python bench.py                                   # 默认 1000,10000,100000 条
+    python bench.py --sizes 1000,10000 --output bench.json
+    python bench.py --compare bench.json              # 和之前保存的结果对比（比如上一个提交）
+
+- 聊天记录是固定随机种子生成的中文对话（带 seq / tags / tokens / metadata），每次运行完全一样
+- 时间：自动调整每轮调用次数，重复几轮取中位数和最小值（每次调用的微秒数）
+- 内存：tracemalloc 单独跑一次，记录调用过程中的峰值分配和调用结束后留下的字节数
+- 对比：中位数时间或峰值分配比基线多出 --threshold（默认 20%）时标记为回退，退出码为 1
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+# 拼接聊天内容用的片段（部分带关键词，标签分布和真实聊天接近）
+MOTHER_PHRASES = [
+    "今天天气不错", "我去公园散步了", "最近有点头疼", "你吃饭了吗", "别老吃外卖",
+    "和朋友去跳舞了", "下雨了记得带伞", "买菜做了红烧肉", "晚上有点孤单", "想你了",
+    "体检结果出来了", "医生说一切正常", "你爸又去钓鱼了", "楼下新开了一家超市", "感冒好多了",
+]
+CHILD_PHRASES = [
+    "妈我挺好的", "刚下课", "今天食堂的饭还不错", "周末打算去图书馆", "你要多注意身体",
+    "天冷了多穿点", "别太累了", "我过几天给你打电话", "最近在准备考试", "室友人都很好",
+]
+
+
+def make_history(n, seed=0):
+    """生成 n 条中文聊天记录（妈妈和孩子交替）"""
+    from app import keyword_matcher
+    from keywords import tag_message
+    from prompting import count_message_tokens
+
+    rng = random.Random(seed)
+    history = []
+    for seq in range(1, n + 1):
+        is_user = seq % 2 == 1
+        phrases = MOTHER_PHRASES if is_user else CHILD_PHRASES
+        # 大多数消息很短，偶尔有很长的一段
+        count = rng.choice((1, 1, 2, 2, 3, 4)) if rng.random() > 0.02 else rng.randint(20, 60)
+        content = "，".join(rng.choice(phrases) for _ in range(count)) + rng.choice(("。", "！", "？", "～"))
+        history.append(count_message_tokens(tag_message({
+            "role": "user" if is_user else "assistant",
+            "content": content,
+            "metadata": {"title": "妈妈" if is_user else "小明"},
+            "seq": seq,
+        }, keyword_matcher)))
+    return history
+
+
+def make_memories(n=50, seed=0):
+    rng = random.Random(seed)
+    now = time.time()
+    categories = ["健康", "情绪", "日常", "天气"]
+    return [
+        {
+            "text": f"[{category}] {rng.choice(MOTHER_PHRASES)}，{rng.choice(MOTHER_PHRASES)}",
+            "category": category,
+            "importance": rng.choice((0.5, 1.0, 2.0, 3.0)),
+            "count": rng.randint(1, 5),
+            "last_seen": now - rng.uniform(0, 60 * 86400),
+        }
+        for category in (rng.choice(categories) for _ in range(n))
+    ]
+
+
+def make_cases(history, memories):
+    """每个基准：名字 -> 无参函数（和 call_gpt / handle_login 里的调用方式一致）"""
+    import app
+    import retrieval
+
+    profile = {"gender": "女", "age": "大学生", "nickname": "小明", "child_desc": "在外地读书，喜欢打篮球。" * 5}
+    summary = {"upto": max(len(history) - 200, 0), "recent": "妈妈最近在学跳舞，身体不错。", "long_term": "妈妈喜欢散步。"}
+    memories_text = app.format_memories(memories)
+    system_prompt = app.SYSTEM_PROMPT_TEMPLATE.format(
+        gender=profile["gender"], age=profile["age"], nickname=profile["nickname"],
+        child_desc=profile["child_desc"], style=app.format_style(None), summary=app.format_summary(summary)
+    )
+    context_prompt = app.CONTEXT_PROMPT_TEMPLATE.format(
+        memories=memories_text, related="（暂无）", time_awareness="【时间意识】"
+    )
+    prompt_history = app.trim_history(history)
+    shown_from = history[-app.HISTORY_PAGE_SIZE]["seq"]
+    index = retrieval.BM25Index()
+    for seq, last_seq, text in retrieval.exchanges(history):
+        index.add(seq, text, last_seq)
+
+    def prompt_format():
+        app.SYSTEM_PROMPT_TEMPLATE.format(
+            gender=profile["gender"], age=profile["age"], nickname=profile["nickname"],
+            child_desc=app.truncate_text(profile["child_desc"], app.TOKEN_BUDGET["system"] // 2),
+            style=app.format_style(None), summary=app.format_summary(summary)
+        )
+        return app.CONTEXT_PROMPT_TEMPLATE.format(
+            memories=memories_text, related="（暂无）", time_awareness="【时间意识】"
+        )
+
+    return {
+        "trim_history": lambda: app.trim_history(history),
+        "trim_history_summarized": lambda: app.trim_history(history, summary["upto"]),
+        "format_memories": lambda: app.format_memories(memories),
+        "prompt_format": prompt_format,
+        "build_messages": lambda: app.build_messages(system_prompt, prompt_history, context_prompt),
+        # 登录时只把最近一页转换成 Chatbot 格式
+        "chatbot_login": lambda: app.visible_messages(history, shown_from),
+        # call_gpt 流式输出前转换除最后一条以外、Chatbot 里显示的记录
+        "chatbot_prefix": lambda: app.visible_messages(history[:-1], shown_from),
+        # 每轮用妈妈的话检索相关的旧对话
+        "retrieval_search": lambda: index.search(MOTHER_PHRASES[0], retrieval.RETRIEVAL_TOP_K, history[-1]["seq"]),
+        # 保存 / WAL / 整段存储时的序列化
+        "json_dumps": lambda: json.dumps(history, ensure_ascii=False),
+    }
+
+
+def time_case(fn, min_time=0.05, repeat=5):
+    """返回每次调用的 (中位数秒, 最小秒, 每轮调用次数)"""
+    fn()  # 预热
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or number >= 1_000_000:
+            break
+        number *= 2 if elapsed <= 0 else max(2, min(10, int(min_time / elapsed) + 1))
+    runs = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        runs.append((time.perf_counter() - start) / number)
+    return statistics.median(runs), min(runs), number
+
+
+def measure_allocations(fn):
+    """返回 (调用过程中的峰值分配字节, 调用结束后结果等还占着的字节)"""
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        result = fn()
+        current, peak = tracemalloc.get_traced_memory()
+        del result
+    finally:
+        tracemalloc.stop()
+    return peak - before, current - before
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes, min_time, repeat, only=None):
+    results = []
+    for size in sizes:
+        history = make_history(size)
+        memories = make_memories()
+        for name, fn in make_cases(history, memories).items():
+            if only and name not in only:
+                continue
+            median, best, number = time_case(fn, min_time, repeat)
+            peak, retained = measure_allocations(fn)
+            results.append({
+                "name": name, "size": size, "median": median, "best": best,
+                "number": number, "alloc_peak": peak, "alloc_retained": retained,
+            })
+            print(f"{name:<26}{size:>8}{median * 1e6:>14.1f}{best * 1e6:>14.1f}"
+                  f"{peak / 1024:>14.1f}{retained / 1024:>14.1f}", flush=True)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """和基线对比，返回回退的条数"""
+    base = {(r["name"], r["size"]): r for r in baseline["results"]}
+    regressions = 0
+    print(f"\ncompared with {baseline.get('commit') or 'baseline'} (threshold {threshold:.0%})")
+    print(f"{'case':<26}{'size':>8}{'time':>12}{'alloc peak':>14}")
+    for r in results:
+        b = base.get((r["name"], r["size"]))
+        if b is None:
+            continue
+        time_ratio = r["median"] / b["median"] if b["median"] else 1.0
+        alloc_ratio = r["alloc_peak"] / b["alloc_peak"] if b["alloc_peak"] else 1.0
+        regressed = time_ratio > 1 + threshold or alloc_ratio > 1 + threshold
+        regressions += regressed
+        print(f"{r['name']:<26}{r['size']:>8}{time_ratio - 1:>+12.1%}{alloc_ratio - 1:>+14.1%}"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the per-turn CPU hot path")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="history sizes, comma separated")
+    parser.add_argument("--only", help="run only these cases, comma separated")
+    parser.add_argument("--min-time", type=float, default=0.05, help="minimum seconds per timing round")
+    parser.add_argument("--repeat", type=int, default=5, help="timing rounds per case")
+    parser.add_argument("--output", help="save results to this JSON file")
+    parser.add_argument("--compare", help="compare with results saved by --output")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown ratio that counts as a regression")
+    args = parser.parse_args()
+
+    # app 的配置在导入时读取：用内存存储，WAL 放到临时目录，不连任何外部服务
+    os.environ.update({
+        "DEEPSEEK_API_KEY": os.getenv("DEEPSEEK_API_KEY") or "bench",
+        "STORAGE_BACKEND": "memory",
+        "HISTORY_WAL_PATH": os.path.join(tempfile.mkdtemp(prefix="ai-kid-bench-"), "pending_writes.wal"),
+    })
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    only = set(args.only.split(",")) if args.only else None
+    print(f"{'case':<26}{'size':>8}{'median us':>14}{'best us':>14}{'peak KiB':>14}{'kept KiB':>14}")
+    results = run(sizes, args.min_time, args.repeat, only)
+
+    report = {
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+import copy
+import json
+import threading
+import time
+from collections import Counter, OrderedDict
+
+# =====================
+# 进程内缓存（TTL + LRU，按占用大小淘汰）
+# =====================
+# 一次注册/登录会多次读取同一个用户（检查用户名、保存设置、登录、保存时确认用户存在），
+# 放一层缓存在存储后端前面，写入时同步更新或失效，避免重复的网络往返
+
+
+def estimate_size(value):
+    """粗略估算缓存值占用的字节数（不做完整序列化，聊天记录很长时也很快）"""
+    if value is None:
+        return 16
+    if isinstance(value, list):
+        size = 64
+        for msg in value:
+            if isinstance(msg, dict):
+                # 中文在 UTF-8 / Python 字符串里大约 3 字节一个字
+                size += 3 * len(str(msg.get("content", ""))) + 128
+            else:
+                size += 64
+        return size
+    try:
+        return len(json.dumps(value, ensure_ascii=False).encode("utf-8")) + 64
+    except (TypeError, ValueError):
+        return 1024
+
+
+def merge_histories(base, other):
+    """
+    合并同一个用户的两份聊天记录（两个标签页 / 两个进程各自的会话）：
+    在 base 后面接上 other 里 base 没有的新消息，谁的消息都不丢
+    - 按 (角色, 时间, 内容) 比较，同样的消息出现几次就算几次
+    - other 里带 seq 的消息已经在数据库里了，base 没有时说明只是两边读出的范围不同，不接
+    """
+    remaining = Counter((msg["role"], msg.get("ts"), msg["content"]) for msg in base)
+    extra = []
+    for msg in other:
+        key = (msg["role"], msg.get("ts"), msg["content"])
+        if remaining[key] > 0:
+            remaining[key] -= 1
+        elif "seq" not in msg:
+            extra.append(msg)
+    return list(base) + extra if extra else list(base)
+
+
+class TTLCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=300.0, max_entries=10000):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._data = OrderedDict()   # key -> (expires_at, size, value)
+        self._bytes = 0
+
+        # 统计数据
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            expires_at, _, value = item
+            if expires_at < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """ttl：这一项的过期秒数，不给时用缓存的默认值"""
+        size = estimate_size(value)
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            if size > self.max_bytes:
+                # 单个值比整个缓存还大，不缓存
+                return
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), size, value)
+            self._bytes += size
+            while self._bytes > self.max_bytes or len(self._data) > self.max_entries:
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def _remove(self, key):
+        _, size, _ = self._data.pop(key)
+        self._bytes -= size
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+
+# 缓存里 “用户不存在” 的标记（和 “还没缓存” 区分开）
+# 只缓存很短的时间：别的进程刚注册的用户，本进程过一会儿就能看到
+_MISSING = object()
+
+
+class CachedStore:
+    """
+    包在存储后端外面的缓存层，接口和 HistoryStore 一致
+    - 用户信息：读穿透，保存时直接更新缓存（写穿透）
+    - 聊天记录：缓存完整记录或最近一段（登录只读最近一段），保存时接到缓存后面
+      （同一用户的几个会话各自保存时合并），接不上就失效
+    - 多进程部署时别的进程的写入本进程看不到，登录、注册前调用 invalidate_user 丢掉这个用户的缓存，
+      直接读后端（这一次读本来就要读聊天记录，不多一次往返）
+    """
+
+    def __init__(self, store, cache, missing_ttl=5.0):
+        self.store = store
+        self.cache = cache
+        self.missing_ttl = missing_ttl
+
+    def __getattr__(self, name):
+        # 其它接口原样转发给后端
+        return getattr(self.store, name)
+
+    def load_profile(self, username):
+        cached = self.cache.get(("profile", username))
+        if cached is _MISSING:
+            return None
+        if cached is not None:
+            return copy.deepcopy(cached)
+
+        child_profile = self.store.load_profile(username)
+        self._cache_profile(username, child_profile)
+        return child_profile
+
+    def load_messages(self, username, limit=None):
+        chat_history = self._cached_messages(username, limit)
+        if chat_history is not None:
+            return chat_history
+
+        chat_history = self.store.load_messages(username, limit)
+        self._cache_messages(username, chat_history, limit)
+        return chat_history
+
+    def load_user(self, username, limit=None):
+        cached = self.cache.get(("profile", username))
+        if cached is _MISSING:
+            return None, []
+        if cached is not None:
+            # 用户信息和聊天记录都在缓存里时一次都不用读
+            chat_history = self._cached_messages(username, limit)
+            if chat_history is not None:
+                return copy.deepcopy(cached), chat_history
+
+        # 聊天记录不在缓存里时和用户信息一起读（一次嵌套查询；单独读聊天记录在按行存储时
+        # 还可能要再读一次旧的 chats 表）
+        child_profile, chat_history = self.store.load_user(username, limit)
+        self._cache_profile(username, child_profile)
+        if child_profile is not None:
+            self._cache_messages(username, chat_history, limit)
+        return child_profile, chat_history
+
+    def invalidate_user(self, username):
+        """丢掉这个用户的缓存（用户信息和聊天记录），下次读直接读后端"""
+        self.cache.delete(("profile", username))
+        self.cache.delete(("messages", username))
+
+    def ensure_user(self, username):
+        cached = self.cache.get(("profile", username))
+        if cached is not None and cached is not _MISSING:
+            return
+        self.store.ensure_user(username)
+        if cached is _MISSING:
+            self.cache.set(("profile", username), {})
+
+    def save_messages(self, username, chat_history):
+        self.store.save_messages(username, chat_history)
+        self._merge_cached_messages(username, chat_history)
+
+    def save_profile(self, username, child_profile):
+        child_profile = self._with_cached_password(username, child_profile)
+        self.store.save_profile(username, child_profile)
+        self.cache.set(("profile", username), copy.deepcopy(child_profile))
+
+    def update_profile_fields(self, username, fields):
+        self.store.update_profile_fields(username, fields)
+        cached = self.cache.get(("profile", username))
+        if cached is not None and cached is not _MISSING:
+            self.cache.set(("profile", username), dict(copy.deepcopy(cached), **copy.deepcopy(fields)))
+
+    def save_user(self, username, chat_history=None, child_profile=None):
+        if child_profile is not None:
+            child_profile = self._with_cached_password(username, child_profile)
+        self.store.save_user(username, chat_history, child_profile)
+        if child_profile is not None:
+            self.cache.set(("profile", username), copy.deepcopy(child_profile))
+        elif self.cache.get(("profile", username)) is _MISSING:
+            self.cache.set(("profile", username), {})
+        if chat_history:
+            self._merge_cached_messages(username, chat_history)
+
+    def _with_cached_password(self, username, child_profile):
+        """没有新密码时把缓存里的原密码带上（缓存里的用户信息和数据库里的一致）"""
+        cached = self.cache.get(("profile", username))
+        if not child_profile.get("password") and cached and cached is not _MISSING and cached.get("password"):
+            return dict(child_profile, password=cached["password"])
+        return child_profile
+
+    def _cached_messages(self, username, limit):
+        """缓存里的聊天记录够用时返回（完整记录，或者至少有 limit 条），不够时返回 None"""
+        cached = self.cache.get(("messages", username))
+        if cached is None or not (self._is_complete(cached) or (limit is not None and len(cached) >= limit)):
+            return None
+        if limit is not None:
+            return cached[-limit:] if limit > 0 else []
+        return list(cached)
+
+    def _cache_profile(self, username, child_profile):
+        if child_profile is None:
+            self.cache.set(("profile", username), _MISSING, ttl=self.missing_ttl)
+        else:
+            self.cache.set(("profile", username), copy.deepcopy(child_profile))
+
+    def _cache_messages(self, username, chat_history, limit):
+        # 整段存储时截出来的最近几条没有 seq，分不清是不是完整记录，不缓存
+        if limit is None or (limit > 0 and (not chat_history or "seq" in chat_history[0])):
+            self.cache.set(("messages", username), list(chat_history))
+
+    def _merge_cached_messages(self, username, chat_history):
+        cached = self.cache.get(("messages", username))
+        merged = self._extend_cached(cached, chat_history) if cached is not None else None
+        if merged is not None:
+            self.cache.set(("messages", username), merged)
+        else:
+            self.cache.delete(("messages", username))
+
+    @staticmethod
+    def _is_complete(messages):
+        """是不是从第一条开始的完整记录（按行存储时第一条的 seq 是 1，整段存储的消息没有 seq）"""
+        return not messages or messages[0].get("seq", 1) == 1
+
+    @staticmethod
+    def _extend_cached(cached, chat_history):
+        """
+        要保存的记录和缓存对得上时返回合并后的记录，对不上返回 None（缓存失效）
+        - 会话里可能只有最近一段：在缓存里找到它的第一条，前面更早的部分照旧保留
+        - 缓存的那段比会话里的短：以会话里的为准
+        - 两边各有对方没有的新消息（同一用户开了两个标签页）：合并，谁的都不丢
+        """
+        if not cached:
+            return list(chat_history)
+        if not chat_history:
+            return None
+
+        def same(a, b):
+            return a.get("seq") == b.get("seq") and a["role"] == b["role"] and a["content"] == b["content"]
+
+        first = chat_history[0]
+        for i, msg in enumerate(cached):
+            if same(msg, first):
+                return cached[:i] + merge_histories(cached[i:], chat_history)
+        if any(same(msg, cached[0]) for msg in chat_history):
+            return merge_histories(chat_history, cached)
+        return None
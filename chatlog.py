@@ -0,0 +1,406 @@
+import calendar
+import codecs
+import itertools
+import logging
+import os
+import random
+import re
+from collections import Counter
+from datetime import datetime
+
+import pytz
+
+logger = logging.getLogger(__name__)
+
+# =====================
+# 上传的聊天记录导入
+# =====================
+# 妈妈在设置页上传和孩子的聊天记录（微信 / WhatsApp 导出的 txt）：
+# 1. 检测编码（BOM、UTF-8、GB18030、没有 BOM 的 UTF-16），逐行读取，不把整个文件读进内存
+# 2. 识别导出格式，边读边解析成一条条消息 {"speaker", "content", "ts"}，分批写进单独的表（store.save_chat_log）
+# 3. 同时统计孩子平时说话的习惯（语气词、表情、口头禅、几条例句），生成一份很小的风格档案放进 prompt
+# 原始文本不再存进 child_profile，登录时不用再把整份聊天记录拉下来
+
+CHAT_LOG_MAX_BYTES = int(float(os.getenv("CHAT_LOG_MAX_MB", "20")) * 1024 * 1024)
+CHAT_LOG_MAX_MESSAGES = int(os.getenv("CHAT_LOG_MAX_MESSAGES", "100000"))
+MAX_MESSAGE_CHARS = 2000   # 单条消息超过这个长度截断
+SNIFF_BYTES = 64 * 1024    # 检测编码读取的字节数
+SNIFF_LINES = 200          # 识别导出格式看的行数
+
+
+class ChatLogError(Exception):
+    """上传的聊天记录没法导入（文件不存在、太大等），message 可以直接给妈妈看"""
+
+
+# ---------- 编码 ----------
+
+def detect_encoding(head):
+    """根据文件开头的字节判断编码"""
+    if head.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "utf-16"
+    # 没有 BOM 的 UTF-16：ASCII 字符的另一半字节是 0
+    sample = head[:4096]
+    if sample and sample.count(0) > len(sample) // 4:
+        even_zeros = sample[0::2].count(0)
+        odd_zeros = sample[1::2].count(0)
+        return "utf-16-le" if odd_zeros > even_zeros else "utf-16-be"
+    try:
+        # 开头截断的半个字符不算错（final=False）
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "gb18030"
+
+
+def chat_log_path(file_obj):
+    """gr.File 可能传进来路径字符串，也可能是带 name 属性的临时文件对象"""
+    if file_obj is None:
+        return None
+    if isinstance(file_obj, (str, os.PathLike)):
+        return os.fspath(file_obj)
+    return getattr(file_obj, "name", None)
+
+
+def iter_lines(path):
+    """检查大小、检测编码后逐行读取（去掉行尾换行；解不出的字节替换掉，不整份失败）"""
+    if not path or not os.path.isfile(path):
+        raise ChatLogError("没有找到上传的聊天记录文件")
+    size = os.path.getsize(path)
+    if size > CHAT_LOG_MAX_BYTES:
+        raise ChatLogError(f"聊天记录文件太大了（超过 {CHAT_LOG_MAX_BYTES // (1024 * 1024)} MB），可以只导出最近一段再上传")
+
+    with open(path, "rb") as f:
+        encoding = detect_encoding(f.read(SNIFF_BYTES))
+    logger.debug(f"Chat log {path}: {size} bytes, encoding {encoding}")
+
+    with open(path, encoding=encoding, errors="replace", newline=None) as f:
+        for line in f:
+            yield line.rstrip("\n").lstrip("\ufeff")
+
+
+# ---------- 解析 ----------
+
+_DATE = r"(?P<y>\d{4})[-/.年](?P<m>\d{1,2})[-/.月](?P<d>\d{1,2})日?"
+_TIME = r"(?P<H>\d{1,2}):(?P<M>\d{2})(?::(?P<S>\d{2}))?"
+_WA_DATE = r"(?P<a>\d{1,2})[/.](?P<b>\d{1,2})[/.](?P<y>\d{2,4})"
+_WA_TIME = r"(?P<H>\d{1,2}):(?P<M>\d{2})(?::(?P<S>\d{2}))?(?:\s?(?P<ampm>[AaPp]\.?\s?[Mm]\.?))?"
+
+# 微信（电脑端 / 第三方工具导出）：时间和名字占一行，内容在下面的行
+#   2023-05-01 20:15:32 妈妈        或        妈妈 2023-05-01 20:15:32
+WECHAT_HEADER = re.compile(rf"^{_DATE}\s+{_TIME}\s+(?P<speaker>\S.{{0,30}}?)\s*$")
+WECHAT_HEADER_NAME_FIRST = re.compile(rf"^(?P<speaker>\S.{{0,30}}?)\s+{_DATE}\s+{_TIME}\s*$")
+# WhatsApp：安卓 “31/12/2023, 21:15 - 名字: 内容”，iOS “[31/12/2023, 21:15:32] 名字: 内容”
+WHATSAPP = re.compile(
+    rf"^\u200e?\[?{_WA_DATE},?\s+{_WA_TIME}\]?\s+(?:-\s+)?(?P<speaker>[^:]{{1,40}}?):\s?(?P<content>.*)$"
+)
+# WhatsApp 的系统消息（加密提示、建群等），没有说话人
+WHATSAPP_SYSTEM = re.compile(rf"^\u200e?\[?{_WA_DATE},?\s+{_WA_TIME}\]?\s+(?:-\s+)?[^:]*$")
+# 没有时间的简单格式：“名字：内容”
+PLAIN = re.compile(r"^(?P<speaker>[^:：\s]{1,20})[:：]\s*(?P<content>.+)$")
+
+# 图片、语音这些占位内容，没有文字可学
+PLACEHOLDER = re.compile(
+    r"^\u200e?(<Media omitted>|<媒体已省略>|<附件：.*>|image omitted|video omitted|audio omitted|sticker omitted"
+    r"|\[(图片|语音|视频|文件|动画表情|表情|位置|链接|视频通话|语音通话)\])$",
+    re.IGNORECASE
+)
+
+
+def detect_format(lines):
+    """看开头若干行哪种格式命中最多：wechat / whatsapp / plain；都不像返回 None"""
+    hits = Counter()
+    for line in lines:
+        line = line.strip()
+        if WECHAT_HEADER.match(line) or WECHAT_HEADER_NAME_FIRST.match(line):
+            hits["wechat"] += 1
+        elif WHATSAPP.match(line) or WHATSAPP_SYSTEM.match(line):
+            hits["whatsapp"] += 1
+        elif PLAIN.match(line):
+            hits["plain"] += 1
+    # 有时间的格式优先，简单格式容易把正文里的 “注意：” 当成名字
+    for name in ("wechat", "whatsapp", "plain"):
+        if hits[name] >= 2 or (hits[name] and len(lines) < 5):
+            return name
+    return None
+
+
+def _utc_offset(tz, cache, year, month, day, hour):
+    """时区在这个钟点的 UTC 偏移秒数（pytz 的 localize 很慢，同一个钟点只算一次）"""
+    key = (year, month, day, hour)
+    offset = cache.get(key)
+    if offset is None:
+        offset = cache[key] = tz.localize(datetime(year, month, day, hour), is_dst=False).utcoffset().total_seconds()
+    return offset
+
+
+def _timestamp(match, tz, offsets, whatsapp=False):
+    """把匹配到的日期时间转成 epoch 秒（按妈妈所在时区理解），不合法返回 None"""
+    try:
+        groups = match.groupdict()
+        year, hour = int(groups["y"]), int(groups["H"])
+        if whatsapp:
+            a, b = int(groups["a"]), int(groups["b"])
+            # 12 小时制一般是美式 “月/日”，否则 “日/月”；有一边大于 12 时就能确定
+            month_first = bool(groups.get("ampm")) and a <= 12 or b > 12
+            month, day = (a, b) if month_first else (b, a)
+            if year < 100:
+                year += 2000
+            ampm = (groups.get("ampm") or "").lower()
+            if ampm.startswith("p") and hour < 12:
+                hour += 12
+            elif ampm.startswith("a") and hour == 12:
+                hour = 0
+        else:
+            month, day = int(groups["m"]), int(groups["d"])
+        naive = datetime(year, month, day, hour, int(groups["M"]), int(groups["S"] or 0))
+        return calendar.timegm(naive.timetuple()) - _utc_offset(tz, offsets, year, month, day, hour)
+    except (ValueError, OverflowError):
+        return None
+
+
+def parse_chat_log(lines, timezone="Asia/Shanghai", max_messages=CHAT_LOG_MAX_MESSAGES):
+    """
+    逐行解析聊天记录，产出 {"speaker", "content", "ts"}（ts 没有时为 None）
+    - 先看开头 SNIFF_LINES 行判断格式，再接着往下解析（不会把整份读进内存）
+    - 不认识的行算作上一条消息的续行；图片、语音等占位消息跳过
+    - 超过 max_messages 条后不再解析
+    """
+    lines = iter(lines)
+    head = list(itertools.islice(lines, SNIFF_LINES))
+    fmt = detect_format(head)
+    if fmt is None:
+        logger.info("Chat log format not recognized, nothing imported")
+        return
+    tz = pytz.timezone(timezone)
+    offsets = {}
+
+    current = None
+    count = 0
+
+    def finish(msg):
+        content = msg["content"].strip()
+        if not content or PLACEHOLDER.match(content):
+            return None
+        msg["content"] = content[:MAX_MESSAGE_CHARS]
+        return msg
+
+    for line in itertools.chain(head, lines):
+        stripped = line.strip()
+        started = None
+        if fmt == "wechat":
+            match = WECHAT_HEADER.match(stripped) or WECHAT_HEADER_NAME_FIRST.match(stripped)
+            if match:
+                started = {"speaker": match["speaker"], "content": "", "ts": _timestamp(match, tz, offsets)}
+        elif fmt == "whatsapp":
+            match = WHATSAPP.match(stripped)
+            if match:
+                started = {"speaker": match["speaker"], "content": match["content"],
+                           "ts": _timestamp(match, tz, offsets, whatsapp=True)}
+            elif WHATSAPP_SYSTEM.match(stripped):
+                started = False
+        else:
+            match = PLAIN.match(stripped)
+            if match:
+                started = {"speaker": match["speaker"], "content": match["content"], "ts": None}
+
+        if started is None:
+            # 续行（多行消息）
+            if current is not None and stripped:
+                current["content"] += ("\n" if current["content"] else "") + stripped
+            continue
+
+        if current is not None:
+            msg = finish(current)
+            if msg is not None:
+                count += 1
+                yield msg
+                if count >= max_messages:
+                    logger.warning(f"Chat log truncated at {max_messages} messages")
+                    return
+        current = started or None
+
+    if current is not None:
+        msg = finish(current)
+        if msg is not None:
+            yield msg
+
+
+# ---------- 说话风格 ----------
+
+# 句尾语气词
+PARTICLES = ("哈", "呀", "啦", "嘛", "哦", "噢", "呢", "吧", "嗯", "啊", "咯", "喔", "嘞")
+# 孩子对妈妈的称呼
+ADDRESS_TERMS = ("老妈", "妈妈", "妈咪", "母上", "麻麻", "妈")
+# 说话人像是妈妈自己
+MOTHER_NAMES = {"mom", "mum", "mama", "mother", "母亲", "老妈", "妈妈", "妈"}
+SELF_NAMES = {"我", "me", "you", "自己"}
+
+WECHAT_EMOJI = re.compile(r"\[[\u4e00-\u9fa5A-Za-z]{1,4}\]")
+UNICODE_EMOJI = re.compile("[\U0001F300-\U0001FAFF\u2600-\u27bf]")
+
+MAX_SPEAKERS = 20          # 群聊导出时最多统计这么多个说话人
+MAX_PHRASES = 2000         # 短句计数超过这个数量时只留最常见的一半
+SAMPLE_COUNT = 5           # 保留的例句条数
+
+
+class _SpeakerStats:
+    def __init__(self, rng):
+        self.rng = rng
+        self.messages = 0
+        self.chars = 0
+        self.short = 0
+        self.tildes = 0
+        self.periods = 0
+        self.endings = Counter()
+        self.emoji = Counter()
+        self.address = Counter()
+        self.phrases = Counter()
+        self.samples = []
+        self.sample_seen = 0
+
+    def add(self, content):
+        text = content.strip()
+        self.messages += 1
+        self.chars += len(text)
+        if len(text) <= 5:
+            self.short += 1
+        self.tildes += "~" in text or "～" in text
+        self.periods += text.endswith("。")
+
+        self.emoji.update(WECHAT_EMOJI.findall(text))
+        self.emoji.update(UNICODE_EMOJI.findall(text))
+        plain = UNICODE_EMOJI.sub("", WECHAT_EMOJI.sub("", text)).rstrip("。！!？?~～.， ")
+        if plain and plain[-1] in PARTICLES:
+            self.endings[plain[-1]] += 1
+        for term in ADDRESS_TERMS:
+            if term in text:
+                self.address[term] += 1
+                break
+
+        # 很短的整句（“好的”“知道啦”）当作口头禅候选
+        if 2 <= len(plain) <= 6:
+            self.phrases[plain] += 1
+            if len(self.phrases) > MAX_PHRASES:
+                self.phrases = Counter(dict(self.phrases.most_common(MAX_PHRASES // 2)))
+        # 中等长度的句子随机留几条做例句（蓄水池抽样）
+        if 6 <= len(text) <= 40 and "\n" not in text and text not in self.samples:
+            self.sample_seen += 1
+            if len(self.samples) < SAMPLE_COUNT:
+                self.samples.append(text)
+            else:
+                j = self.rng.randrange(self.sample_seen)
+                if j < SAMPLE_COUNT:
+                    self.samples[j] = text
+
+
+class StyleProfiler:
+    """边解析边统计每个说话人的说话习惯（只保留计数和几条例句，内存和聊天记录长度无关）"""
+
+    def __init__(self, seed=0):
+        self._rng = random.Random(seed)
+        self._speakers = {}
+
+    def add(self, msg):
+        stats = self._speakers.get(msg["speaker"])
+        if stats is None:
+            if len(self._speakers) >= MAX_SPEAKERS:
+                return
+            stats = self._speakers[msg["speaker"]] = _SpeakerStats(self._rng)
+        stats.add(msg["content"])
+
+    def child_speaker(self, nickname=None):
+        """
+        猜哪个说话人是孩子（只看说得最多的两个人）
+        - 名字和昵称对得上的
+        - 一边的名字像妈妈（“妈妈”“老妈”），另一边就是孩子
+        - 一边是 “我”（妈妈自己手机导出的），另一边就是孩子
+        猜不出来返回 None
+        """
+        top = [name for name, _ in sorted(self._speakers.items(), key=lambda item: -item[1].messages)[:2]]
+        if nickname:
+            for name in top:
+                if nickname in name or name in nickname:
+                    return name
+        if len(top) < 2:
+            return None
+        motherish = [name for name in top if name.lower() in MOTHER_NAMES or "妈" in name]
+        if len(motherish) == 1:
+            return next(name for name in top if name not in motherish)
+        selfish = [name for name in top if name.lower() in SELF_NAMES]
+        if len(selfish) == 1:
+            return next(name for name in top if name not in selfish)
+        return None
+
+    def profile(self, nickname=None):
+        """孩子的风格档案（很小的字典，存进 child_profile["chat_style"]）；认不出孩子时返回 None"""
+        speaker = self.child_speaker(nickname)
+        if speaker is None:
+            return None
+        stats = self._speakers[speaker]
+        if not stats.messages:
+            return None
+        return {
+            "speaker": speaker,
+            "messages": stats.messages,
+            "avg_chars": round(stats.chars / stats.messages, 1),
+            "short_ratio": round(stats.short / stats.messages, 2),
+            "tilde_ratio": round(stats.tildes / stats.messages, 2),
+            "period_ratio": round(stats.periods / stats.messages, 2),
+            "endings": [p for p, _ in stats.endings.most_common(4)],
+            "emoji": [e for e, _ in stats.emoji.most_common(5)],
+            "address": stats.address.most_common(1)[0][0] if stats.address else "",
+            "phrases": [p for p, count in stats.phrases.most_common(6) if count >= 2],
+            "samples": list(stats.samples),
+        }
+
+
+def format_style(style):
+    """把风格档案写成 prompt 里的几行（没有时返回 “（暂无）”）"""
+    if not style:
+        return "（暂无）"
+    lines = [f"- 平时一条消息大约 {style['avg_chars']:.0f} 个字"
+             + ("，经常只回几个字" if style.get("short_ratio", 0) >= 0.4 else "")]
+    if style.get("address"):
+        lines.append(f"- 称呼妈妈：{style['address']}")
+    if style.get("endings"):
+        lines.append(f"- 常用语气词：{'、'.join(style['endings'])}")
+    if style.get("phrases"):
+        lines.append(f"- 口头禅：{'、'.join(style['phrases'])}")
+    if style.get("emoji"):
+        lines.append(f"- 常用表情：{' '.join(style['emoji'])}")
+    if style.get("tilde_ratio", 0) >= 0.2:
+        lines.append("- 喜欢用 “～”")
+    if style.get("period_ratio", 1) <= 0.05:
+        lines.append("- 句尾基本不加句号")
+    if style.get("samples"):
+        lines.append("- 说话的例子：" + " / ".join(f"“{s}”" for s in style["samples"]))
+    return "\n".join(lines)
+
+
+def ingest_chat_log(store, username, file_obj, nickname=None, timezone="Asia/Shanghai"):
+    """
+    导入上传的聊天记录：逐行解析、分批写进 store（替换这个用户之前导入的），同时统计孩子的说话风格
+    返回 (导入的消息条数, 风格档案或 None)；文件有问题时抛出 ChatLogError
+    一条消息都认不出来时返回 (0, None)，不动之前导入的记录
+    """
+    path = chat_log_path(file_obj)
+    profiler = StyleProfiler()
+    parsed = parse_chat_log(iter_lines(path), timezone)
+    first = next(parsed, None)
+    if first is None:
+        return 0, None
+
+    def messages():
+        for msg in itertools.chain([first], parsed):
+            profiler.add(msg)
+            yield msg
+
+    count = store.save_chat_log(username, messages())
+    style = profiler.profile(nickname)
+    logger.info(
+        f"Imported {count} chat log messages for {username}"
+        + (f", child speaker {style['speaker']!r}" if style else ", child speaker not recognized")
+    )
+    return count, style
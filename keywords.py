@@ -0,0 +1,140 @@
+import json
+import logging
+import os
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# =====================
+# 关键词匹配（Aho-Corasick 多模式匹配）
+# =====================
+# 晚安检测、记忆提取、重要消息筛选原来各自用 `any(keyword in text ...)` 循环扫描，
+# 现在统一用一张关键词表构建一次自动机，一遍扫描就能找出所有类别。
+# 消息写入时打上类别标签（msg["tags"]），之后裁剪历史、生成周报直接读标签。
+
+# 关键词表：类别 -> 关键词（类别和关键词的顺序就是提取记忆时的优先级）
+DEFAULT_KEYWORD_TABLE = {
+    "晚安": ["晚安", "睡了", "困了", "休息了", "去睡", "要睡"],
+    "健康": ["头疼", "感冒", "生病", "不舒服", "医院", "体检", "吃药", "发烧", "咳嗽"],
+    "情绪": ["心情不好", "孤单", "难过", "想你", "开心", "高兴", "烦恼"],
+    "日常": ["朋友", "旅游", "出门", "散步", "买菜", "做饭", "跳舞", "唱歌", "打牌"],
+    "天气": ["天气", "下雨", "冷", "热", "晴天"],
+    # 裁剪历史时值得保留的旧消息
+    "重要": ["医院", "生病", "头疼", "感冒", "不舒服", "体检", "吃药",
+            "心情不好", "孤单", "难过", "想你", "开心",
+            "朋友", "旅游", "出门"],
+}
+
+# 提取记忆时关注的类别
+MEMORY_CATEGORIES = ["健康", "情绪", "日常", "天气"]
+
+
+def load_keyword_table():
+    """读取关键词表：KEYWORDS_PATH 指向的 JSON 文件会覆盖 / 补充默认表"""
+    table = {category: list(words) for category, words in DEFAULT_KEYWORD_TABLE.items()}
+    path = os.getenv("KEYWORDS_PATH")
+    if path:
+        try:
+            with open(path, encoding="utf-8") as f:
+                table.update(json.load(f))
+        except (OSError, ValueError) as e:
+            logger.error(f"Cannot load keyword table {path}: {e}")
+    return table
+
+
+class KeywordMatcher:
+    """把整张关键词表编译成一个 Aho-Corasick 自动机"""
+
+    def __init__(self, table):
+        self.table = table
+        # 关键词优先级：(类别顺序, 关键词顺序)
+        self._priority = {}
+        for c_idx, (category, words) in enumerate(table.items()):
+            for w_idx, word in enumerate(words):
+                self._priority[(category, word.lower())] = (c_idx, w_idx)
+
+        # trie：goto[state] = {字符: 下一个状态}，output[state] = [(关键词, 类别), ...]
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        for category, words in table.items():
+            for word in words:
+                self._add(word.lower(), category)
+        self._build()
+
+    def _add(self, word, category):
+        if not word:
+            return
+        state = 0
+        for ch in word:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = nxt
+        self._output[state].append((word, category))
+
+    def _build(self):
+        """按层遍历，计算失败指针并合并输出"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                if state == 0:
+                    # 第一层的失败指针都指向根
+                    self._fail[nxt] = 0
+                else:
+                    fail = self._fail[state]
+                    while fail and ch not in self._goto[fail]:
+                        fail = self._fail[fail]
+                    self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._output[nxt] = self._output[nxt] + self._output[self._fail[nxt]]
+
+    def find(self, text):
+        """返回所有命中：[(起始位置, 关键词, 类别), ...]"""
+        matches = []
+        state = 0
+        goto, fail, output = self._goto, self._fail, self._output
+        for i, ch in enumerate(text.lower()):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for word, category in output[state]:
+                matches.append((i - len(word) + 1, word, category))
+        return matches
+
+    def categories(self, text):
+        """文本命中的所有类别"""
+        return {category for _, _, category in self.find(text)}
+
+    def first_by_priority(self, text, categories):
+        """
+        按关键词表的优先级返回第一个命中的 (类别, 关键词, 位置)
+        （和 “按类别、按关键词依次 text.find” 的结果一致）
+        """
+        best = None
+        for start, word, category in self.find(text):
+            if category not in categories:
+                continue
+            key = (self._priority[(category, word)], start)
+            if best is None or key < best[0]:
+                best = (key, (category, word, start))
+        return best[1] if best else None
+
+
+def message_tags(msg, matcher):
+    """读取消息的类别标签；旧消息没有标签时现算（不写回消息）"""
+    tags = msg.get("tags")
+    if tags is None:
+        tags = sorted(matcher.categories(msg.get("content", "")))
+    return tags
+
+
+def tag_message(msg, matcher):
+    """消息写入时打上类别标签"""
+    msg["tags"] = sorted(matcher.categories(msg.get("content", "")))
+    return msg
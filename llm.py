@@ -0,0 +1,289 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# =====================
+# DeepSeek API 客户端
+# =====================
+# 整个进程共用一个异步客户端（聊天、周报的流式输出）和一个同步客户端（后台摘要等任务），
+# 连接池大小和 keep-alive 显式配置：并发流只受网络限制，不再占用 Gradio 的工作线程
+# 导入 openai 要 0.3 秒多，建客户端（SSL 上下文）还要几十毫秒：都推迟到第一次用到时，
+# 启动时由 warm_up() 在后台做掉，顺便把连接池里的 TLS 连接提前建好
+
+LLM_API_KEY = os.getenv("DEEPSEEK_API_KEY")
+LLM_BASE_URL = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
+MODEL_NAME = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
+
+HTTP_LIMITS = httpx.Limits(
+    max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", "200")),
+    max_keepalive_connections=int(os.getenv("LLM_MAX_KEEPALIVE", "50")),
+    keepalive_expiry=float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))
+)
+# 启动预热时提前建好的连接数
+WARM_CONNECTIONS = int(os.getenv("LLM_WARM_CONNECTIONS", "4"))
+
+# 流式输出可能持续很久，读超时按 “两段数据之间” 计算
+HTTP_TIMEOUT = httpx.Timeout(
+    connect=float(os.getenv("LLM_CONNECT_TIMEOUT", "10")),
+    read=float(os.getenv("LLM_READ_TIMEOUT", "120")),
+    write=30.0,
+    pool=30.0
+)
+
+
+def create_async_client():
+    from openai import AsyncOpenAI
+
+    # 重试由 stream_completion 自己做（只在还没出字时重试），SDK 内置的重试关掉
+    return AsyncOpenAI(
+        api_key=LLM_API_KEY,
+        base_url=LLM_BASE_URL,
+        max_retries=0,
+        http_client=httpx.AsyncClient(limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+    )
+
+
+def create_sync_client():
+    from openai import OpenAI
+
+    return OpenAI(
+        api_key=LLM_API_KEY,
+        base_url=LLM_BASE_URL,
+        http_client=httpx.Client(limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+    )
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _get_client(kind, factory):
+    client = _clients.get(kind)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(kind)
+            if client is None:
+                client = _clients[kind] = factory()
+    return client
+
+
+def get_async_client():
+    """进程共用的异步客户端（第一次调用时创建）"""
+    return _get_client("async", create_async_client)
+
+
+def get_sync_client():
+    """进程共用的同步客户端（第一次调用时创建）"""
+    return _get_client("sync", create_sync_client)
+
+
+async def warm_up(connections=WARM_CONNECTIONS):
+    """
+    启动预热：创建两个客户端，并发请求几次 GET /models，把 TLS 连接提前建好放进连接池，
+    第一个用户不用再等握手（连接空闲超过 LLM_KEEPALIVE_EXPIRY 秒后会被关掉）
+    要在之后处理请求的同一个事件循环里调用（异步连接池跟着事件循环走）
+    """
+    client = get_async_client()
+    await asyncio.gather(
+        asyncio.to_thread(lambda: get_sync_client().models.list()),
+        *(client.models.list() for _ in range(connections))
+    )
+
+
+def complete_text(prompt):
+    """非流式调用大模型，返回生成的文本（后台任务用，在工作线程里调用）"""
+    res = get_sync_client().chat.completions.create(
+        model=MODEL_NAME,
+        messages=[{"role": "user", "content": prompt}]
+    )
+    return res.choices[0].message.content or ""
+
+
+# =====================
+# 流式调用的超时、重试和对冲
+# =====================
+# - 首字超时：发出请求后 LLM_FIRST_TOKEN_TIMEOUT 秒还没有出字，算这次失败
+# - 字间超时：出字之后两段之间超过 LLM_INTER_TOKEN_TIMEOUT 秒，算卡住
+# - 还没出字的失败（超时、连不上、限流、5xx）最多重试 LLM_MAX_RETRIES 次，等待时间指数增长并加随机抖动
+# - 已经出字后不再重试（前端已经显示了一半），直接抛出
+# - 对冲（LLM_HEDGE=1 开启）：第一个请求超过 “首字时间 p95” 还没出字时，再发一个一样的请求，谁先出字用谁
+
+FIRST_TOKEN_TIMEOUT = float(os.getenv("LLM_FIRST_TOKEN_TIMEOUT", "15"))
+INTER_TOKEN_TIMEOUT = float(os.getenv("LLM_INTER_TOKEN_TIMEOUT", "20"))
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+RETRY_BACKOFF = float(os.getenv("LLM_RETRY_BACKOFF", "0.5"))
+HEDGE_ENABLED = os.getenv("LLM_HEDGE", "0") == "1"
+HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "3"))   # 样本不够时的对冲等待秒数
+HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "0.5"))
+HEDGE_MIN_SAMPLES = 20
+
+def retryable_errors():
+    """还没出字时可以重试的错误（openai 用到时才导入）"""
+    from openai import APIConnectionError, InternalServerError, RateLimitError
+
+    return (asyncio.TimeoutError, APIConnectionError, RateLimitError, InternalServerError)
+
+
+class StreamStalled(Exception):
+    """已经出字之后，两段输出之间等得太久"""
+
+
+class _StreamStats:
+    """首字时间样本（算对冲等待时间）和重试 / 对冲计数"""
+
+    def __init__(self, max_samples=1000):
+        self.ttft = deque(maxlen=max_samples)
+        self.counters = {"requests": 0, "retries": 0, "hedges": 0, "hedge_wins": 0,
+                         "first_token_timeouts": 0, "stalls": 0, "failures": 0}
+
+    def percentile(self, q):
+        samples = sorted(self.ttft)
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def hedge_delay(self):
+        if len(self.ttft) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DELAY
+        return max(HEDGE_MIN_DELAY, self.percentile(0.95))
+
+    def snapshot(self):
+        return dict(self.counters, ttft_p50=self.percentile(0.5), ttft_p95=self.percentile(0.95))
+
+
+stream_stats = _StreamStats()
+
+
+async def _iterate(iterator):
+    """逐个读取同一个迭代器（中途 break 不会关掉它，之后还能接着读）"""
+    while True:
+        try:
+            yield await iterator.__anext__()
+        except StopAsyncIteration:
+            return
+
+
+async def _open_stream(create_kwargs):
+    """发起一次流式请求，读到第一段正文为止；返回 (stream, 迭代器, 已读到的 chunks)"""
+    stream = await get_async_client().chat.completions.create(stream=True, **create_kwargs)
+    iterator = stream.__aiter__()
+    chunks = []
+    try:
+        async for chunk in _iterate(iterator):
+            chunks.append(chunk)
+            if chunk.choices and chunk.choices[0].delta.content:
+                break
+        return stream, iterator, chunks
+    except BaseException:
+        await stream.close()
+        raise
+
+
+async def _first_token(create_kwargs):
+    """带首字超时的一次尝试（成功时记录首字时间）"""
+    started = time.monotonic()
+    try:
+        result = await asyncio.wait_for(_open_stream(create_kwargs), FIRST_TOKEN_TIMEOUT)
+    except asyncio.TimeoutError:
+        stream_stats.counters["first_token_timeouts"] += 1
+        raise
+    stream_stats.ttft.append(time.monotonic() - started)
+    return result
+
+
+async def _close_later(task):
+    """对冲输掉的那个请求：已经连上的流要关掉"""
+    try:
+        stream, _, _ = await task
+    except asyncio.CancelledError:
+        # 还没连上就被取消了，没有要关的流
+        return
+    except Exception:
+        logger.debug("Losing hedged request failed", exc_info=True)
+        return
+    await stream.close()
+
+
+async def _race(create_kwargs, hedge):
+    """发出请求；开启对冲时，第一个请求迟迟不出字就再发一个，用先出字的那个"""
+    first = asyncio.create_task(_first_token(create_kwargs))
+    if not hedge:
+        return await first
+
+    # 没被选中的请求都在 pending 里，退出时（包括调用方被取消）统一取消并关掉
+    pending = {first}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=stream_stats.hedge_delay())
+        if done:
+            return first.result()
+
+        stream_stats.counters["hedges"] += 1
+        pending.add(asyncio.create_task(_first_token(create_kwargs)))
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = None
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                elif winner is None:
+                    winner = task
+                else:
+                    pending.add(task)
+            if winner is not None:
+                if winner is not first:
+                    stream_stats.counters["hedge_wins"] += 1
+                return winner.result()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+            asyncio.create_task(_close_later(task))
+
+
+async def stream_completion(messages, **create_kwargs):
+    """
+    带超时 / 重试 / 对冲的流式调用，逐个产出 chunk（和直接迭代 SDK 的 stream 一样）
+    失败时抛出最后一次的异常：还没出字的失败已经重试过，出字后卡住抛 StreamStalled
+    """
+    create_kwargs = dict(create_kwargs, model=create_kwargs.get("model", MODEL_NAME), messages=messages)
+    stream_stats.counters["requests"] += 1
+
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            stream, iterator, chunks = await _race(create_kwargs, HEDGE_ENABLED)
+            break
+        except retryable_errors() as e:
+            if attempt == MAX_RETRIES:
+                stream_stats.counters["failures"] += 1
+                raise
+            stream_stats.counters["retries"] += 1
+            delay = random.uniform(0, RETRY_BACKOFF * 2 ** attempt)
+            logger.warning(f"LLM request failed before first token ({type(e).__name__}: {e}), retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+        except Exception:
+            stream_stats.counters["failures"] += 1
+            raise
+
+    try:
+        for chunk in chunks:
+            yield chunk
+        while True:
+            try:
+                chunk = await asyncio.wait_for(iterator.__anext__(), INTER_TOKEN_TIMEOUT)
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                stream_stats.counters["stalls"] += 1
+                raise StreamStalled(f"no output for {INTER_TOKEN_TIMEOUT:g}s")
+            yield chunk
+    finally:
+        await stream.close()
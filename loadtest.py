@@ -0,0 +1,459 @@
+"""
+压测：不需要 DeepSeek 和 Supabase，在本机模拟很多妈妈和子女同时使用
+
+    python loadtest.py --mothers 200 --children 50 --turns 5
+
+- 本地起一个 OpenAI 兼容的流式接口（假模型），可以设置首字延迟、每秒 token 数、出错率、卡住的比例
+- 存储用内存后端（STORAGE_BACKEND=memory），可以加上模拟的网络往返延迟
+- 直接调用 app.py 里 Gradio 的处理函数：注册 → 填写设置 → 登录 → 聊几轮；子女登录看周报
+- 输出每种操作的吞吐量、p50 / p95 / p99 延迟，以及每个会话占用的内存
+- 压测前先顺序跑一个用户的完整流程，检查每个操作的存储往返次数（最多一次读、一次写），超出时退出码为 1
+不经过浏览器和 Gradio 的 HTTP / WebSocket 层，测的是处理函数本身和它们背后的模型、存储调用
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 假模型回复用的文本
+FAKE_REPLY = "妈，我今天挺好的，刚吃完饭，下午还要去上课。你最近身体怎么样？天气冷了记得多穿点衣服，别太累了。"
+
+# 模拟妈妈说的话
+MOTHER_LINES = [
+    "今天天气不错，我去公园散步了",
+    "最近有点头疼，不过没事",
+    "你吃饭了吗？别老吃外卖",
+    "今天和朋友去跳舞了，很开心",
+    "下雨了，你出门记得带伞",
+    "我今天买菜做了红烧肉",
+    "晚上有点孤单，想你了",
+    "体检结果出来了，医生说一切正常",
+]
+
+
+# =====================
+# 假模型（OpenAI 兼容的 /chat/completions）
+# =====================
+class FakeLLMConfig:
+    def __init__(self, latency=0.3, jitter=0.1, token_rate=50.0, reply_tokens=60,
+                 error_rate=0.0, stall_rate=0.0, stall_seconds=30.0):
+        self.latency = latency            # 首字延迟（秒）
+        self.jitter = jitter              # 首字延迟的随机浮动（秒）
+        self.token_rate = token_rate      # 每秒输出的 token 数
+        self.reply_tokens = reply_tokens  # 每次回复的 token 数
+        self.error_rate = error_rate      # 直接返回 500 的比例
+        self.stall_rate = stall_rate      # 输出到一半卡住的比例
+        self.stall_seconds = stall_seconds
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        config = self.server.config
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+        prompt_chars = sum(len(m.get("content") or "") for m in body.get("messages", []))
+        prompt_tokens = int(prompt_chars * 0.6) + 1
+
+        time.sleep(max(0.0, config.latency + random.uniform(-config.jitter, config.jitter)))
+        if random.random() < config.error_rate:
+            self._send_json(500, {"error": {"message": "injected error", "type": "server_error"}})
+            return
+
+        tokens = [FAKE_REPLY[i % len(FAKE_REPLY)] for i in range(config.reply_tokens)]
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(tokens),
+            "total_tokens": prompt_tokens + len(tokens),
+            "prompt_cache_hit_tokens": prompt_tokens // 2,
+            "prompt_cache_miss_tokens": prompt_tokens - prompt_tokens // 2,
+        }
+        if not body.get("stream"):
+            time.sleep(len(tokens) / config.token_rate)
+            self._send_json(200, {
+                "id": "fake", "object": "chat.completion", "created": int(time.time()),
+                "model": body.get("model", "fake"),
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "".join(tokens)}}],
+                "usage": usage,
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        stall_at = len(tokens) // 2 if random.random() < config.stall_rate else None
+        try:
+            self._send_chunk(body, {"role": "assistant", "content": ""})
+            for i, token in enumerate(tokens):
+                if i == stall_at:
+                    time.sleep(config.stall_seconds)
+                time.sleep(1.0 / config.token_rate)
+                self._send_chunk(body, {"content": token})
+            self._send_chunk(body, {}, finish_reason="stop")
+            if (body.get("stream_options") or {}).get("include_usage"):
+                self._send_event({"id": "fake", "object": "chat.completion.chunk", "created": int(time.time()),
+                                  "model": body.get("model", "fake"), "choices": [], "usage": usage})
+            self._send_data(b"data: [DONE]\n\n")
+            self._send_data(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端已经断开（超时或对冲输掉的请求）
+            self.close_connection = True
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_chunk(self, body, delta, finish_reason=None):
+        self._send_event({
+            "id": "fake", "object": "chat.completion.chunk", "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        })
+
+    def _send_event(self, payload):
+        self._send_data(b"data: " + json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n\n")
+
+    def _send_data(self, data):
+        # chunked 编码：长度（十六进制）+ 数据，空块表示结束
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+def start_fake_llm(config):
+    """在后台线程里启动假模型，返回 (server, base_url)"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeLLMHandler)
+    server.daemon_threads = True
+    server.request_queue_size = 1024
+    server.config = config
+    threading.Thread(target=server.serve_forever, name="fake-llm", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# =====================
+# 存储替身：内存后端 + 模拟网络往返
+# =====================
+class SlowStore:
+    """每次存储调用前等 latency 秒，模拟远程数据库的往返（其他属性原样转发）"""
+
+    def __init__(self, store, latency):
+        self._store = store
+        self._latency = latency
+
+    def __getattr__(self, name):
+        attr = getattr(self._store, name)
+        if not callable(attr) or name.startswith("_"):
+            return attr
+
+        def slow(*args, **kwargs):
+            time.sleep(self._latency)
+            return attr(*args, **kwargs)
+        return slow
+
+
+# =====================
+# 统计
+# =====================
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}   # 操作 -> [耗时, ...]
+        self.errors = {}    # 操作 -> 失败次数
+
+    def record(self, op, seconds, ok=True):
+        if ok:
+            self.samples.setdefault(op, []).append(seconds)
+        else:
+            self.errors[op] = self.errors.get(op, 0) + 1
+
+    def summary(self, elapsed):
+        result = {}
+        for op in sorted(set(self.samples) | set(self.errors)):
+            values = sorted(self.samples.get(op, []))
+            result[op] = {
+                "count": len(values),
+                "errors": self.errors.get(op, 0),
+                "throughput": len(values) / elapsed if elapsed else 0.0,
+                "p50": percentile(values, 0.50),
+                "p95": percentile(values, 0.95),
+                "p99": percentile(values, 0.99),
+                "max": values[-1] if values else 0.0,
+            }
+        return result
+
+
+def rss_bytes():
+    """当前进程的常驻内存（Linux 读 /proc，其他系统用峰值代替）"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+# =====================
+# 模拟用户
+# =====================
+async def simulate_mother(app, index, args, recorder, sessions, registered):
+    username = f"loadtest-mom-{index}"
+    password = "pw"
+
+    start = time.perf_counter()
+    await asyncio.to_thread(app.handle_register, username, password)
+    recorder.record("register", time.perf_counter() - start)
+    registered.append(username)
+
+    start = time.perf_counter()
+    await asyncio.to_thread(
+        app.save_profile, username, "女", "大学生", f"小{index}", "在外地读书", None,
+        "UTC+8（北京、上海、香港）", "UTC+8（北京、上海、香港）"
+    )
+    recorder.record("save_profile", time.perf_counter() - start)
+
+    start = time.perf_counter()
+    outputs = await asyncio.to_thread(app.handle_login, username, password)
+    recorder.record("login", time.perf_counter() - start)
+    chat_history, child_profile = outputs[4], outputs[5]
+
+    notice_prefix = app.QUEUE_NOTICE.split("{")[0]
+    for _ in range(args.turns):
+        await asyncio.sleep(random.uniform(0, args.think_time))
+        start = time.perf_counter()
+        first_token = None
+        state = None
+        async for chatbot, state_update, _ in app.call_gpt(
+            random.choice(MOTHER_LINES), chat_history, child_profile, username
+        ):
+            content = chatbot[-1]["content"] if chatbot else ""
+            if first_token is None and content and not content.startswith(notice_prefix) \
+                    and content not in (app.BUSY_REPLY, app.ERROR_REPLY):
+                first_token = time.perf_counter() - start
+            if isinstance(state_update, list):
+                state = state_update
+        elapsed = time.perf_counter() - start
+        ok = state is not None
+        recorder.record("chat_turn", elapsed, ok)
+        if ok:
+            chat_history = state
+            if first_token is not None:
+                recorder.record("chat_ttft", first_token)
+
+    sessions.append(chat_history)
+
+
+async def simulate_child(app, index, args, recorder, registered):
+    # 等妈妈们先聊一会儿，再随机看一个已经注册的妈妈的周报
+    await asyncio.sleep(random.uniform(0, args.child_delay))
+    while not registered:
+        await asyncio.sleep(0.1)
+    parent = random.choice(registered)
+    start = time.perf_counter()
+    report = ""
+    async for _, _, report in app.child_login(parent, index % 5 == 0):
+        pass
+    ok = "出错" not in report and "没有找到" not in report and "稍后" not in report
+    recorder.record("weekly_report", time.perf_counter() - start, ok)
+
+
+# =====================
+# 存储往返次数检查
+# =====================
+# 每个页面操作最多一次读、一次写（见 storage.py）。后台的工作（写入队列、检索索引的加载）
+# 等它做完再数，算在触发它的操作上；第一次建检索索引的那次读取不算（只在本机没有索引文件时发生一次）
+MAX_READS = 1
+MAX_WRITES = 1
+
+
+async def check_round_trips(app):
+    """顺序跑一个用户的注册 → 填写设置 → 登录 → 聊一轮 → 子女看周报，返回 [(操作, 读次数, 写次数)]"""
+    from metrics import STORAGE_ROUND_TRIPS
+
+    username, password = "loadtest-round-trips", "pw"
+
+    async def settle():
+        await asyncio.to_thread(app.history_writer.flush, 30)
+        while app.retriever.stats()["loading"]:
+            await asyncio.sleep(0.01)
+
+    async def chat(session):
+        async for _, state, _ in app.call_gpt(MOTHER_LINES[0], session[4], session[5], username):
+            pass
+
+    async def weekly_report():
+        async for _ in app.child_login(username):
+            pass
+
+    results = []
+    session = None
+
+    async def step(name, fn):
+        nonlocal session
+        await settle()
+        reads, writes = STORAGE_ROUND_TRIPS.value(kind="read"), STORAGE_ROUND_TRIPS.value(kind="write")
+        result = await fn()
+        await settle()
+        results.append((
+            name,
+            STORAGE_ROUND_TRIPS.value(kind="read") - reads,
+            STORAGE_ROUND_TRIPS.value(kind="write") - writes,
+        ))
+        return result
+
+    await step("register", lambda: asyncio.to_thread(app.handle_register, username, password))
+    await step("save_profile", lambda: asyncio.to_thread(
+        app.save_profile, username, "女", "大学生", "小明", "在外地读书", None,
+        "UTC+8（北京、上海、香港）", "UTC+8（北京、上海、香港）"
+    ))
+    # 登录时会在后台建检索索引（第一次要读全部聊天记录），先建好，不算在登录里
+    app.retriever.preload(username)
+    session = await step("login", lambda: asyncio.to_thread(app.handle_login, username, password))
+    await step("chat_turn", lambda: chat(session))
+    await step("weekly_report", weekly_report)
+    return results
+
+
+async def run(args):
+    llm_config = FakeLLMConfig(
+        latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000, token_rate=args.token_rate,
+        reply_tokens=args.reply_tokens, error_rate=args.error_rate, stall_rate=args.stall_rate,
+        stall_seconds=args.stall_seconds
+    )
+    server, base_url = start_fake_llm(llm_config)
+
+    # app 的配置在导入时读取，所以要先设置好环境变量
+    workdir = tempfile.mkdtemp(prefix="ai-kid-loadtest-")
+    os.environ.update({
+        "DEEPSEEK_API_KEY": "loadtest",
+        "DEEPSEEK_BASE_URL": base_url,
+        "STORAGE_BACKEND": "memory",
+        "HISTORY_WAL_PATH": os.path.join(workdir, "pending_writes.wal"),
+    })
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    import app
+    from cache import estimate_size
+
+    round_trips = await check_round_trips(app)
+
+    if args.storage_latency_ms > 0:
+        app.store = SlowStore(app.store, args.storage_latency_ms / 1000)
+
+    recorder = Recorder()
+    sessions = []
+    registered = []
+    rss_before = rss_bytes()
+    started = time.perf_counter()
+    tasks = [simulate_mother(app, i, args, recorder, sessions, registered) for i in range(args.mothers)]
+    tasks += [simulate_child(app, i, args, recorder, registered) for i in range(args.mothers and args.children)]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    app.history_writer.flush(timeout=30)
+    rss_after = rss_bytes()
+    server.shutdown()
+
+    failures = [r for r in results if isinstance(r, Exception)]
+    for failure in failures[:5]:
+        print(f"simulated user failed: {type(failure).__name__}: {failure}", file=sys.stderr)
+
+    n_sessions = args.mothers + args.children
+    return {
+        "config": vars(args),
+        "elapsed": elapsed,
+        "operations": recorder.summary(elapsed),
+        "failed_users": len(failures),
+        "memory": {
+            "rss_before": rss_before,
+            "rss_after": rss_after,
+            "rss_per_session": (rss_after - rss_before) / n_sessions if n_sessions else 0,
+            "history_state_per_session": (
+                sum(estimate_size(history) for history in sessions) / len(sessions) if sessions else 0
+            ),
+        },
+        "scheduler": app.llm_scheduler.stats(),
+        "llm_stream": app.stream_stats.snapshot(),
+        "round_trips": round_trips,
+    }
+
+
+def print_report(result):
+    print(f"\n{result['config']['mothers']} mothers, {result['config']['children']} children, "
+          f"{result['config']['turns']} turns each, {result['elapsed']:.1f}s")
+    print(f"{'operation':<16}{'count':>8}{'errors':>8}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for op, stats in result["operations"].items():
+        print(f"{op:<16}{stats['count']:>8}{stats['errors']:>8}{stats['throughput']:>10.1f}"
+              f"{stats['p50'] * 1000:>10.0f}{stats['p95'] * 1000:>10.0f}"
+              f"{stats['p99'] * 1000:>10.0f}{stats['max'] * 1000:>10.0f}")
+    memory = result["memory"]
+    print(f"memory: rss {memory['rss_before'] / 2**20:.1f} -> {memory['rss_after'] / 2**20:.1f} MiB, "
+          f"{memory['rss_per_session'] / 1024:.1f} KiB/session, "
+          f"chat_history state {memory['history_state_per_session'] / 1024:.1f} KiB/session")
+    print(f"queue wait: chat p95={result['scheduler']['chat']['wait_p95'] * 1000:.0f}ms, "
+          f"report p95={result['scheduler']['report']['wait_p95'] * 1000:.0f}ms, "
+          f"rejected={result['scheduler']['chat']['rejected'] + result['scheduler']['report']['rejected']}")
+    print(f"llm: {result['llm_stream']}")
+    print("storage round trips: " + ", ".join(
+        f"{op} {reads}r/{writes}w" for op, reads, writes in result["round_trips"]
+    ))
+    for op, reads, writes in round_trips_exceeded(result):
+        print(f"{op} needs {reads} reads and {writes} writes (max {MAX_READS} / {MAX_WRITES})")
+    if result["failed_users"]:
+        print(f"{result['failed_users']} simulated users raised an exception")
+
+
+def round_trips_exceeded(result):
+    return [
+        (op, reads, writes) for op, reads, writes in result["round_trips"]
+        if reads > MAX_READS or writes > MAX_WRITES
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AI-kid load test with a local fake LLM and in-memory storage")
+    parser.add_argument("--mothers", type=int, default=50, help="simulated mothers chatting at once")
+    parser.add_argument("--children", type=int, default=10, help="simulated children opening weekly reports")
+    parser.add_argument("--turns", type=int, default=5, help="chat turns per mother")
+    parser.add_argument("--think-time", type=float, default=1.0, help="max seconds a mother waits between turns")
+    parser.add_argument("--child-delay", type=float, default=5.0, help="max seconds before a child logs in")
+    parser.add_argument("--latency-ms", type=float, default=300, help="fake LLM time to first token")
+    parser.add_argument("--jitter-ms", type=float, default=100, help="random spread of the first-token latency")
+    parser.add_argument("--token-rate", type=float, default=50, help="fake LLM tokens per second")
+    parser.add_argument("--reply-tokens", type=int, default=60, help="tokens per fake reply")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of LLM requests failing with 500")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="fraction of LLM streams that stall halfway")
+    parser.add_argument("--stall-seconds", type=float, default=30.0, help="how long a stalled stream stays silent")
+    parser.add_argument("--storage-latency-ms", type=float, default=20, help="simulated storage round trip")
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if round_trips_exceeded(result):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+import logging
+import math
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# =====================
+# 记忆提取（后台流水线）
+# =====================
+# 每轮聊天结束后把妈妈说的话交给后台线程：
+# 1. 提取记忆（关键词类别 + 上下文）
+# 2. 和已有记忆去重（几乎相同的合并，只刷新时间和次数）
+# 3. 按重要程度和新近程度打分，超过上限的淘汰
+# 4. 攒够一批或隔一段时间再保存，不是每条都写数据库
+# 记忆存在 child_profile["memories"]，每条是：
+# {"text": "[健康] ...", "category": "健康", "importance": 3, "count": 1, "last_seen": 时间戳}
+
+# 各类别的重要程度
+CATEGORY_IMPORTANCE = {
+    "健康": 3.0,
+    "情绪": 2.0,
+    "日常": 1.0,
+    "天气": 0.5,
+}
+
+MAX_MEMORIES = 50          # 每个用户最多保留的记忆条数
+HALF_LIFE_DAYS = 14.0      # 记忆的 “新鲜度” 半衰期
+SIMILARITY_THRESHOLD = 0.6 # 相似度超过这个值视为同一条记忆
+
+
+def _bigrams(text):
+    text = "".join(text.split())
+    if len(text) < 2:
+        return {text} if text else set()
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def similarity(a, b):
+    """两段文本的字符二元组 Jaccard 相似度（中文不需要分词）"""
+    sa, sb = _bigrams(a), _bigrams(b)
+    if not sa or not sb:
+        return 0.0
+    return len(sa & sb) / len(sa | sb)
+
+
+def normalize_memory(memory, now=None):
+    """兼容旧格式：纯字符串的记忆转成字典"""
+    if isinstance(memory, dict):
+        return memory
+    text = str(memory)
+    category = text[1:text.index("]")] if text.startswith("[") and "]" in text else ""
+    return {
+        "text": text,
+        "category": category,
+        "importance": CATEGORY_IMPORTANCE.get(category, 1.0),
+        "count": 1,
+        "last_seen": now or time.time()
+    }
+
+
+def memory_score(memory, now=None):
+    """重要程度 × 出现次数 × 新鲜度"""
+    now = now or time.time()
+    age_days = max(0.0, (now - memory.get("last_seen", now)) / 86400)
+    decay = 0.5 ** (age_days / HALF_LIFE_DAYS)
+    return memory.get("importance", 1.0) * (1 + math.log(memory.get("count", 1))) * decay
+
+
+def merge_memory(memories, text, category, now=None, max_memories=MAX_MEMORIES):
+    """把一条新记忆合并进列表（去重 + 淘汰），返回新的列表（按最近出现时间排序）"""
+    now = now or time.time()
+    memories = [dict(normalize_memory(m, now)) for m in memories or []]
+
+    for memory in memories:
+        if memory.get("category") == category and similarity(memory["text"], text) >= SIMILARITY_THRESHOLD:
+            memory["text"] = text
+            memory["count"] = memory.get("count", 1) + 1
+            memory["last_seen"] = now
+            break
+    else:
+        memories.append({
+            "text": text,
+            "category": category,
+            "importance": CATEGORY_IMPORTANCE.get(category, 1.0),
+            "count": 1,
+            "last_seen": now
+        })
+
+    if len(memories) > max_memories:
+        memories.sort(key=lambda m: memory_score(m, now), reverse=True)
+        memories = memories[:max_memories]
+    memories.sort(key=lambda m: m.get("last_seen", 0))
+    return memories
+
+
+def select_memories(memories, limit=10, now=None):
+    """选出最值得放进 prompt 的几条记忆（按时间先后排列）"""
+    now = now or time.time()
+    memories = [normalize_memory(m, now) for m in memories or []]
+    if len(memories) > limit:
+        memories = sorted(memories, key=lambda m: memory_score(m, now), reverse=True)[:limit]
+    return sorted(memories, key=lambda m: m.get("last_seen", 0))
+
+
+class MemoryPipeline:
+    """
+    后台提取记忆，不阻塞聊天回复；攒批保存
+    只保存 memories 这一个字段（在库里最新的用户信息上改），不会把聊天时拿到的旧 child_profile 整个写回去
+    """
+
+    def __init__(self, extract_fn, persist_fn, batch_size=5, flush_interval=60.0):
+        """
+        extract_fn(text) -> "[类别] 上下文" 或 None
+        persist_fn(username, fields)：只保存 child_profile 里给出的字段
+        """
+        self._extract_fn = extract_fn
+        self._persist_fn = persist_fn
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._dirty = {}   # username -> [memories, 未保存的条数, 第一次变更的时间]
+        self._thread = threading.Thread(target=self._run, name="memory-pipeline", daemon=True)
+        self._thread.start()
+
+    def submit(self, username, text, child_profile):
+        """提交一条妈妈说的话（立即返回）"""
+        if username and text:
+            self._queue.put((username, text, child_profile))
+
+    def flush(self):
+        """保存所有还没保存的记忆（关闭前调用）"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        for username, (memories, _, _) in dirty.items():
+            self._save(username, memories)
+
+    def flush_user(self, username):
+        """马上保存这个用户还没保存的记忆（修改设置前调用，设置里要带上最新的记忆）"""
+        with self._lock:
+            entry = self._dirty.pop(username, None)
+        if entry is not None:
+            self._save(username, entry[0])
+
+    def _run(self):
+        while True:
+            try:
+                username, text, child_profile = self._queue.get(timeout=self._flush_interval / 4)
+            except queue.Empty:
+                self._flush_due()
+                continue
+            try:
+                self._process(username, text, child_profile)
+            except Exception as e:
+                logger.error(f"Memory extraction failed for {username}: {e}")
+            self._flush_due()
+
+    def _process(self, username, text, child_profile):
+        memory = self._extract_fn(text)
+        if memory is None:
+            return
+        category = memory[1:memory.index("]")] if memory.startswith("[") and "]" in memory else ""
+
+        with self._lock:
+            entry = self._dirty.get(username)
+            # 还有没保存的记忆时接着它合并（比会话里的 child_profile 新）
+            base = entry[0] if entry is not None else child_profile.get("memories")
+            memories = merge_memory(base, memory, category)
+            if entry is None:
+                entry = self._dirty[username] = [memories, 0, time.monotonic()]
+            entry[0] = memories
+            entry[1] += 1
+        # 会话里的 child_profile 也更新，下一轮的 prompt 就能用上
+        child_profile["memories"] = memories
+
+    def _flush_due(self):
+        now = time.monotonic()
+        with self._lock:
+            due = {
+                username: entry
+                for username, entry in self._dirty.items()
+                if entry[1] >= self._batch_size or now - entry[2] >= self._flush_interval
+            }
+            for username in due:
+                del self._dirty[username]
+        for username, (memories, _, _) in due.items():
+            self._save(username, memories)
+
+    def _save(self, username, memories):
+        try:
+            self._persist_fn(username, {"memories": memories})
+        except Exception as e:
+            logger.error(f"Saving memories failed for {username}: {e}")
@@ -0,0 +1,228 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# =====================
+# 指标（Prometheus 文本格式）
+# =====================
+# 每轮聊天的耗时拆分和吞吐量：prompt 组装、首字时间、每秒 token 数、整个流的时间、
+# 存储读写延迟、prompt / completion token 数。
+# 指标都在进程内存里，app.py 在 /metrics 上按 Prometheus 文本格式输出（不需要额外依赖）。
+
+# 默认的耗时分桶（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200)
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    body = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    )
+    return "{" + body + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(labels[name] for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in sorted(items):
+            lines.extend(self._render_value(key, value))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = self._key(labels)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # [每个分桶的计数..., 总和, 次数]
+                entry = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+                    break
+            entry[-2] += value
+            entry[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """with histogram.time(op="..."): ... 记录代码块的耗时（出异常也记）"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_value(self, key, value):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, value):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, ("le", _format_value(float(bound))))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(value[-2])}")
+        lines.append(f"{self.name}_count{labels} {value[-1]}")
+        return lines
+
+
+class Gauge(_Metric):
+    """取值时才读（collect_fn 返回 {标签值元组: 数值}），适合把各组件已有的统计挂出来"""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), collect_fn=None):
+        super().__init__(name, documentation, labelnames)
+        self._collect_fn = collect_fn
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            values = self._collect_fn() if self._collect_fn else {}
+        except Exception:
+            # 某个组件的统计出错时这个指标先不输出，不影响其他指标
+            logger.exception(f"Collecting metric {self.name} failed")
+            values = {}
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, labelnames=(), collect_fn=None):
+        return self.register(Gauge(name, documentation, labelnames, collect_fn))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# 每轮聊天 / 周报
+CHAT_TURNS = REGISTRY.counter(
+    "ai_kid_chat_turns_total", "Chat turns by outcome (ok, goodnight, busy, error)", ["outcome"])
+PROMPT_BUILD_SECONDS = REGISTRY.histogram(
+    "ai_kid_prompt_build_seconds", "Time spent assembling the chat prompt")
+LLM_TTFT_SECONDS = REGISTRY.histogram(
+    "ai_kid_llm_ttft_seconds", "Time from request to first streamed token", ["kind"])
+LLM_STREAM_SECONDS = REGISTRY.histogram(
+    "ai_kid_llm_stream_seconds", "Total time of a streamed completion", ["kind"])
+LLM_TOKENS_PER_SECOND = REGISTRY.histogram(
+    "ai_kid_llm_tokens_per_second", "Completion tokens per second after the first token", ["kind"],
+    buckets=RATE_BUCKETS)
+LLM_TOKENS = REGISTRY.counter(
+    "ai_kid_llm_tokens_total", "Tokens used, by kind and type (prompt, completion, cache_hit)", ["kind", "type"])
+LLM_QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    "ai_kid_llm_queue_wait_seconds", "Time spent waiting for an LLM slot", ["kind"])
+
+# 存储
+STORAGE_SECONDS = REGISTRY.histogram(
+    "ai_kid_storage_seconds", "Storage call latency", ["op"])
+STORAGE_ERRORS = REGISTRY.counter(
+    "ai_kid_storage_errors_total", "Storage calls that raised", ["op"])
+STORAGE_ROUND_TRIPS = REGISTRY.counter(
+    "ai_kid_storage_round_trips_total", "Round trips to the storage backend, by kind (read, write)", ["kind"])
+
+
+class TimedStore:
+    """
+    包在存储外面，记录每个接口的耗时、出错次数和往返次数；其他属性原样转发
+    存储接口按 “一次调用一次往返” 设计（见 storage.py），缓存命中不经过这里，不算往返
+    """
+
+    READ_METHODS = ("load_profile", "load_user", "load_report_inputs", "load_messages", "load_messages_since",
+                    "load_messages_before", "load_messages_by_seq", "load_report", "list_users", "load_chat_log")
+    WRITE_METHODS = ("ensure_user", "save_messages", "save_profile", "update_profile_fields", "save_user", "save_report",
+                     "save_chat_log")
+    TIMED_METHODS = READ_METHODS + WRITE_METHODS
+
+    def __init__(self, store):
+        self._store = store
+
+    def __getattr__(self, name):
+        attr = getattr(self._store, name)
+        if name not in self.TIMED_METHODS:
+            return attr
+
+        kind = "write" if name in self.WRITE_METHODS else "read"
+
+        def timed(*args, **kwargs):
+            STORAGE_ROUND_TRIPS.inc(kind=kind)
+            start = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            except Exception:
+                STORAGE_ERRORS.inc(op=name)
+                raise
+            finally:
+                STORAGE_SECONDS.observe(time.perf_counter() - start, op=name)
+        return timed
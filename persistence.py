@@ -0,0 +1,509 @@
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Windows 上没有 fcntl，不加文件锁
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# =====================
+# 后台写入队列（write-behind）+ 本地预写日志（WAL）
+# =====================
+# 聊天回复结束后不再同步等待数据库写入：
+# 1. 先把这次保存里新增的消息追加到本地 WAL 文件（进程崩溃也不会丢）
+#    - 只记还没记过、也还没写进数据库的消息，每轮写入量和聊天记录长度无关
+#    - 文件读写不占用队列的锁；同时提交的几次保存共用一次 fsync（group commit）
+# 2. 放进待写队列，同一个用户的多次保存会合并成一次
+#    （同一用户开着几个标签页时，几份聊天记录合并成一份，不会只剩最后保存的那份）
+# 3. 后台线程按提交顺序把队列写入数据库；写失败的用户各自退避重试，不影响其他人
+# 4. 队列写空时清空 WAL；一直有流量时，WAL 超过 compact_bytes 就改写成只剩还没写完的内容
+# 启动时会先回放 WAL 里还没写完的内容
+#
+# 每个进程用自己的 WAL（路径由调用方决定，app.py 里按主机名和 pid 区分），
+# 运行期间一直锁着旁边的 <wal>.lock 文件；两个进程配成同一个路径时后启动的那个直接报错。
+# 启动时还会接管同一目录下匹配 adopt_pattern、锁已经没人拿着的 WAL（上次退出的进程留下的）：
+# 内容并进自己的 WAL 和队列后删掉原文件
+
+# 每个用户记住哪些消息已经写进了数据库（最多记多少个用户，超出时最久没动的先忘，
+# 忘了只会让这个用户的下一次保存多记几条消息到 WAL，重复写入由存储后端去重）
+ACKED_USERS = 1000
+
+
+def _message_key(msg):
+    return msg["role"], msg.get("ts"), msg["content"]
+
+
+class WriteBehindQueue:
+    def __init__(self, write_fn, wal_path, retry_delay=1.0, max_retry_delay=30.0, depth_warning=50,
+                 merge_history=None, compact_bytes=1024 * 1024, adopt_pattern=None):
+        """
+        write_fn(username, chat_history, child_profile, update_user)：真正写数据库的函数，失败时抛异常
+        （chat_history 可能只有还没保存的新消息：从 WAL 回放的内容只记了这些）
+        wal_path：本地预写日志路径，同一时间只能有一个进程使用
+        merge_history(old, new)：合并同一用户待写的两份聊天记录；不给时用新的那份
+        compact_bytes：WAL 超过这么大时改写（只保留还没写完的内容）
+        adopt_pattern：启动时接管 WAL 所在目录下匹配这个通配符、已经没有进程在用的其他 WAL
+        """
+        self._write_fn = write_fn
+        self._merge_history = merge_history
+        self._wal_path = wal_path
+        self._adopt_pattern = adopt_pattern
+        self._lock_file = None
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+        self._depth_warning = depth_warning
+        self._compact_bytes = compact_bytes
+
+        self._cond = threading.Condition()
+        self._pending = OrderedDict()   # username -> 待写入的合并结果（按第一次提交的顺序）
+        self._inflight = {}             # username -> 正在写入的内容
+        self._retry = {}                # username -> (最早什么时候重试, 这次的退避秒数)
+        self._thread = None
+        self._stopping = False
+
+        # WAL 文件：_wal_lock 保护文件和下面几项，顺序为 _sync_lock -> _wal_lock -> _cond
+        self._wal_lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._wal_file = None
+        self._wal_bytes = 0
+        self._wal_records = 0    # 追加过的记录数
+        self._wal_synced = 0     # 已经 fsync 过的记录数
+        self._logged = {}        # username -> WAL 里已经记过的消息
+        self._acked = OrderedDict()   # username -> 已经写进数据库的消息
+
+        # 统计数据
+        self.submitted = 0
+        self.coalesced = 0
+        self.written = 0
+        self.failures = 0
+        self.compactions = 0
+
+    # ---------- 对外接口 ----------
+
+    def start(self):
+        """锁住 WAL，回放它（和接管的其他 WAL）并启动后台写入线程"""
+        if self._wal_path:
+            wal_dir = os.path.dirname(self._wal_path)
+            if wal_dir:
+                os.makedirs(wal_dir, exist_ok=True)
+            self._lock_file = _try_lock(self._wal_path)
+            if self._lock_file is None:
+                raise RuntimeError(f"WAL {self._wal_path} is in use by another process")
+            self._replay_wal()
+            self._adopt_wals()
+        self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, username, chat_history=None, child_profile=None, update_user=False):
+        """提交一次保存（立即返回，不等待数据库；WAL 落盘后返回）"""
+        entry = {
+            "username": username,
+            "chat_history": list(chat_history) if chat_history is not None else None,
+            "child_profile": dict(child_profile) if child_profile is not None else None,
+            "update_user": update_user
+        }
+        with self._wal_lock:
+            record = self._wal_record(entry)
+            if record is not None:
+                self._append_wal(record)
+            position = self._wal_records
+            # 在 _wal_lock 里放进队列：改写 WAL 时看到的队列和文件内容一致
+            with self._cond:
+                self._merge_pending(entry)
+                self.submitted += 1
+                depth = self.depth()
+                self._cond.notify()
+        self._sync_wal(position)
+
+        if depth >= self._depth_warning:
+            logger.warning(f"History write queue is falling behind, depth={depth}")
+
+    def pending_history(self, username):
+        """
+        返回还没写入数据库的消息（没有则返回 None），用于读己之写：
+        调用方读出数据库里的记录后用 merge_history 把它们接上
+        """
+        with self._cond:
+            entries = [entries[username] for entries in (self._inflight, self._pending) if username in entries]
+        messages = None
+        with self._wal_lock:
+            for entry in entries:
+                unsaved = self._unsaved(entry)
+                if unsaved is None:
+                    continue
+                if messages is not None and self._merge_history is not None:
+                    unsaved = self._merge_history(messages, unsaved)
+                messages = unsaved
+        return messages
+
+    def depth(self):
+        """队列深度：等待写入 + 正在写入的用户数"""
+        return len(self._pending) + len(self._inflight)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "depth": self.depth(),
+                "submitted": self.submitted,
+                "coalesced": self.coalesced,
+                "written": self.written,
+                "failures": self.failures,
+                "retrying": len(self._retry),
+                "compactions": self.compactions,
+                "wal_bytes": self._wal_bytes
+            }
+
+    def flush(self, timeout=None):
+        """等待队列写空，返回是否在超时前写完"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while self.depth() > 0:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def flush_user(self, username, timeout=None):
+        """等待某个用户的内容写入完成，返回是否在超时前写完"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while username in self._pending or username in self._inflight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stop(self, timeout=10.0):
+        """关闭前调用：尽量写完队列后停止后台线程"""
+        flushed = self.flush(timeout)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout=1.0)
+        if not flushed:
+            logger.warning(f"History writer stopped with {self.depth()} pending users, kept in WAL for replay")
+        # WAL 里只留下还没写完的内容，下次启动不用回放已经写过的
+        self._compact_wal()
+        with self._sync_lock, self._wal_lock:
+            if self._wal_file is not None:
+                self._wal_file.close()
+                self._wal_file = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+        return flushed
+
+    # ---------- 内部实现 ----------
+
+    def _merge_pending(self, entry):
+        """同一用户的待写内容合并：聊天记录合并（或取最新），用户信息只在需要更新时保留"""
+        username = entry["username"]
+        old = self._pending.get(username)
+        if old is None:
+            self._pending[username] = entry
+            return
+
+        self.coalesced += 1
+        merged = dict(old)
+        if entry["chat_history"] is not None:
+            if self._merge_history is not None and old["chat_history"] is not None:
+                merged["chat_history"] = self._merge_history(old["chat_history"], entry["chat_history"])
+            else:
+                merged["chat_history"] = entry["chat_history"]
+        if entry["update_user"]:
+            merged["child_profile"] = entry["child_profile"]
+            merged["update_user"] = True
+        elif not old["update_user"] and entry["child_profile"] is not None:
+            merged["child_profile"] = entry["child_profile"]
+        # 合并后留在原来的位置，不会因为一直有新内容而排到后面
+        self._pending[username] = merged
+
+    def _next_username(self):
+        """按提交顺序取第一个可以写的用户；都在退避时返回 (None, 还要等多少秒)"""
+        now = time.monotonic()
+        wait = None
+        for username in self._pending:
+            retry = self._retry.get(username)
+            if retry is None or retry[0] <= now:
+                return username, None
+            wait = retry[0] - now if wait is None else min(wait, retry[0] - now)
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    username, wait = self._next_username()
+                    if username is not None:
+                        break
+                    if self._stopping:
+                        # 还在退避的内容留在 WAL 里，下次启动时回放
+                        return
+                    self._cond.wait(wait)
+                entry = self._pending.pop(username)
+                self._inflight[username] = entry
+
+            try:
+                self._write_fn(
+                    entry["username"],
+                    entry["chat_history"],
+                    entry["child_profile"],
+                    entry["update_user"]
+                )
+                ok = True
+            except Exception as e:
+                ok = False
+                logger.error(f"Background history write failed for {username}: {e}")
+
+            if ok:
+                self._acknowledge(username, entry)
+            with self._cond:
+                del self._inflight[username]
+                if ok:
+                    self.written += 1
+                    self._retry.pop(username, None)
+                else:
+                    # 写失败：只有这个用户退避（每次翻倍），放回队尾，其他用户照常写入
+                    self.failures += 1
+                    delay = self._retry.get(username, (0, self._retry_delay / 2))[1] * 2
+                    delay = min(max(delay, self._retry_delay), self._max_retry_delay)
+                    self._retry[username] = (time.monotonic() + delay, delay)
+                    newer = self._pending.pop(username, None)
+                    self._pending[username] = entry
+                    if newer is not None:
+                        self._merge_pending(newer)
+                idle = not self._pending and not self._inflight
+                self._cond.notify_all()
+
+            if ok and (idle or self._wal_bytes >= self._compact_bytes):
+                self._compact_wal()
+
+    def _unsaved(self, entry):
+        """
+        待写内容里还没写进数据库的消息（读出来的消息带 seq；新消息写入后记在 _acked 里）
+        调用方持有 _wal_lock
+        """
+        if entry["chat_history"] is None:
+            return None
+        acked = self._acked.get(entry["username"], ())
+        return [msg for msg in entry["chat_history"] if "seq" not in msg and _message_key(msg) not in acked]
+
+    def _acknowledge(self, username, entry):
+        """写入成功：记下这些消息已经在数据库里了"""
+        if not entry["chat_history"]:
+            return
+        with self._wal_lock:
+            acked = self._acked.pop(username, None) or set()
+            acked.update(_message_key(msg) for msg in entry["chat_history"] if "seq" not in msg)
+            self._acked[username] = acked
+            while len(self._acked) > ACKED_USERS:
+                self._acked.popitem(last=False)
+
+    def _wal_record(self, entry):
+        """
+        这次保存要追加到 WAL 的内容：只有还没记过、也还没写进数据库的新消息；
+        用户信息只在需要更新时记。什么都没有时返回 None（调用方持有 _wal_lock）
+        """
+        username = entry["username"]
+        messages = None
+        if entry["chat_history"] is not None:
+            logged = self._logged.setdefault(username, set())
+            acked = self._acked.get(username, ())
+            messages = []
+            for msg in entry["chat_history"]:
+                if "seq" in msg:
+                    continue
+                key = _message_key(msg)
+                if key not in logged and key not in acked:
+                    logged.add(key)
+                    messages.append(msg)
+        if not messages and not entry["update_user"]:
+            return None
+        return {
+            "username": username,
+            "chat_history": messages,
+            "child_profile": entry["child_profile"] if entry["update_user"] else None,
+            "update_user": entry["update_user"]
+        }
+
+    def _open_wal(self):
+        if self._wal_file is None and self._wal_path:
+            try:
+                self._wal_file = open(self._wal_path, "a", encoding="utf-8")
+                self._wal_bytes = self._wal_file.tell()
+            except OSError as e:
+                logger.error(f"Cannot open WAL {self._wal_path}: {e}")
+        return self._wal_file
+
+    def _append_wal(self, record):
+        """追加一条记录（还没 fsync，见 _sync_wal；调用方持有 _wal_lock）"""
+        f = self._open_wal()
+        if f is None:
+            return
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        try:
+            f.write(line)
+            self._wal_bytes += len(line.encode("utf-8"))
+            self._wal_records += 1
+        except OSError as e:
+            logger.error(f"Cannot append to WAL {self._wal_path}: {e}")
+
+    def _sync_wal(self, position):
+        """
+        等到第 position 条记录落盘：同一时间只有一个线程 fsync，
+        它等待期间追加的记录由下一次 fsync 一起落盘（group commit）
+        """
+        if not self._wal_path or self._wal_synced >= position:
+            return
+        with self._sync_lock:
+            if self._wal_synced >= position:
+                return
+            with self._wal_lock:
+                f = self._wal_file
+                if f is None:
+                    return
+                target = self._wal_records
+                try:
+                    f.flush()
+                except OSError as e:
+                    logger.error(f"Cannot flush WAL {self._wal_path}: {e}")
+                    return
+            try:
+                os.fsync(f.fileno())
+            except OSError as e:
+                logger.error(f"Cannot fsync WAL {self._wal_path}: {e}")
+                return
+            self._wal_synced = target
+
+    def _compact_wal(self):
+        """
+        改写 WAL，只留下还没写完的内容（队列空时就是清空）：
+        写到临时文件、fsync 后替换，中途崩溃时旧文件还在
+        """
+        if not self._wal_path:
+            return
+        with self._sync_lock, self._wal_lock:
+            with self._cond:
+                entries = list(self._inflight.values()) + list(self._pending.values())
+            self._logged = {}
+            records = []
+            for entry in entries:
+                record = self._wal_record(dict(entry, chat_history=self._unsaved(entry)))
+                if record is not None:
+                    records.append(record)
+
+            tmp_path = self._wal_path + ".tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    for record in records:
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                if self._wal_file is not None:
+                    self._wal_file.close()
+                    self._wal_file = None
+                os.replace(tmp_path, self._wal_path)
+            except OSError as e:
+                logger.error(f"Cannot compact WAL {self._wal_path}: {e}")
+                return
+            self._open_wal()
+            self._wal_synced = self._wal_records
+            self.compactions += 1
+
+    def _replay_wal(self):
+        """启动时回放自己的 WAL：把上次没写完的内容重新放进队列"""
+        if not os.path.exists(self._wal_path):
+            return
+        replayed = 0
+        for entry in _read_wal(self._wal_path):
+            with self._wal_lock:
+                logged = self._logged.setdefault(entry["username"], set())
+                logged.update(_message_key(msg) for msg in entry["chat_history"] or [])
+            with self._cond:
+                self._merge_pending(entry)
+            replayed += 1
+
+        if replayed:
+            logger.info(f"Replayed {replayed} WAL entries for {len(self._pending)} users")
+
+    def _adopt_wals(self):
+        """接管已经退出的进程留下的 WAL：内容追加进自己的 WAL 并落盘后，删掉原文件"""
+        if not self._adopt_pattern:
+            return
+        own = os.path.abspath(self._wal_path)
+        pattern = os.path.join(os.path.dirname(own), self._adopt_pattern)
+        for path in sorted(glob.glob(pattern)):
+            if os.path.abspath(path) == own:
+                continue
+            lock_file = _try_lock(path)
+            if lock_file is None:
+                # 还有进程在用
+                continue
+            try:
+                adopted = 0
+                for entry in _read_wal(path):
+                    with self._wal_lock:
+                        record = self._wal_record(entry)
+                        if record is not None:
+                            self._append_wal(record)
+                        with self._cond:
+                            self._merge_pending(entry)
+                    adopted += 1
+                self._sync_wal(self._wal_records)
+                os.remove(path)
+                logger.info(f"Adopted {adopted} WAL entries from {path}")
+            except OSError as e:
+                logger.error(f"Cannot adopt WAL {path}: {e}")
+            finally:
+                _remove_lock(path, lock_file)
+
+
+def _read_wal(path):
+    """逐条读出 WAL 里的记录，跳过写坏的行"""
+    try:
+        f = open(path, encoding="utf-8")
+    except FileNotFoundError:
+        return
+    with f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # 进程崩溃时最后一行可能只写了一半
+                logger.warning(f"Skipping corrupted line in WAL {path}")
+
+
+def _try_lock(wal_path):
+    """拿 <wal>.lock 的排他锁，拿到时返回打开的锁文件（关掉即释放），别的进程拿着时返回 None"""
+    lock_file = open(wal_path + ".lock", "a")
+    if fcntl is None:
+        return lock_file
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def _remove_lock(wal_path, lock_file):
+    try:
+        os.remove(wal_path + ".lock")
+    except OSError:
+        pass
+    lock_file.close()
@@ -0,0 +1,154 @@
+import os
+from bisect import bisect_right
+
+# =====================
+# 按 token 预算组装 prompt
+# =====================
+# 原来按消息条数裁剪历史（30/15/10），一条很长的粘贴消息就能让 prompt 暴涨，
+# 很多短消息时又浪费了上下文。现在每一部分都有明确的 token 预算：
+# - system：固定规则 + 子女信息
+# - memories：记得的小事 + 之前聊过的事（摘要）
+# - history：聊天记录（从最新往前放，放不下为止，剩余预算再放重要的旧消息）
+# - retrieval：检索到的相关旧对话（见 retrieval.py）
+# 每条消息的 token 数只算一次，存在消息的 "tokens" 字段里
+
+TOKEN_BUDGET = {
+    "system": int(os.getenv("PROMPT_SYSTEM_TOKENS", "1500")),
+    "memories": int(os.getenv("PROMPT_MEMORY_TOKENS", "800")),
+    "history": int(os.getenv("PROMPT_HISTORY_TOKENS", "4000")),
+    "retrieval": int(os.getenv("PROMPT_RETRIEVAL_TOKENS", "400")),
+}
+
+# 聊天记录起点按这么多条对齐（见 select_history）
+HISTORY_ANCHOR = int(os.getenv("PROMPT_HISTORY_ANCHOR", "10"))
+
+# 每条消息除正文外的固定开销（角色、分隔符等）
+MESSAGE_OVERHEAD = 4
+
+
+def estimate_tokens(text):
+    """
+    本地快速估算 token 数（不需要分词器）
+    DeepSeek 的经验值：1 个中文字约 0.6 token，1 个英文字符约 0.3 token。
+    用 UTF-8 字节数和字符数的差值算出中文（3 字节）字符的数量，全程在 C 里完成
+    """
+    if not text:
+        return 0
+    n_chars = len(text)
+    n_bytes = len(text.encode("utf-8"))
+    wide = min(n_chars, (n_bytes - n_chars) // 2)
+    return int(0.6 * wide + 0.3 * (n_chars - wide)) + 1
+
+
+def message_tokens(msg):
+    """消息的 token 数（优先用缓存的 "tokens" 字段）"""
+    tokens = msg.get("tokens")
+    if tokens is None:
+        tokens = estimate_tokens(msg.get("content", "")) + MESSAGE_OVERHEAD
+    return tokens
+
+
+def count_message_tokens(msg):
+    """消息写入时算好 token 数并缓存在消息上"""
+    msg["tokens"] = estimate_tokens(msg.get("content", "")) + MESSAGE_OVERHEAD
+    return msg
+
+
+def fit_lines(text, budget):
+    """文本超出预算时从最前面（最旧的）一行开始丢，返回 (文本, token 数)"""
+    tokens = estimate_tokens(text)
+    if tokens <= budget:
+        return text, tokens
+    lines = text.split("\n")
+    while len(lines) > 1 and estimate_tokens("\n".join(lines)) > budget:
+        lines.pop(0)
+    text = "\n".join(lines)
+    return text, estimate_tokens(text)
+
+
+def truncate_text(text, budget):
+    """文本超出预算时截掉结尾部分"""
+    if estimate_tokens(text) <= budget:
+        return text
+    # 按中文 0.6 token/字 估算能保留的字数，再逐步收紧
+    keep = max(0, int(budget / 0.6))
+    while keep > 0 and estimate_tokens(text[:keep]) > budget:
+        keep = int(keep * 0.9)
+    return text[:keep] + "…"
+
+
+def first_unsummarized_index(chat_history, summarized_upto):
+    """第一条还没被摘要的消息的位置（seq 递增，二分查找）"""
+    if not summarized_upto or not chat_history:
+        return 0
+    if "seq" not in chat_history[0]:
+        # 整段存储的旧记录没有 seq，seq 就是位置
+        return min(summarized_upto, len(chat_history))
+    return bisect_right(chat_history, summarized_upto, key=lambda msg: msg.get("seq", float("inf")))
+
+
+def select_history(chat_history, budget, is_old_candidate=None, max_old=10, max_scan=500, anchor=1):
+    """
+    按预算挑选放进 prompt 的聊天记录
+    1. 从最新的消息往前放，直到放不下（最新一条无论多长都保留）
+    2. 放不下全部时，起点向后对齐到 anchor 的整数倍：起点不会每轮都移动，
+       连续几轮的 prompt 前缀保持不变，模型服务端的前缀缓存才能命中
+    3. 剩余预算里再放几条更早的重要消息（is_old_candidate(msg) 为 True 的，最多往前看 max_scan 条）
+    返回 (按时间顺序的消息列表, 用掉的 token 数)
+    """
+    used = 0
+    start = len(chat_history)
+    for i in range(len(chat_history) - 1, -1, -1):
+        tokens = message_tokens(chat_history[i])
+        if used + tokens > budget and start < len(chat_history):
+            break
+        used += tokens
+        start = i
+
+    if start > 0 and anchor > 1:
+        aligned = min(-(-start // anchor) * anchor, len(chat_history) - 1)
+        for msg in chat_history[start:aligned]:
+            used -= message_tokens(msg)
+        start = max(start, aligned)
+
+    important = []
+    if is_old_candidate is not None and start > 0:
+        for msg in reversed(chat_history[max(0, start - max_scan):start]):
+            if len(important) >= max_old:
+                break
+            if not is_old_candidate(msg):
+                continue
+            tokens = message_tokens(msg)
+            if used + tokens > budget:
+                continue
+            used += tokens
+            important.append(msg)
+        important.reverse()
+
+    return important + chat_history[start:], used
+
+
+def prompt_cache_stats(usage):
+    """
+    从接口返回的 usage 里取出前缀缓存命中情况
+    - DeepSeek：prompt_cache_hit_tokens / prompt_cache_miss_tokens
+    - OpenAI 兼容格式：prompt_tokens_details.cached_tokens
+    """
+    if usage is None:
+        return None
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    hit = getattr(usage, "prompt_cache_hit_tokens", None)
+    if hit is None:
+        details = getattr(usage, "prompt_tokens_details", None)
+        hit = getattr(details, "cached_tokens", 0) if details is not None else 0
+    hit = hit or 0
+    miss = getattr(usage, "prompt_cache_miss_tokens", None)
+    if miss is None:
+        miss = max(prompt_tokens - hit, 0)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+        "cache_hit_tokens": hit,
+        "cache_miss_tokens": miss,
+        "cache_hit_ratio": hit / prompt_tokens if prompt_tokens else 0.0
+    }
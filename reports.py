@@ -0,0 +1,92 @@
+import asyncio
+import hashlib
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# =====================
+# 周报缓存 + 并发合并
+# =====================
+# - 周报按 “生成它用到的聊天记录” 的哈希（水位）保存，聊天记录没变就直接返回上次的结果
+# - 同一个妈妈的周报同时被多个人打开时，只发起一次生成，大家共享同一个流式输出
+
+
+def report_watermark(recent_chats, child_profile):
+    """周报输入的指纹：最近的聊天记录 + 孩子昵称，任何一项变了周报都要重新生成"""
+    payload = {
+        "nickname": child_profile.get("nickname", "孩子"),
+        "chats": [
+            [msg.get("seq"), msg["role"], msg["content"]]
+            for msg in recent_chats
+        ]
+    }
+    data = json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return hashlib.sha1(data).hexdigest()
+
+
+class _Flight:
+    """一次进行中的生成：保存最新输出，订阅者按版本号等待更新"""
+
+    def __init__(self):
+        self.cond = asyncio.Condition()
+        self.value = None
+        self.version = 0
+        self.done = False
+
+    async def publish(self, value):
+        async with self.cond:
+            self.value = value
+            self.version += 1
+            self.cond.notify_all()
+
+    async def finish(self):
+        async with self.cond:
+            self.done = True
+            self.cond.notify_all()
+
+    async def subscribe(self):
+        seen = 0
+        while True:
+            async with self.cond:
+                await self.cond.wait_for(lambda seen=seen: self.version != seen or self.done)
+                if self.version == seen and self.done:
+                    return
+                seen = self.version
+                value = self.value
+            # 只推最新的输出，订阅者跟不上时会跳过中间状态
+            yield value
+
+
+class SingleFlight:
+    """相同 key 的并发请求共享同一次生成（生成在独立的任务里跑，某个订阅者断开不影响其他人）"""
+
+    def __init__(self):
+        self._flights = {}
+        self._tasks = set()
+
+    async def stream(self, key, make_generator):
+        """make_generator() 返回异步生成器"""
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight()
+            self._flights[key] = flight
+            task = asyncio.create_task(self._run(key, flight, make_generator))
+            # 保留任务引用，防止被垃圾回收
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        async for value in flight.subscribe():
+            yield value
+
+    def in_flight(self):
+        return len(self._flights)
+
+    async def _run(self, key, flight, make_generator):
+        try:
+            async for value in make_generator():
+                await flight.publish(value)
+        except Exception as e:
+            logger.error(f"Shared generation failed for {key}: {e}")
+        finally:
+            self._flights.pop(key, None)
+            await flight.finish()
@@ -0,0 +1,358 @@
+import hashlib
+import heapq
+import json
+import logging
+import math
+import os
+import re
+import tempfile
+import threading
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate, pairwise
+
+logger = logging.getLogger(__name__)
+
+# =====================
+# 过去聊天的检索（每个用户一份 BM25 倒排索引）
+# =====================
+# 离开 prompt 窗口的旧消息只剩摘要，妈妈提起很久以前的事时模型就接不上了。
+# 这里把每一轮 “妈妈的话 + 回复” 当作一篇文档建倒排索引（中文按相邻两个字切词，不需要分词器），
+# 每轮聊天时用妈妈这句话检索最相关的几轮旧对话，按 token 预算放进 prompt。
+# - 纯 CPU、进程内：常见词只看最近的一段倒排表，10 万条聊天记录也在几毫秒内
+# - 增量更新：每轮聊完把新的一轮加进去，攒够一定数量再落盘
+# - 落盘格式紧凑（数组 + zlib），只是本机缓存：丢了或对不上时从聊天记录重建
+
+RETRIEVAL_INDEX_DIR = os.getenv("RETRIEVAL_INDEX_DIR", os.path.join("histories", "index"))
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "3"))
+RETRIEVAL_MAX_USERS = int(os.getenv("RETRIEVAL_MAX_USERS", "200"))   # 内存里最多保留多少个用户的索引
+RETRIEVAL_SAVE_EVERY = 20   # 攒够这么多轮新对话落盘一次
+
+# BM25 参数
+K1 = 1.2
+B = 0.75
+MAX_QUERY_TERMS = 12    # 查询只用区分度最高的这么多个词
+MAX_POSTINGS = 2000     # 每个词最多看最近这么多篇文档（常见词的倒排表很长，越新的越相关）
+MIN_RELATIVE_SCORE = 0.5    # 分数不到第一名这个比例的不要（只是碰巧对上一两个常见词）
+# 词频权重 tf·(k1+1)/(tf+norm) 在 0 ~ k1+1 之间，量化成一个字节存
+WEIGHT_STEP = (K1 + 1) / 255
+
+FORMAT_VERSION = 2
+
+_WORDS = re.compile(r"[一-鿿]+|[A-Za-z]+|\d+")
+
+
+def tokenize(text):
+    """中文按相邻两个字切（单独一个字的保留），英文单词转小写，数字原样"""
+    terms = []
+    for word in _WORDS.findall(text or ""):
+        if word[0] >= "一":
+            if len(word) == 1:
+                terms.append(word)
+            else:
+                terms.extend(word[i:i + 2] for i in range(len(word) - 1))
+        else:
+            terms.append(word.lower())
+    return terms
+
+
+class BM25Index:
+    """
+    一个用户的倒排索引；文档编号按加入顺序递增，对应这轮对话里妈妈那条消息的 seq
+    每个词的倒排表是 (文档编号数组, 权重数组)，权重在加入时按当时的平均长度算好并量化成一个字节，查询时只乘 idf
+    """
+
+    def __init__(self):
+        self.doc_seqs = array("I")   # 文档编号 -> seq（递增）
+        self.total_len = 0
+        self.last_seq = 0            # 已经索引到的最大 seq（包括回复）
+        self.postings = {}           # 词 -> (array("I") 文档编号, array("B") 量化后的权重)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.doc_seqs)
+
+    def add(self, seq, text, last_seq=None):
+        """加入一篇文档（seq 必须比已有的都大）"""
+        terms = tokenize(text)
+        with self._lock:
+            if self.doc_seqs and seq <= self.doc_seqs[-1]:
+                return
+            doc = len(self.doc_seqs)
+            self.doc_seqs.append(seq)
+            self.total_len += len(terms)
+            self.last_seq = max(self.last_seq, last_seq or seq)
+            if not terms:
+                return
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            avgdl = self.total_len / len(self.doc_seqs)
+            norm = K1 * (1 - B + B * len(terms) / avgdl)
+            for term, tf in counts.items():
+                posting = self.postings.get(term)
+                if posting is None:
+                    posting = self.postings[term] = (array("I"), array("B"))
+                posting[0].append(doc)
+                posting[1].append(max(1, round(tf * (K1 + 1) / (tf + norm) / WEIGHT_STEP)))
+
+    def search(self, query, k=RETRIEVAL_TOP_K, before_seq=None):
+        """
+        返回最相关的 k 篇 [(seq, 分数)]，分数从高到低
+        - before_seq：只找 seq 比它小的（已经在 prompt 里的最近消息不用再找）
+        - 查询有两个以上的词时，至少命中两个词才算（一个常见词碰巧对上不算相关）
+        """
+        with self._lock:
+            n = len(self.doc_seqs)
+            if not n:
+                return []
+            end_doc = bisect_left(self.doc_seqs, before_seq) if before_seq is not None else n
+            weighted = []
+            for term in set(tokenize(query)):
+                posting = self.postings.get(term)
+                if posting is not None:
+                    df = len(posting[0])
+                    weighted.append((math.log(1 + (n - df + 0.5) / (df + 0.5)) * WEIGHT_STEP, posting))
+            weighted.sort(key=lambda item: -item[0])
+            weighted = weighted[:MAX_QUERY_TERMS]
+
+            scores = {}
+            hits = {}
+            for idf, (docs, weights) in weighted:
+                end = bisect_left(docs, end_doc)
+                start = max(0, end - MAX_POSTINGS)
+                for doc, weight in zip(docs[start:end], weights[start:end]):
+                    scores[doc] = scores.get(doc, 0.0) + idf * weight
+                    hits[doc] = hits.get(doc, 0) + 1
+
+            min_hits = min(2, len(weighted))
+            best = heapq.nlargest(k, ((score, doc) for doc, score in scores.items() if hits[doc] >= min_hits))
+            return [(self.doc_seqs[doc], score) for score, doc in best]
+
+    # ---------- 落盘 ----------
+
+    def to_bytes(self):
+        with self._lock:
+            terms = list(self.postings)
+            header = json.dumps({
+                "version": FORMAT_VERSION,
+                "last_seq": self.last_seq,
+                "total_len": self.total_len,
+                "docs": len(self.doc_seqs),
+                "terms": terms,
+                "counts": [len(self.postings[term][0]) for term in terms],
+            }, ensure_ascii=False).encode("utf-8")
+            # 编号都是递增的，存相邻的差值，压缩后小很多
+            parts = [len(header).to_bytes(4, "little"), header, _deltas(self.doc_seqs).tobytes()]
+            for term in terms:
+                docs, weights = self.postings[term]
+                parts.append(_deltas(docs).tobytes())
+                parts.append(weights.tobytes())
+        return zlib.compress(b"".join(parts), 1)
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = zlib.decompress(data)
+        header_len = int.from_bytes(data[:4], "little")
+        header = json.loads(data[4:4 + header_len])
+        if header.get("version") != FORMAT_VERSION:
+            raise ValueError(f"unsupported index version {header.get('version')}")
+        index = cls()
+        index.last_seq = header["last_seq"]
+        index.total_len = header["total_len"]
+        pos = 4 + header_len
+
+        def take(typecode, count):
+            nonlocal pos
+            values = array(typecode)
+            size = values.itemsize * count
+            values.frombytes(data[pos:pos + size])
+            pos += size
+            return values
+
+        index.doc_seqs = array("I", accumulate(take("I", header["docs"])))
+        for term, count in zip(header["terms"], header["counts"]):
+            index.postings[term] = (array("I", accumulate(take("I", count))), take("B", count))
+        return index
+
+
+def _deltas(values):
+    return array("I", [values[0]] + [b - a for a, b in pairwise(values)]) if values else array("I")
+
+
+def exchanges(chat_history, after_seq=0):
+    """
+    把聊天记录切成一轮一轮的对话：[(妈妈那条的 seq, 这轮最后一条的 seq, 文本)]
+    只取 seq 大于 after_seq、而且已经有回复的轮次
+    会话里还没从数据库读回 seq 的新消息跳过（本地编的 seq 和别的会话同时写入后库里分配的对不上），
+    下次读出聊天记录时再加进索引
+    """
+    result = []
+    current = None
+    for msg in chat_history:
+        seq = msg.get("seq")
+        if seq is None:
+            continue
+        if msg["role"] == "user":
+            current = [seq, seq, msg["content"], False] if seq > after_seq else None
+        elif current is not None:
+            current[1] = seq
+            current[2] += "\n" + msg["content"]
+            current[3] = True
+            result.append(tuple(current[:3]))
+            current = None
+    return result
+
+
+class ChatRetriever:
+    """
+    管理所有用户的索引
+    - 第一次用到时在后台从磁盘加载，磁盘上没有就从聊天记录重建（期间检索返回空，不阻塞聊天）
+    - 内存里按最近使用保留 max_users 个用户，多出来的先落盘再丢掉
+    """
+
+    def __init__(self, load_messages_fn, index_dir=RETRIEVAL_INDEX_DIR,
+                 max_users=RETRIEVAL_MAX_USERS, save_every=RETRIEVAL_SAVE_EVERY):
+        """load_messages_fn(username)：读取用户的全部聊天记录（重建索引用）"""
+        self._load_messages_fn = load_messages_fn
+        self._index_dir = index_dir
+        self._max_users = max_users
+        self._save_every = save_every
+        self._lock = threading.Lock()
+        self._indexes = OrderedDict()   # username -> BM25Index
+        self._loading = set()
+        self._unsaved = {}              # username -> 还没落盘的新轮数
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="retrieval")
+
+    def search(self, username, query, k=RETRIEVAL_TOP_K, before_seq=None):
+        """检索这个用户最相关的 k 轮旧对话的 seq；索引还没准备好时返回空列表"""
+        index = self._get(username)
+        if index is None:
+            return []
+        hits = index.search(query, k, before_seq)
+        return [seq for seq, score in hits if score >= hits[0][1] * MIN_RELATIVE_SCORE]
+
+    def preload(self, username):
+        """提前在后台加载索引（登录时调用）"""
+        self._get(username)
+
+    def update(self, username, chat_history):
+        """把会话里新聊完的轮次加进索引（每轮聊天结束后调用）"""
+        index = self._get(username)
+        if index is None:
+            return
+        first_seq = next((msg["seq"] for msg in chat_history if "seq" in msg), None)
+        # 会话里最早的消息也比索引里的新：中间缺了一段，重建
+        if first_seq is not None and first_seq > index.last_seq + 1:
+            logger.info(f"Retrieval index for {username} is behind (seq {index.last_seq} < {first_seq - 1}), rebuilding")
+            self._reload(username, rebuild=True)
+            return
+        added = 0
+        for seq, last_seq, text in exchanges(chat_history, index.last_seq):
+            index.add(seq, text, last_seq)
+            added += 1
+        if added:
+            with self._lock:
+                unsaved = self._unsaved[username] = self._unsaved.get(username, 0) + added
+            if unsaved >= self._save_every:
+                self._executor.submit(self._save, username, index)
+
+    def flush(self):
+        """把还没落盘的索引都写到磁盘（关闭前调用）"""
+        with self._lock:
+            dirty = [(username, self._indexes[username]) for username in self._unsaved if username in self._indexes]
+        for username, index in dirty:
+            self._save(username, index)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "users": len(self._indexes),
+                "loading": len(self._loading),
+                "documents": sum(len(index) for index in self._indexes.values()),
+            }
+
+    # ---------- 内部 ----------
+
+    def _path(self, username):
+        name = hashlib.sha1(username.encode("utf-8")).hexdigest()
+        return os.path.join(self._index_dir, f"{name}.bm25")
+
+    def _get(self, username):
+        if not username:
+            return None
+        with self._lock:
+            index = self._indexes.get(username)
+            if index is not None:
+                self._indexes.move_to_end(username)
+                return index
+        self._reload(username)
+        return None
+
+    def _reload(self, username, rebuild=False):
+        with self._lock:
+            if username in self._loading:
+                return
+            self._loading.add(username)
+        self._executor.submit(self._load, username, rebuild)
+
+    def _load(self, username, rebuild):
+        try:
+            index = None
+            path = self._path(username)
+            if not rebuild and os.path.exists(path):
+                try:
+                    with open(path, "rb") as f:
+                        index = BM25Index.from_bytes(f.read())
+                except (OSError, ValueError, zlib.error) as e:
+                    logger.warning(f"Retrieval index for {username} is unreadable, rebuilding: {e}")
+            if index is None:
+                index = BM25Index()
+                for seq, last_seq, text in exchanges(self._load_messages_fn(username)):
+                    index.add(seq, text, last_seq)
+                self._write(path, index)
+                logger.info(f"Retrieval index for {username} built ({len(index)} exchanges)")
+
+            with self._lock:
+                self._indexes[username] = index
+                self._indexes.move_to_end(username)
+                self._unsaved.pop(username, None)
+                evicted = []
+                while len(self._indexes) > self._max_users:
+                    old_user, old_index = self._indexes.popitem(last=False)
+                    if self._unsaved.pop(old_user, 0):
+                        evicted.append((old_user, old_index))
+            for old_user, old_index in evicted:
+                self._write(self._path(old_user), old_index)
+        except Exception as e:
+            logger.error(f"Loading retrieval index for {username} failed: {e}")
+        finally:
+            with self._lock:
+                self._loading.discard(username)
+
+    def _save(self, username, index):
+        with self._lock:
+            self._unsaved.pop(username, None)
+        try:
+            self._write(self._path(username), index)
+        except Exception as e:
+            logger.error(f"Saving retrieval index for {username} failed: {e}")
+
+    def _write(self, path, index):
+        # 临时文件名每次不同：几个进程共用一个索引目录时，不会写到同一个临时文件里
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        tmp = None
+        try:
+            with tempfile.NamedTemporaryFile(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                             delete=False) as f:
+                tmp = f.name
+                f.write(index.to_bytes())
+            os.replace(tmp, path)
+        except BaseException:
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+            raise
@@ -0,0 +1,278 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+logger = logging.getLogger(__name__)
+
+# =====================
+# LLM 调用排队（准入控制 + 按用户公平调度）
+# =====================
+# 晚上高峰时同时打到 DeepSeek 的流太多会被限流，一个人连点 “发送” 也会挤占别人。
+# 所有流式调用先在这里领号：
+# - 全局并发上限：同时最多 LLM_MAX_CONCURRENCY 个流
+# - 按用户公平：同一优先级里按用户轮转，每人同时最多 LLM_MAX_PER_USER 个流、排队最多 LLM_MAX_QUEUED_PER_USER 个
+# - 聊天优先于周报；周报排队超过 LLM_REPORT_MAX_WAIT 秒后优先放行，不会一直饿着
+# - 后台批量预生成的周报优先级最低，只用聊天和周报剩下的名额
+# - 排队总数超过 LLM_MAX_QUEUE 或等待超过 LLM_QUEUE_TIMEOUT 秒时直接拒绝，由调用方提示稍后再试
+# - 记录每个优先级的排队时间（平均 / p50 / p95 / 最大）
+
+PRIORITY_CHAT = 0
+PRIORITY_REPORT = 1
+PRIORITY_BATCH = 2
+PRIORITY_NAMES = {PRIORITY_CHAT: "chat", PRIORITY_REPORT: "report", PRIORITY_BATCH: "batch"}
+
+MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+MAX_PER_USER = int(os.getenv("LLM_MAX_PER_USER", "2"))
+MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "100"))
+MAX_QUEUED_PER_USER = int(os.getenv("LLM_MAX_QUEUED_PER_USER", "3"))
+QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "60"))
+REPORT_MAX_WAIT = float(os.getenv("LLM_REPORT_MAX_WAIT", "30"))
+
+# 排队时间样本保留的条数（算分位数用）
+WAIT_SAMPLES = 1000
+
+
+class SchedulerBusy(Exception):
+    """排队的人太多（或等太久），这次请求被拒绝"""
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+class Ticket:
+    """一次 LLM 调用的号：先排队，轮到后才能调用，用完（或放弃）必须 release()"""
+
+    def __init__(self, scheduler, user, priority):
+        self.user = user
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.granted_at = None
+        self._scheduler = scheduler
+        self._granted = asyncio.get_running_loop().create_future()
+        self._released = False
+
+    @property
+    def granted(self):
+        return self.granted_at is not None
+
+    def position(self):
+        """前面还有几个号在排队"""
+        return self._scheduler._position(self)
+
+    async def wait(self, timeout=None):
+        """等到轮到自己；超时返回 False（仍在排队）"""
+        if self.granted:
+            return True
+        try:
+            await asyncio.wait_for(asyncio.shield(self._granted), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def queued(self, interval=2.0, timeout=QUEUE_TIMEOUT):
+        """
+        排队期间每隔 interval 秒产出一次当前位置（给前端显示 “请稍等”），轮到后结束；
+        等待超过 timeout 秒抛出 SchedulerBusy（timeout=None 一直等）
+        """
+        while not self.granted:
+            yield self.position()
+            if timeout is not None and time.monotonic() - self.enqueued_at >= timeout:
+                self._scheduler._count(self.priority, "timed_out")
+                raise SchedulerBusy("queue wait timed out")
+            await self.wait(interval)
+
+    def release(self):
+        """用完归还；还没轮到时就是取消排队（可重复调用）"""
+        if not self._released:
+            self._released = True
+            self._scheduler._release(self)
+
+
+class LLMScheduler:
+    """
+    用法：
+        ticket = scheduler.enqueue(username, PRIORITY_CHAT)   # 满了抛 SchedulerBusy
+        try:
+            async for position in ticket.queued():
+                ...  # 提示 “前面还有 position 位”
+            ...      # 调用模型
+        finally:
+            ticket.release()
+    只在事件循环线程里使用（不加锁）；工作线程里的后台任务用 run_in_thread()
+    """
+
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, max_per_user=MAX_PER_USER,
+                 max_queue=MAX_QUEUE, max_queued_per_user=MAX_QUEUED_PER_USER,
+                 report_max_wait=REPORT_MAX_WAIT):
+        self.max_concurrency = max_concurrency
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+        self.max_queued_per_user = max_queued_per_user
+        self.report_max_wait = report_max_wait
+
+        # 每个优先级：用户 -> 这个用户排队中的号（OrderedDict 的顺序就是轮转顺序）
+        self._queues = {priority: OrderedDict() for priority in PRIORITY_NAMES}
+        self._waiting = 0
+        self._active = 0
+        self._active_per_user = {}
+        self._counters = {
+            priority: {"admitted": 0, "rejected": 0, "cancelled": 0, "timed_out": 0}
+            for priority in PRIORITY_NAMES
+        }
+        self._wait_samples = {priority: deque(maxlen=WAIT_SAMPLES) for priority in PRIORITY_NAMES}
+        self._wait_max = {priority: 0.0 for priority in PRIORITY_NAMES}
+        self._loop = None   # 领号用的事件循环（run_in_thread 要回到这里排队）
+
+    def enqueue(self, user, priority=PRIORITY_CHAT):
+        """领号（有空位时直接放行）；排队已满抛出 SchedulerBusy"""
+        self._loop = asyncio.get_running_loop()
+        user = user or ""
+        user_queue = self._queues[priority].get(user)
+        if self._waiting >= self.max_queue or (user_queue and len(user_queue) >= self.max_queued_per_user):
+            self._count(priority, "rejected")
+            raise SchedulerBusy("too many queued requests")
+
+        ticket = Ticket(self, user, priority)
+        self._queues[priority].setdefault(user, deque()).append(ticket)
+        self._waiting += 1
+        self._dispatch()
+        return ticket
+
+    def run_in_thread(self, user, fn, priority=PRIORITY_BATCH, timeout=QUEUE_TIMEOUT):
+        """
+        在工作线程里排队调用 fn()（后台任务用，比如摘要），返回 fn() 的结果：
+        回到事件循环领号，轮到后在当前线程调用，用完归还，和聊天、周报共用同一个并发上限
+        - 排队已满或等待超过 timeout 秒抛出 SchedulerBusy
+        - 还没在事件循环里领过号（没有聊天、周报在跑）时直接调用
+        - 不能在事件循环线程里调用（会一直等自己）
+        """
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return fn()
+        future = asyncio.run_coroutine_threadsafe(self._admit(user, priority), loop)
+        try:
+            ticket = future.result(timeout)
+        except FutureTimeoutError:
+            if future.cancel():
+                # 取消排队（_admit 里归还号）
+                raise SchedulerBusy("queue wait timed out")
+            # 刚好轮到：照常调用
+            ticket = future.result()
+        try:
+            return fn()
+        finally:
+            loop.call_soon_threadsafe(ticket.release)
+
+    async def _admit(self, user, priority):
+        ticket = self.enqueue(user, priority)
+        try:
+            await ticket.wait()
+        except BaseException:
+            ticket.release()
+            raise
+        return ticket
+
+    def waiting(self, priorities=None):
+        """排队中的号数（priorities 指定只数哪些优先级）"""
+        if priorities is None:
+            return self._waiting
+        return sum(len(q) for priority in priorities for q in self._queues[priority].values())
+
+    def stats(self):
+        stats = {
+            "active": self._active,
+            "waiting": self._waiting,
+            "max_concurrency": self.max_concurrency,
+        }
+        for priority, name in PRIORITY_NAMES.items():
+            samples = sorted(self._wait_samples[priority])
+            stats[name] = dict(
+                self._counters[priority],
+                waiting=sum(len(q) for q in self._queues[priority].values()),
+                wait_avg=sum(samples) / len(samples) if samples else 0.0,
+                wait_p50=_percentile(samples, 0.5),
+                wait_p95=_percentile(samples, 0.95),
+                wait_max=self._wait_max[priority],
+            )
+        return stats
+
+    def _count(self, priority, counter):
+        self._counters[priority][counter] += 1
+
+    def _priority_order(self, now):
+        """平时聊天优先；周报排队太久时先放行周报；批量任务总是最后"""
+        for user_queue in self._queues[PRIORITY_REPORT].values():
+            if now - user_queue[0].enqueued_at >= self.report_max_wait:
+                return [PRIORITY_REPORT, PRIORITY_CHAT, PRIORITY_BATCH]
+        return [PRIORITY_CHAT, PRIORITY_REPORT, PRIORITY_BATCH]
+
+    def _next_ticket(self, now):
+        for priority in self._priority_order(now):
+            queues = self._queues[priority]
+            for user in list(queues):
+                if self._active_per_user.get(user, 0) >= self.max_per_user:
+                    continue
+                user_queue = queues[user]
+                ticket = user_queue.popleft()
+                if user_queue:
+                    # 这个用户还有号：排到本优先级的队尾，轮到下一个用户
+                    queues.move_to_end(user)
+                else:
+                    del queues[user]
+                return ticket
+        return None
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self._active < self.max_concurrency:
+            ticket = self._next_ticket(now)
+            if ticket is None:
+                break
+            self._waiting -= 1
+            self._active += 1
+            self._active_per_user[ticket.user] = self._active_per_user.get(ticket.user, 0) + 1
+
+            ticket.granted_at = now
+            wait = now - ticket.enqueued_at
+            self._wait_samples[ticket.priority].append(wait)
+            self._wait_max[ticket.priority] = max(self._wait_max[ticket.priority], wait)
+            self._count(ticket.priority, "admitted")
+            if wait >= 1.0:
+                logger.info(f"LLM {PRIORITY_NAMES[ticket.priority]} call for {ticket.user} waited {wait:.1f}s in queue")
+            ticket._granted.set_result(True)
+
+    def _release(self, ticket):
+        if ticket.granted:
+            self._active -= 1
+            remaining = self._active_per_user[ticket.user] - 1
+            if remaining:
+                self._active_per_user[ticket.user] = remaining
+            else:
+                del self._active_per_user[ticket.user]
+        else:
+            queues = self._queues[ticket.priority]
+            user_queue = queues.get(ticket.user)
+            if user_queue is not None and ticket in user_queue:
+                user_queue.remove(ticket)
+                if not user_queue:
+                    del queues[ticket.user]
+                self._waiting -= 1
+                self._count(ticket.priority, "cancelled")
+        self._dispatch()
+
+    def _position(self, ticket):
+        if ticket.granted:
+            return 0
+        ahead = 0
+        for priority in self._priority_order(time.monotonic()):
+            for user_queue in self._queues[priority].values():
+                ahead += sum(1 for other in user_queue if other.enqueued_at < ticket.enqueued_at)
+            if priority == ticket.priority:
+                break
+        return ahead
@@ -0,0 +1,150 @@
+-- =====================
+-- Supabase 表结构
+-- =====================
+
+-- 用户信息
+create table if not exists users (
+    username      text primary key,
+    password      text not null default '',
+    child_profile jsonb not null default '{}'::jsonb
+);
+
+-- 聊天记录（blob 模式：整段 chat_history 存一行）
+create table if not exists chats (
+    username     text primary key references users(username) on delete cascade,
+    chat_history jsonb not null default '[]'::jsonb,
+    revision     integer not null default 0  -- 每次写入加一，保存时比较（compare-and-set）
+);
+
+-- 聊天记录（append 模式：每条消息一行，CHAT_STORAGE_MODE=append）
+create table if not exists chat_messages (
+    username   text not null references users(username) on delete cascade,
+    seq        integer not null,
+    msg_key    text,                        -- 去重键：同一条消息重复保存时相同（旧数据为空）
+    role       text not null,
+    content    text not null,
+    metadata   jsonb not null default '{}'::jsonb,
+    tags       jsonb,                       -- 写入时打上的关键词类别标签
+    tokens     integer,                     -- 写入时估算的 token 数
+    ts         double precision,            -- 消息发出的时间（epoch 秒），周报按它取最近 7 天
+    created_at timestamptz not null default now(),
+    primary key (username, seq)
+);
+
+create index if not exists chat_messages_username_created_at_idx
+    on chat_messages (username, created_at);
+
+-- 周报缓存（watermark 是生成周报时用到的聊天记录的哈希）
+create table if not exists weekly_reports (
+    username   text primary key references users(username) on delete cascade,
+    watermark  text not null,
+    report     text not null,
+    created_at timestamptz not null default now()
+);
+
+-- 上传导入的聊天记录（和 AI 的聊天记录分开存，每次上传整份替换）
+create table if not exists chat_log_messages (
+    username text not null references users(username) on delete cascade,
+    seq      integer not null,
+    speaker  text not null,              -- 导出文件里的说话人名字
+    content  text not null,
+    ts       double precision,           -- 导出文件里的时间（epoch 秒），没有时为空
+    primary key (username, seq)
+);
+
+-- 已有数据库升级
+alter table chat_messages add column if not exists tags jsonb;
+alter table chat_messages add column if not exists tokens integer;
+alter table chat_messages add column if not exists ts double precision;
+alter table chat_messages add column if not exists msg_key text;
+alter table chats add column if not exists revision integer not null default 0;
+
+create index if not exists chat_messages_username_ts_idx
+    on chat_messages (username, ts);
+
+create unique index if not exists chat_messages_username_msg_key_idx
+    on chat_messages (username, msg_key);
+
+-- =====================
+-- 一次调用写入一个用户的改动（SupabaseStore.save_user：每次保存只要一次往返）
+-- =====================
+-- - 用户不存在时创建；p_child_profile 不为空时更新用户信息，p_password 为空时保留原密码
+-- - p_messages：append 模式要追加的消息行 [{msg_key, role, content, metadata, tags, tokens, ts}, ...]
+--   seq 在这里接着这个用户最大的 seq 分配，msg_key 已经存在的消息跳过（只追加，不覆盖）；
+--   先锁住 users 里这个用户的行，同一用户的并发保存排队执行，不会分到同一个 seq
+-- - p_chat_history：blob 模式的整段聊天记录，p_revision 是读到它时的版本号
+--   版本号一致（或还没有记录）时写入并返回新版本号；不一致（别人先写过了）时不写，返回 null
+-- 其他情况返回 0
+drop function if exists save_user_data(text, text, jsonb, jsonb, jsonb);
+
+create or replace function save_user_data(
+    p_username      text,
+    p_password      text default null,
+    p_child_profile jsonb default null,
+    p_messages      jsonb default null,
+    p_chat_history  jsonb default null,
+    p_revision      integer default null
+) returns integer
+language plpgsql
+as $$
+declare
+    v_last_seq integer;
+    v_revision integer;
+begin
+    if p_child_profile is null then
+        insert into users (username) values (p_username)
+        on conflict (username) do nothing;
+    else
+        insert into users (username, password, child_profile)
+        values (p_username, coalesce(p_password, ''), p_child_profile)
+        on conflict (username) do update set
+            password = coalesce(p_password, users.password),
+            child_profile = excluded.child_profile;
+    end if;
+
+    if p_messages is not null then
+        perform 1 from users where username = p_username for update;
+        select coalesce(max(seq), 0) into v_last_seq from chat_messages where username = p_username;
+
+        insert into chat_messages (username, seq, msg_key, role, content, metadata, tags, tokens, ts)
+        select p_username, v_last_seq + row_number() over (order by m.ord),
+               m.value->>'msg_key', m.value->>'role', m.value->>'content',
+               coalesce(nullif(m.value->'metadata', 'null'::jsonb), '{}'::jsonb),
+               nullif(m.value->'tags', 'null'::jsonb),
+               (m.value->>'tokens')::integer, (m.value->>'ts')::double precision
+        from jsonb_array_elements(p_messages) with ordinality as m(value, ord)
+        where not exists (
+            select 1 from chat_messages c where c.username = p_username and c.msg_key = m.value->>'msg_key'
+        );
+    end if;
+
+    if p_chat_history is not null then
+        select revision into v_revision from chats where username = p_username for update;
+        if not found then
+            insert into chats (username, chat_history, revision) values (p_username, p_chat_history, 1);
+            return 1;
+        end if;
+        if p_revision is null or p_revision <> v_revision then
+            return null;
+        end if;
+        update chats set chat_history = p_chat_history, revision = v_revision + 1
+        where username = p_username;
+        return v_revision + 1;
+    end if;
+
+    return 0;
+end;
+$$;
+
+-- =====================
+-- 只更新 child_profile 里的几个字段（SupabaseStore.update_profile_fields：记忆、摘要等后台任务用）
+-- =====================
+-- 在库里当前的 child_profile 上合并，同时保存的设置不会被后台任务手里的旧快照覆盖
+create or replace function update_profile_fields(
+    p_username text,
+    p_fields   jsonb
+) returns void
+language sql
+as $$
+    update users set child_profile = child_profile || p_fields where username = p_username;
+$$;
@@ -0,0 +1,1109 @@
+import copy
+import hashlib
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from cache import CachedStore, TTLCache, merge_histories
+from metrics import TimedStore
+from prompting import count_message_tokens, message_tokens
+
+logger = logging.getLogger(__name__)
+
+# 导入聊天记录时每批写入的行数
+CHAT_LOG_BATCH = 500
+# 每个用户在内存里记住多少条已经写过的消息（同一会话再次保存时不重复发送）
+WRITTEN_KEYS_PER_USER = 1000
+# 整段存储时版本号冲突的最多重试次数
+BLOB_SAVE_RETRIES = int(os.getenv("BLOB_SAVE_RETRIES", "5"))
+# 整段存储时记住最近多少个用户的版本号和内容
+BLOB_STATE_USERS = 200
+
+# =====================
+# 存储后端
+# =====================
+# 所有后端对外提供同样的接口，app.py 只通过 store 读写数据：
+# - SupabaseStore：远程 Supabase（支持 blob / append 两种聊天记录存储方式）
+# - SQLiteStore：本地嵌入式数据库，小规模部署不需要网络往返
+# - MemoryStore：进程内存，用于测试和压测
+# 通过环境变量 STORAGE_BACKEND 选择，见 create_store()
+#
+# 远程后端每次调用都是一次网络往返，所以接口按用途设计：
+# - 每个接口只查需要的列，不用 select("*")
+# - 登录（load_user）、看周报（load_report_inputs）各用一次查询读出要用的全部数据
+# - 保存（save_user）一次写入用户信息和新消息，用户不存在时顺便创建
+# 这样每个页面操作最多一次读、一次写（往返次数见 metrics.STORAGE_ROUND_TRIPS）
+#
+# 多个进程 / 多个标签页可能同时保存同一个用户的聊天记录（各自的会话里只有自己这边的新消息）：
+# - 按消息存储时只追加：新消息的 seq 由后端在写入时接着库里最大的 seq 分配，谁也不会覆盖谁；
+#   每条消息带去重键 msg_key，重复保存（重试、WAL 回放）不会写出重复行
+# - 整段存储时 chats 表带版本号 revision：写入时比较版本号（compare-and-set），
+#   对不上说明别人先保存了，读出最新的记录合并后重试
+
+
+class WriteConflict(Exception):
+    """别的进程一直在同时写入同一条记录，重试几次后仍然没有写成功"""
+
+
+def message_seqs(chat_history):
+    """
+    计算每条消息的 seq（只在会话里用，比如 Chatbot 分页的位置）
+    - 从数据库读出来的消息带有 seq，直接用
+    - 还没保存的新消息从前面最大的 seq 往后依次编号
+      （保存时由后端接着库里最大的 seq 分配，别的进程 / 标签页同时写入过时两边的编号会不同，
+      所以检索索引、摘要水位、按 seq 读消息这些要跨会话对得上的地方只用消息自带的 seq）
+    """
+    last_seq = max((msg["seq"] for msg in chat_history if "seq" in msg), default=0)
+    seqs = []
+    for msg in chat_history:
+        if "seq" in msg:
+            seqs.append(msg["seq"])
+        else:
+            last_seq += 1
+            seqs.append(last_seq)
+    return seqs
+
+
+def message_key(msg, seq=None):
+    """
+    消息的去重键：同一条消息不管保存几次（同一会话多次保存、写入失败重试、WAL 回放）都相同
+    按角色、发出时间和内容计算；没有时间的旧消息再加上它在会话里的 seq
+    """
+    ts = msg.get("ts")
+    stamp = repr(ts) if ts is not None else f"#{seq}"
+    raw = f"{msg['role']}\x00{stamp}\x00{msg['content']}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:24]
+
+
+def messages_since(chat_history, since, limit=None):
+    """
+    从按 seq 排好的聊天记录里取 ts >= since（epoch 秒）的消息；limit=N 时只取其中最近 N 条
+    - 没有 ts 的旧消息不知道是什么时候发的，不算在内
+    """
+    recent = [msg for msg in chat_history if msg.get("ts") is not None and msg["ts"] >= since]
+    if limit is not None:
+        recent = recent[-limit:] if limit > 0 else []
+    return recent
+
+
+class HistoryStore:
+    """存储后端接口"""
+
+    # 聊天记录是否每条消息一行：是的话可以只读最近一段、按 seq 往前翻页，
+    # 保存时也只写新消息；否则每次保存都重写整段，会话里必须拿着完整记录
+    supports_paging = True
+
+    def __init__(self):
+        # 每个用户最近写入过的消息去重键（避免同一会话里重复发送旧消息）
+        self._written_keys = {}
+
+    def load_profile(self, username):
+        """读取 child_profile（带上密码）；用户不存在时返回 None"""
+        raise NotImplementedError
+
+    def load_user(self, username, limit=None):
+        """
+        登录用：一起读出用户信息和最近 limit 条聊天记录（limit=None 时全部）
+        返回 (child_profile, chat_history)；用户不存在时返回 (None, [])
+        默认实现分两次读，远程后端用一次查询
+        """
+        child_profile = self.load_profile(username)
+        if child_profile is None:
+            return None, []
+        return child_profile, self.load_messages(username, limit)
+
+    def load_report_inputs(self, username, since, limit, recent_limit=0):
+        """
+        看周报用：一起读出用户信息、ts >= since 的最近 limit 条聊天记录、
+        不管时间的最近 recent_limit 条（旧数据没有 ts 时用）和上次生成的周报
+        返回 (child_profile, chat_history, recent, report)；用户不存在时返回 (None, [], [], None)
+        默认实现分几次读，远程后端用一次查询
+        """
+        child_profile = self.load_profile(username)
+        if child_profile is None:
+            return None, [], [], None
+        recent = self.load_messages(username, recent_limit) if recent_limit > 0 else []
+        return child_profile, self.load_messages_since(username, since, limit), recent, self.load_report(username)
+
+    def load_messages(self, username, limit=None):
+        """按 seq 顺序读取聊天记录；limit=N 时只读取最近 N 条"""
+        raise NotImplementedError
+
+    def load_messages_since(self, username, since, limit=None):
+        """
+        按 seq 顺序读取 ts >= since（epoch 秒）的聊天记录；limit=N 时只取其中最近 N 条
+        默认实现读出全部再过滤，按消息存储的后端用 (username, ts) 索引做范围查询
+        """
+        return messages_since(self.load_messages(username), since, limit)
+
+    def load_messages_before(self, username, before_seq, limit):
+        """
+        按 seq 顺序读取 seq < before_seq 的最近 limit 条（往前翻页，按 seq 做游标）
+        默认实现读出全部再截取（整段存储时 seq 就是消息的位置，和 message_seqs 一致）
+        """
+        chat_history = self.load_messages(username)
+        end = sum(1 for seq in message_seqs(chat_history) if seq < before_seq)
+        return chat_history[max(end - limit, 0):end]
+
+    def load_messages_by_seq(self, username, seqs):
+        """
+        按 seq 顺序读取指定 seq 的消息（检索到的旧对话用，不存在的 seq 跳过）
+        默认实现读出全部再挑出来
+        """
+        wanted = set(seqs)
+        chat_history = self.load_messages(username)
+        return [msg for msg, seq in zip(chat_history, message_seqs(chat_history)) if seq in wanted]
+
+    def ensure_user(self, username):
+        """确保用户存在（不存在就创建一个空用户）"""
+        raise NotImplementedError
+
+    def save_messages(self, username, chat_history):
+        """
+        保存聊天记录（只写入还没保存过的消息）
+        别的进程 / 标签页同时写入时合并，不覆盖已经保存的消息
+        """
+        raise NotImplementedError
+
+    def save_profile(self, username, child_profile):
+        """保存用户信息；child_profile 里没有密码时保留原密码"""
+        raise NotImplementedError
+
+    def update_profile_fields(self, username, fields):
+        """
+        只更新 child_profile 里给出的几个字段（后台任务用，比如记忆、摘要）：
+        在库里当前的用户信息上改，同时保存的设置不会被后台任务手里的旧快照覆盖；用户不存在时什么都不做
+        默认实现先读再写，其他后端在数据库里一次改完
+        """
+        child_profile = self.load_profile(username)
+        if child_profile is None:
+            return
+        child_profile.update(fields)
+        self.save_profile(username, child_profile)
+
+    def save_user(self, username, chat_history=None, child_profile=None):
+        """
+        保存一个用户的改动：用户不存在时先创建
+        - child_profile 不为 None 时更新用户信息（没有密码时保留原密码）
+        - chat_history 里有还没保存过的消息时写入
+        默认实现分几次写，远程后端用一次调用
+        """
+        if child_profile is not None:
+            self.save_profile(username, child_profile)
+        else:
+            self.ensure_user(username)
+        if chat_history:
+            self.save_messages(username, chat_history)
+
+    def load_report(self, username):
+        """读取上次生成的周报 {"watermark": ..., "report": ...}；没有时返回 None"""
+        raise NotImplementedError
+
+    def save_report(self, username, watermark, report):
+        """保存周报和生成它时的聊天记录水位"""
+        raise NotImplementedError
+
+    def list_users(self, after=None, limit=200):
+        """按用户名顺序分页列出用户名：返回排在 after 之后的最多 limit 个"""
+        raise NotImplementedError
+
+    def save_chat_log(self, username, messages):
+        """
+        用上传的聊天记录替换这个用户之前导入的（和聊天记录分开存）
+        messages 是可迭代的 {"speaker", "content", "ts"}，边读边分批写入，返回写入的条数
+        """
+        raise NotImplementedError
+
+    def load_chat_log(self, username, limit=None):
+        """按顺序读取导入的聊天记录；limit=N 时只读取最后 N 条"""
+        raise NotImplementedError
+
+    def warm_up(self):
+        """启动预热：提前建好客户端和连接（本地后端不需要）"""
+
+    def invalidate_user(self, username):
+        """丢掉这个用户的进程内缓存（见 cache.CachedStore；后端本身没有缓存，不用做什么）"""
+
+    # ---------- 公共工具 ----------
+
+    def _new_rows(self, username, chat_history):
+        """
+        计算需要追加写入的消息行（会话里还没有 seq 的消息）
+        - 行里不带 seq：由后端写入时接着库里最大的 seq 编号，多个进程同时写入也不会撞号
+        - 每行带去重键 msg_key，同一条消息重复写入时后端跳过，不会产生重复行
+        - 本进程已经写过的消息不再发送
+        - 不修改传进来的消息（后台线程写入时，会话里的同一批消息可能正在被序列化）
+        """
+        written = self._written_keys.get(username, {})
+        rows = []
+        for msg, seq in zip(chat_history, message_seqs(chat_history)):
+            if "seq" in msg:
+                continue
+            key = message_key(msg, seq)
+            if key in written:
+                continue
+            rows.append({
+                "username": username,
+                "msg_key": key,
+                "role": msg["role"],
+                "content": msg["content"],
+                "metadata": msg.get("metadata", {}),
+                "tags": msg.get("tags"),
+                "tokens": message_tokens(msg),
+                "ts": msg.get("ts")
+            })
+        return rows
+
+    @staticmethod
+    def _chat_log_batches(username, messages):
+        """导入的消息按 CHAT_LOG_BATCH 条一批编号成行（seq 从 1 开始）"""
+        messages = iter(messages)
+        seq = 0
+        while True:
+            batch = []
+            for msg in itertools.islice(messages, CHAT_LOG_BATCH):
+                seq += 1
+                batch.append({
+                    "username": username,
+                    "seq": seq,
+                    "speaker": msg["speaker"],
+                    "content": msg["content"],
+                    "ts": msg.get("ts")
+                })
+            if not batch:
+                return
+            yield batch
+
+    def _mark_written(self, username, rows):
+        """记下写入成功的消息（每个用户只记最近 WRITTEN_KEYS_PER_USER 条）"""
+        if not rows:
+            return
+        written = self._written_keys.setdefault(username, OrderedDict())
+        for row in rows:
+            written[row["msg_key"]] = None
+        while len(written) > WRITTEN_KEYS_PER_USER:
+            written.popitem(last=False)
+
+    @staticmethod
+    def _profile_from_row(row):
+        """users 表的一行 -> child_profile（密码单独存了一列，child_profile 里没有时补上）"""
+        child_profile = row.get("child_profile") or {}
+        if isinstance(child_profile, str):
+            child_profile = json.loads(child_profile or "{}")
+        if row.get("password") and not child_profile.get("password"):
+            child_profile["password"] = row["password"]
+        return child_profile
+
+    @staticmethod
+    def _row_to_message(row):
+        message = {
+            "seq": row["seq"],
+            "role": row["role"],
+            "content": row["content"]
+        }
+        if row.get("metadata"):
+            message["metadata"] = row["metadata"]
+        if row.get("tags") is not None:
+            message["tags"] = row["tags"]
+        if row.get("ts") is not None:
+            message["ts"] = row["ts"]
+        # 旧数据没有 token 数时读出来就算好，之后不用每轮重算
+        message["tokens"] = row.get("tokens") or message_tokens(message)
+        return message
+
+
+# =====================
+# Supabase
+# =====================
+# chat_messages 读出来的列
+MESSAGE_COLUMNS = "seq, role, content, metadata, tags, tokens, ts"
+# users 读出来的列
+USER_COLUMNS = "password, child_profile"
+
+
+def _embedded_one(value):
+    """一对一嵌套查询的结果：不同版本的 PostgREST 返回对象或只有一个元素的列表"""
+    if isinstance(value, list):
+        return value[0] if value else None
+    return value
+
+
+class SupabaseStore(HistoryStore):
+    def __init__(self, client=None, mode="blob", client_factory=None):
+        """
+        client / client_factory：Supabase 客户端，或者第一次用到时才调用的创建函数
+        （supabase 包导入和建客户端都比较慢，推迟到启动预热或第一次访问时）
+        mode：
+        - blob：整段 chat_history 存在 chats 表的一行里（旧方式，每轮重写全部）
+        - append：每条消息单独一行存在 chat_messages 表（每轮只追加新消息）
+        """
+        super().__init__()
+        self._client = client
+        self._client_factory = client_factory
+        self._client_lock = threading.Lock()
+        self.mode = mode
+        # 整段存储：每个用户最近一次读到 / 写入的 (revision, chat_history)，保存时拿来比较版本号
+        self._blob_state = OrderedDict()
+        self._blob_lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self._client_factory()
+        return self._client
+
+    @property
+    def supports_paging(self):
+        return self.mode == "append"
+
+    def warm_up(self):
+        # 建好客户端，再发一个最小的查询，把到 Supabase 的连接提前建好
+        self.client.table("users").select("username").limit(1).execute()
+
+    def load_profile(self, username):
+        user_res = (
+            self.client.table("users")
+            .select(USER_COLUMNS)
+            .eq("username", username)
+            .execute()
+        )
+        if not user_res.data or len(user_res.data) == 0:
+            return None
+        return self._profile_from_row(user_res.data[0])
+
+    def load_user(self, username, limit=None):
+        # 用户信息和聊天记录用一次嵌套查询读出（chat_messages / chats 通过外键关联到 users）
+        if self.mode == "append":
+            # chats 只取主键，用来判断有没有还没迁移的旧记录
+            query = (
+                self.client.table("users")
+                .select(f"{USER_COLUMNS}, chat_messages({MESSAGE_COLUMNS}), chats(username)")
+                .eq("username", username)
+                .order("seq", desc=True, foreign_table="chat_messages")
+            )
+            if limit is not None:
+                query = query.limit(limit, foreign_table="chat_messages")
+        else:
+            query = (
+                self.client.table("users")
+                .select(f"{USER_COLUMNS}, chats(chat_history, revision)")
+                .eq("username", username)
+            )
+        res = query.execute()
+        if not res.data:
+            return None, []
+
+        row = res.data[0]
+        child_profile = self._profile_from_row(row)
+        if self.mode == "append":
+            if row.get("chat_messages") or not _embedded_one(row.get("chats")):
+                return child_profile, [self._row_to_message(msg) for msg in reversed(row.get("chat_messages") or [])]
+            # 还没迁移的旧用户：再读一次 chats 表（下次保存时会自动迁移，之后就不用了）
+            chat_history = self._load_chat_blob(username)
+        else:
+            chat_history = self._blob_messages(username, _embedded_one(row.get("chats")))
+        return child_profile, chat_history[-limit:] if limit is not None else chat_history
+
+    def load_report_inputs(self, username, since, limit, recent_limit=0):
+        # 用户信息、时间范围内的消息、最近几条消息、上次的周报用一次嵌套查询读出
+        # （同一张 chat_messages 嵌套两次，第二次用别名 recent，各自排序和限制条数；
+        # recent 至少取一条，和 chats 的主键一起用来判断有没有还没迁移的旧记录，同 load_user）
+        if self.mode == "append":
+            query = (
+                self.client.table("users")
+                .select(
+                    f"{USER_COLUMNS}, weekly_reports(watermark, report), chat_messages({MESSAGE_COLUMNS}), "
+                    f"recent:chat_messages({MESSAGE_COLUMNS}), chats(username)"
+                )
+                .eq("username", username)
+                .gte("chat_messages.ts", since)
+                .order("seq", desc=True, foreign_table="chat_messages")
+                .limit(limit, foreign_table="chat_messages")
+                .order("seq", desc=True, foreign_table="recent")
+                .limit(max(recent_limit, 1), foreign_table="recent")
+            )
+        else:
+            query = (
+                self.client.table("users")
+                .select(f"{USER_COLUMNS}, weekly_reports(watermark, report), chats(chat_history, revision)")
+                .eq("username", username)
+            )
+        res = query.execute()
+        if not res.data:
+            return None, [], [], None
+
+        row = res.data[0]
+        if self.mode == "append" and (row.get("recent") or not _embedded_one(row.get("chats"))):
+            chat_history = [self._row_to_message(msg) for msg in reversed(row.get("chat_messages") or [])]
+            recent = [self._row_to_message(msg) for msg in reversed(row.get("recent") or [])]
+            recent = recent[-recent_limit:] if recent_limit > 0 else []
+        else:
+            if self.mode == "append":
+                # 还没迁移的旧用户：再读一次 chats 表（下次保存时会自动迁移，之后就不用了）
+                blob = self._load_chat_blob(username)
+            else:
+                blob = self._blob_messages(username, _embedded_one(row.get("chats")))
+            chat_history = messages_since(blob, since, limit)
+            recent = blob[-recent_limit:] if recent_limit > 0 else []
+        return self._profile_from_row(row), chat_history, recent, _embedded_one(row.get("weekly_reports"))
+
+    def load_messages(self, username, limit=None):
+        if self.mode != "append":
+            chat_history = self._load_chat_blob(username)
+            return chat_history[-limit:] if limit is not None else chat_history
+
+        query = (
+            self.client.table("chat_messages")
+            .select(MESSAGE_COLUMNS)
+            .eq("username", username)
+            .order("seq", desc=True)
+        )
+        if limit is not None:
+            query = query.limit(limit)
+        res = query.execute()
+
+        # 表里还没有这个用户的消息：回退读取旧的 chats 记录（下次保存时会自动迁移）
+        if not res.data:
+            chat_history = self._load_chat_blob(username)
+            return chat_history[-limit:] if limit is not None else chat_history
+
+        return [self._row_to_message(row) for row in reversed(res.data)]
+
+    def load_messages_since(self, username, since, limit=None):
+        if self.mode != "append":
+            return super().load_messages_since(username, since, limit)
+
+        query = (
+            self.client.table("chat_messages")
+            .select(MESSAGE_COLUMNS)
+            .eq("username", username)
+            .gte("ts", since)
+            .order("seq", desc=True)
+        )
+        if limit is not None:
+            query = query.limit(limit)
+        # 还没迁移的旧 chats 记录里的消息没有 ts，这里查不到（调用方自己决定怎么退回）
+        return [self._row_to_message(row) for row in reversed(query.execute().data or [])]
+
+    def load_messages_before(self, username, before_seq, limit):
+        if self.mode != "append":
+            return super().load_messages_before(username, before_seq, limit)
+
+        res = (
+            self.client.table("chat_messages")
+            .select(MESSAGE_COLUMNS)
+            .eq("username", username)
+            .lt("seq", before_seq)
+            .order("seq", desc=True)
+            .limit(limit)
+            .execute()
+        )
+        return [self._row_to_message(row) for row in reversed(res.data or [])]
+
+    def load_messages_by_seq(self, username, seqs):
+        if self.mode != "append":
+            return super().load_messages_by_seq(username, seqs)
+        if not seqs:
+            return []
+
+        res = (
+            self.client.table("chat_messages")
+            .select(MESSAGE_COLUMNS)
+            .eq("username", username)
+            .in_("seq", sorted(set(seqs)))
+            .order("seq")
+            .execute()
+        )
+        return [self._row_to_message(row) for row in res.data or []]
+
+    def _load_chat_blob(self, username):
+        """从 chats 表读取整段聊天记录"""
+        chat_res = (
+            self.client.table("chats")
+            .select("chat_history, revision")
+            .eq("username", username)
+            .execute()
+        )
+        return self._blob_messages(username, chat_res.data[0] if chat_res.data else None)
+
+    def _blob_messages(self, username, row):
+        """
+        chats 表的一行 -> 聊天记录（旧数据没有 token 数时顺便算好）
+        顺便记下读到的版本号，保存时用来判断期间有没有别人写过
+        """
+        chat_history = (row or {}).get("chat_history", []) or []
+        for position, msg in enumerate(chat_history, 1):
+            if "tokens" not in msg:
+                count_message_tokens(msg)
+            if self.mode != "append":
+                # 整段记录只会在后面追加（比较版本号、合并后再写），位置不会变，当作 seq 用；
+                # 按行存储时读到的旧记录不编号，下次保存时由数据库分配 seq（迁移）
+                msg["seq"] = position
+        self._remember_blob(username, (row or {}).get("revision", 0), chat_history)
+        return chat_history
+
+    def _remember_blob(self, username, revision, chat_history):
+        with self._blob_lock:
+            self._blob_state[username] = (revision, chat_history)
+            self._blob_state.move_to_end(username)
+            while len(self._blob_state) > BLOB_STATE_USERS:
+                self._blob_state.popitem(last=False)
+
+    def ensure_user(self, username):
+        # 确保用户在 users 表中存在（避免外键约束错误）；已存在时什么都不改，一次往返
+        self.client.table("users").upsert(
+            {"username": username},
+            on_conflict="username",
+            ignore_duplicates=True
+        ).execute()
+
+    def save_messages(self, username, chat_history):
+        # 和 save_user 走同一个数据库函数：seq 在数据库里分配，整段存储时比较版本号
+        self.save_user(username, chat_history)
+
+    def save_profile(self, username, child_profile):
+        # 没有新密码时不写 password 列：upsert 只更新给出的列，原密码保留，不用先查一次
+        row = {"username": username, "child_profile": child_profile}
+        if child_profile.get("password"):
+            row["password"] = child_profile["password"]
+        res_user = self.client.table("users").upsert(row, on_conflict="username").execute()
+        logger.debug(f"Saved profile for {username} ({len(res_user.data or [])} rows)")
+
+    def update_profile_fields(self, username, fields):
+        # 数据库函数里用 child_profile || p_fields 合并（见 schema.sql），一次往返
+        self.client.rpc("update_profile_fields", {"p_username": username, "p_fields": fields}).execute()
+
+    def save_user(self, username, chat_history=None, child_profile=None):
+        # 用户信息和新消息由数据库函数 save_user_data 在一个事务里写入（见 schema.sql），一次往返
+        params = {
+            "p_username": username,
+            "p_password": (child_profile or {}).get("password") or None,
+            "p_child_profile": child_profile,
+            "p_messages": None,
+            "p_chat_history": None,
+            "p_revision": None
+        }
+        if self.mode == "append" or not chat_history:
+            # 新消息的 seq 在数据库里接着最大的 seq 分配，已经写过的（msg_key 相同）跳过
+            rows = self._new_rows(username, chat_history) if chat_history and self.mode == "append" else []
+            params["p_messages"] = [
+                {key: value for key, value in row.items() if key != "username"} for row in rows
+            ] or None
+            self.client.rpc("save_user_data", params).execute()
+            self._mark_written(username, rows)
+            return
+
+        with self._blob_lock:
+            revision, known = self._blob_state.get(username, (None, []))
+        # 本进程里别的会话（另一个标签页）刚保存过的消息也要保留
+        merged = merge_histories(known, chat_history)
+        for attempt in range(BLOB_SAVE_RETRIES):
+            # seq 是读出来时按位置编的，不存进记录里（以后换成按行存储时由数据库重新分配）
+            params["p_chat_history"] = [{key: value for key, value in msg.items() if key != "seq"} for msg in merged]
+            params["p_revision"] = revision
+            new_revision = self.client.rpc("save_user_data", params).execute().data
+            if new_revision is not None:
+                self._remember_blob(username, new_revision, merged)
+                logger.debug(f"Saved chat blob for {username} ({len(merged)} messages, revision {new_revision})")
+                return
+            # 版本号对不上：别的进程先保存了，读出最新的记录，把这次的新消息接在后面再写
+            logger.info(f"Chat blob for {username} changed since revision {revision}, merging (attempt {attempt + 1})")
+            merged = merge_histories(self._load_chat_blob(username), chat_history)
+            with self._blob_lock:
+                revision = self._blob_state.get(username, (None, []))[0]
+        raise WriteConflict(f"Chat blob for {username} kept changing, gave up after {BLOB_SAVE_RETRIES} attempts")
+
+    def load_report(self, username):
+        res = (
+            self.client.table("weekly_reports")
+            .select("watermark, report")
+            .eq("username", username)
+            .execute()
+        )
+        return res.data[0] if res.data else None
+
+    def save_report(self, username, watermark, report):
+        self.client.table("weekly_reports").upsert(
+            {
+                "username": username,
+                "watermark": watermark,
+                "report": report
+            },
+            on_conflict="username"
+        ).execute()
+
+    def list_users(self, after=None, limit=200):
+        query = self.client.table("users").select("username").order("username").limit(limit)
+        if after is not None:
+            query = query.gt("username", after)
+        return [row["username"] for row in query.execute().data or []]
+
+    def save_chat_log(self, username, messages):
+        # 先删掉之前导入的，再分批插入（中途失败时下次重新上传会整份替换）
+        self.client.table("chat_log_messages").delete().eq("username", username).execute()
+        count = 0
+        for batch in self._chat_log_batches(username, messages):
+            self.client.table("chat_log_messages").insert(batch).execute()
+            count += len(batch)
+        return count
+
+    def load_chat_log(self, username, limit=None):
+        query = (
+            self.client.table("chat_log_messages")
+            .select("seq, speaker, content, ts")
+            .eq("username", username)
+            .order("seq", desc=True)
+        )
+        if limit is not None:
+            query = query.limit(limit)
+        return list(reversed(query.execute().data or []))
+
+
+# =====================
+# SQLite（WAL 模式）
+# =====================
+SQLITE_SCHEMA = """
+create table if not exists users (
+    username      text primary key,
+    password      text not null default '',
+    child_profile text not null default '{}'
+);
+
+create table if not exists chat_messages (
+    username   text not null,
+    seq        integer not null,
+    msg_key    text,
+    role       text not null,
+    content    text not null,
+    metadata   text not null default '{}',
+    tags       text,
+    tokens     integer,
+    ts         real,
+    created_at text not null default (strftime('%Y-%m-%dT%H:%M:%fZ', 'now')),
+    primary key (username, seq)
+) without rowid;
+
+create index if not exists idx_chat_messages_user_created
+    on chat_messages (username, created_at);
+
+create table if not exists weekly_reports (
+    username   text primary key,
+    watermark  text not null,
+    report     text not null,
+    created_at text not null default (strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))
+);
+
+create table if not exists chat_log_messages (
+    username text not null,
+    seq      integer not null,
+    speaker  text not null,
+    content  text not null,
+    ts       real,
+    primary key (username, seq)
+) without rowid;
+"""
+
+
+# chat_messages 后来新增的列（老数据库启动时自动补上）
+SQLITE_MESSAGE_COLUMNS = {
+    "msg_key": "text",
+    "tags": "text",
+    "tokens": "integer",
+    "ts": "real",
+}
+
+
+class SQLiteStore(HistoryStore):
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        db_dir = os.path.dirname(path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        # 每个线程一个连接：WAL 模式下读不会被写阻塞
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._conn().executescript(SQLITE_SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        """给旧数据库补上后来新增的列（和依赖这些列的索引）"""
+        conn = self._conn()
+        columns = {row["name"] for row in conn.execute("pragma table_info(chat_messages)")}
+        with self._write_lock, conn:
+            for column, ddl in SQLITE_MESSAGE_COLUMNS.items():
+                if column not in columns:
+                    conn.execute(f"alter table chat_messages add column {column} {ddl}")
+            conn.execute(
+                "create index if not exists idx_chat_messages_user_ts on chat_messages (username, ts)"
+            )
+            # 旧消息的 msg_key 是空的，不受唯一约束影响
+            conn.execute(
+                "create unique index if not exists idx_chat_messages_user_key on chat_messages (username, msg_key)"
+            )
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("pragma journal_mode=wal")
+            conn.execute("pragma synchronous=normal")
+            self._local.conn = conn
+        return conn
+
+    def load_profile(self, username):
+        row = self._conn().execute(
+            "select password, child_profile from users where username = ?",
+            (username,)
+        ).fetchone()
+        if row is None:
+            return None
+        return self._profile_from_row(dict(row))
+
+    def load_messages(self, username, limit=None):
+        if limit is None:
+            rows = self._conn().execute(
+                "select seq, role, content, metadata, tags, tokens, ts from chat_messages "
+                "where username = ? order by seq",
+                (username,)
+            ).fetchall()
+        else:
+            rows = self._conn().execute(
+                "select * from ("
+                "  select seq, role, content, metadata, tags, tokens, ts from chat_messages "
+                "  where username = ? order by seq desc limit ?"
+                ") order by seq",
+                (username, limit)
+            ).fetchall()
+        return [self._row_to_message(self._decode(row)) for row in rows]
+
+    def load_messages_since(self, username, since, limit=None):
+        rows = self._conn().execute(
+            "select * from ("
+            "  select seq, role, content, metadata, tags, tokens, ts from chat_messages "
+            "  where username = ? and ts >= ? order by seq desc limit ?"
+            ") order by seq",
+            (username, since, -1 if limit is None else limit)
+        ).fetchall()
+        return [self._row_to_message(self._decode(row)) for row in rows]
+
+    def load_messages_before(self, username, before_seq, limit):
+        # 主键 (username, seq) 上的范围扫描，翻到多早都一样快
+        rows = self._conn().execute(
+            "select * from ("
+            "  select seq, role, content, metadata, tags, tokens, ts from chat_messages "
+            "  where username = ? and seq < ? order by seq desc limit ?"
+            ") order by seq",
+            (username, before_seq, limit)
+        ).fetchall()
+        return [self._row_to_message(self._decode(row)) for row in rows]
+
+    def load_messages_by_seq(self, username, seqs):
+        seqs = sorted(set(seqs))
+        if not seqs:
+            return []
+        rows = self._conn().execute(
+            "select seq, role, content, metadata, tags, tokens, ts from chat_messages "
+            f"where username = ? and seq in ({', '.join('?' * len(seqs))}) order by seq",
+            (username, *seqs)
+        ).fetchall()
+        return [self._row_to_message(self._decode(row)) for row in rows]
+
+    @staticmethod
+    def _decode(row):
+        row = dict(row)
+        row["metadata"] = json.loads(row["metadata"] or "{}")
+        row["tags"] = json.loads(row["tags"]) if row.get("tags") else None
+        return row
+
+    def ensure_user(self, username):
+        with self._write_lock, self._conn() as conn:
+            conn.execute(
+                "insert or ignore into users (username) values (?)",
+                (username,)
+            )
+
+    def save_messages(self, username, chat_history):
+        rows = self._new_rows(username, chat_history)
+        if not rows:
+            return
+        with self._write_lock, self._conn() as conn:
+            conn.execute("begin immediate")
+            self._insert_messages(conn, username, rows)
+        self._mark_written(username, rows)
+
+    @staticmethod
+    def _insert_messages(conn, username, rows):
+        """
+        接着库里最大的 seq 追加写入，已经写过的消息（msg_key 相同）跳过
+        调用方先用 begin immediate 拿到写锁：读最大 seq 和写入之间别的进程插不进来
+        """
+        existing = set()
+        keys = [row["msg_key"] for row in rows]
+        for start in range(0, len(keys), CHAT_LOG_BATCH):
+            chunk = keys[start:start + CHAT_LOG_BATCH]
+            existing.update(row[0] for row in conn.execute(
+                f"select msg_key from chat_messages where username = ? and msg_key in ({', '.join('?' * len(chunk))})",
+                (username, *chunk)
+            ))
+        rows = [row for row in rows if row["msg_key"] not in existing]
+        if not rows:
+            return
+        last_seq = conn.execute(
+            "select coalesce(max(seq), 0) from chat_messages where username = ?", (username,)
+        ).fetchone()[0]
+        conn.executemany(
+            "insert into chat_messages (username, seq, msg_key, role, content, metadata, tags, tokens, ts) "
+            "values (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (username, last_seq + i, row["msg_key"], row["role"], row["content"],
+                 json.dumps(row["metadata"], ensure_ascii=False),
+                 json.dumps(row["tags"], ensure_ascii=False) if row["tags"] is not None else None,
+                 row["tokens"], row["ts"])
+                for i, row in enumerate(rows, start=1)
+            ]
+        )
+
+    def save_profile(self, username, child_profile):
+        with self._write_lock, self._conn() as conn:
+            self._upsert_profile(conn, username, child_profile)
+
+    def update_profile_fields(self, username, fields):
+        if not fields:
+            return
+        # json_set 整个替换给出的字段，别的字段不动
+        paths = ", ".join("?, json(?)" for _ in fields)
+        params = []
+        for key, value in fields.items():
+            params += [f'$."{key}"', json.dumps(value, ensure_ascii=False)]
+        with self._write_lock, self._conn() as conn:
+            conn.execute(
+                f"update users set child_profile = json_set(child_profile, {paths}) where username = ?",
+                (*params, username)
+            )
+
+    def save_user(self, username, chat_history=None, child_profile=None):
+        # 用户信息和新消息在一个事务里写入
+        rows = self._new_rows(username, chat_history) if chat_history is not None else []
+        with self._write_lock, self._conn() as conn:
+            conn.execute("begin immediate")
+            if child_profile is not None:
+                self._upsert_profile(conn, username, child_profile)
+            else:
+                conn.execute("insert or ignore into users (username) values (?)", (username,))
+            if rows:
+                self._insert_messages(conn, username, rows)
+        self._mark_written(username, rows)
+
+    @staticmethod
+    def _upsert_profile(conn, username, child_profile):
+        # 没有新密码时保留原密码
+        conn.execute(
+            "insert into users (username, password, child_profile) values (?, ?, ?) "
+            "on conflict (username) do update set "
+            "  password = case when excluded.password = '' then users.password else excluded.password end, "
+            "  child_profile = excluded.child_profile",
+            (username, child_profile.get("password") or "", json.dumps(child_profile, ensure_ascii=False))
+        )
+
+    def load_report(self, username):
+        row = self._conn().execute(
+            "select watermark, report from weekly_reports where username = ?",
+            (username,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def save_report(self, username, watermark, report):
+        with self._write_lock, self._conn() as conn:
+            conn.execute(
+                "insert or replace into weekly_reports (username, watermark, report) values (?, ?, ?)",
+                (username, watermark, report)
+            )
+
+    def list_users(self, after=None, limit=200):
+        rows = self._conn().execute(
+            "select username from users where username > ? order by username limit ?",
+            (after if after is not None else "", limit)
+        ).fetchall()
+        return [row["username"] for row in rows]
+
+    def save_chat_log(self, username, messages):
+        # 每批一个短事务，解析文件的时候不占着写锁
+        with self._write_lock, self._conn() as conn:
+            conn.execute("delete from chat_log_messages where username = ?", (username,))
+        count = 0
+        for batch in self._chat_log_batches(username, messages):
+            with self._write_lock, self._conn() as conn:
+                conn.executemany(
+                    "insert or replace into chat_log_messages (username, seq, speaker, content, ts) "
+                    "values (:username, :seq, :speaker, :content, :ts)",
+                    batch
+                )
+            count += len(batch)
+        return count
+
+    def load_chat_log(self, username, limit=None):
+        rows = self._conn().execute(
+            "select * from ("
+            "  select seq, speaker, content, ts from chat_log_messages "
+            "  where username = ? order by seq desc limit ?"
+            ") order by seq",
+            (username, -1 if limit is None else limit)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+
+# =====================
+# 内存（测试 / 压测用）
+# =====================
+class MemoryStore(HistoryStore):
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._users = {}      # username -> {"password": ..., "child_profile": ...}
+        self._messages = {}   # username -> {seq: row}
+        self._message_keys = {}  # username -> 已经写入的 msg_key
+        self._reports = {}    # username -> {"watermark": ..., "report": ...}
+        self._chat_logs = {}  # username -> [row, ...]（导入的聊天记录）
+
+    def load_profile(self, username):
+        with self._lock:
+            user = self._users.get(username)
+            return self._profile_from_row(copy.deepcopy(user)) if user else None
+
+    def load_messages(self, username, limit=None):
+        with self._lock:
+            rows = [self._messages[username][seq] for seq in sorted(self._messages.get(username, {}))]
+            if limit is not None:
+                rows = rows[-limit:] if limit > 0 else []
+            return [self._row_to_message(copy.deepcopy(row)) for row in rows]
+
+    def load_messages_since(self, username, since, limit=None):
+        with self._lock:
+            rows = [self._messages[username][seq] for seq in sorted(self._messages.get(username, {}))]
+            rows = messages_since(rows, since, limit)
+            return [self._row_to_message(copy.deepcopy(row)) for row in rows]
+
+    def load_messages_before(self, username, before_seq, limit):
+        with self._lock:
+            seqs = sorted(seq for seq in self._messages.get(username, {}) if seq < before_seq)
+            rows = [self._messages[username][seq] for seq in seqs[-limit:]] if limit > 0 else []
+            return [self._row_to_message(copy.deepcopy(row)) for row in rows]
+
+    def load_messages_by_seq(self, username, seqs):
+        with self._lock:
+            messages = self._messages.get(username, {})
+            rows = [messages[seq] for seq in sorted(set(seqs)) if seq in messages]
+            return [self._row_to_message(copy.deepcopy(row)) for row in rows]
+
+    def ensure_user(self, username):
+        with self._lock:
+            self._users.setdefault(username, {"password": "", "child_profile": {}})
+
+    def save_messages(self, username, chat_history):
+        rows = self._new_rows(username, chat_history)
+        with self._lock:
+            messages = self._messages.setdefault(username, {})
+            keys = self._message_keys.setdefault(username, set())
+            last_seq = max(messages, default=0)
+            for row in rows:
+                if row["msg_key"] in keys:
+                    continue
+                last_seq += 1
+                keys.add(row["msg_key"])
+                messages[last_seq] = dict(copy.deepcopy(row), seq=last_seq)
+        self._mark_written(username, rows)
+
+    def update_profile_fields(self, username, fields):
+        with self._lock:
+            user = self._users.get(username)
+            if user is not None:
+                user["child_profile"].update(copy.deepcopy(fields))
+
+    def save_profile(self, username, child_profile):
+        with self._lock:
+            old = self._users.get(username, {})
+            self._users[username] = {
+                "password": child_profile.get("password") or old.get("password", ""),
+                "child_profile": copy.deepcopy(child_profile)
+            }
+
+    def load_report(self, username):
+        with self._lock:
+            report = self._reports.get(username)
+            return dict(report) if report else None
+
+    def save_report(self, username, watermark, report):
+        with self._lock:
+            self._reports[username] = {"watermark": watermark, "report": report}
+
+    def list_users(self, after=None, limit=200):
+        with self._lock:
+            usernames = sorted(name for name in self._users if after is None or name > after)
+        return usernames[:limit]
+
+    def save_chat_log(self, username, messages):
+        rows = [row for batch in self._chat_log_batches(username, messages) for row in batch]
+        with self._lock:
+            self._chat_logs[username] = rows
+        return len(rows)
+
+    def load_chat_log(self, username, limit=None):
+        with self._lock:
+            rows = self._chat_logs.get(username, [])
+            if limit is not None:
+                rows = rows[-limit:] if limit > 0 else []
+            return [{key: row[key] for key in ("seq", "speaker", "content", "ts")} for row in rows]
+
+
+# =====================
+# 按配置创建存储后端
+# =====================
+def create_store():
+    """
+    STORAGE_BACKEND：
+    - supabase：需要 SUPABASE_URL / SUPABASE_KEY（聊天记录存储方式见 CHAT_STORAGE_MODE）
+    - sqlite：本地文件 SQLITE_PATH（默认 histories/ai_kid.db）
+    - memory：进程内存，重启即丢失
+    默认：配置了 Supabase 就用 Supabase，否则用 SQLite
+
+    后端的每次调用都记录耗时（metrics.TimedStore，缓存命中不算在内）；
+    除内存后端外，外面再包一层进程内缓存（STORE_CACHE_MB=0 关闭，STORE_CACHE_TTL 为过期秒数，
+    STORE_CACHE_MISSING_TTL 为 “用户不存在” 的过期秒数）
+    """
+    backend = _create_backend()
+    store = TimedStore(backend)
+    cache_mb = float(os.getenv("STORE_CACHE_MB", "64"))
+    if cache_mb <= 0 or isinstance(backend, MemoryStore):
+        return store
+    cache = TTLCache(
+        max_bytes=int(cache_mb * 1024 * 1024),
+        ttl=float(os.getenv("STORE_CACHE_TTL", "300"))
+    )
+    return CachedStore(store, cache, missing_ttl=float(os.getenv("STORE_CACHE_MISSING_TTL", "5")))
+
+
+def _create_backend():
+    supabase_url = os.getenv("SUPABASE_URL")
+    supabase_key = os.getenv("SUPABASE_KEY")
+    backend = os.getenv("STORAGE_BACKEND") or ("supabase" if supabase_url and supabase_key else "sqlite")
+
+    if backend == "supabase":
+        if not (supabase_url and supabase_key):
+            raise RuntimeError("STORAGE_BACKEND=supabase requires SUPABASE_URL and SUPABASE_KEY")
+        def client_factory():
+            from supabase import create_client
+            return create_client(supabase_url, supabase_key)
+        return SupabaseStore(client_factory=client_factory, mode=os.getenv("CHAT_STORAGE_MODE", "blob"))
+    if backend == "sqlite":
+        return SQLiteStore(os.getenv("SQLITE_PATH", os.path.join("histories", "ai_kid.db")))
+    if backend == "memory":
+        return MemoryStore()
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
@@ -0,0 +1,154 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# =====================
+# 滚动分层摘要
+# =====================
+# 最近的消息原样放进 prompt；离开最近窗口的旧消息按块压缩成摘要，
+# 摘要块太多时再合并进一段长期摘要。摘要存在 child_profile["summary"]：
+# {
+#     "upto": 已经摘要到的最大 seq,
+#     "chunks": ["较早一段对话的摘要", ...],
+#     "long_term": "更早以前的长期摘要"
+# }
+# 每次只处理新离开窗口的那部分消息，prompt 大小不会随聊天记录增长
+
+RECENT_WINDOW = 15     # 原样保留的最近消息条数
+CHUNK_SIZE = 20        # 每凑够这么多条旧消息就压缩成一块摘要
+MAX_CHUNKS = 5         # 摘要块超过这个数量就把最老的合并进长期摘要
+
+CHUNK_PROMPT = """下面是妈妈和孩子之间的一段聊天记录。
+请用第三人称、简洁的中文总结这段对话里值得以后记住的内容：发生的事情、提到的人、身体和情绪状况、约定或计划。
+不要评价，不要编造，不超过 150 字。
+
+聊天记录：
+{conversation}
+"""
+
+LONG_TERM_PROMPT = """下面是妈妈和孩子过去聊天的长期摘要，以及之后几段对话的摘要。
+请把它们合并成一段新的长期摘要：保留重要的人和事、健康情况、情绪变化、习惯和约定，去掉重复和琐碎的内容。
+使用第三人称、简洁的中文，不超过 300 字。
+
+长期摘要：
+{long_term}
+
+之后的对话摘要：
+{chunks}
+"""
+
+
+def empty_summary():
+    return {"upto": 0, "chunks": [], "long_term": ""}
+
+
+def pending_messages(chat_history, summary, recent_window=RECENT_WINDOW):
+    """
+    已经离开最近窗口、但还没被摘要的消息（连同它们的 seq）
+    只取从数据库读出来、带 seq 的消息：摘要水位 upto 存在用户信息里，要和库里的 seq 对得上
+    """
+    upto = (summary or {}).get("upto", 0)
+    cutoff = max(0, len(chat_history) - recent_window)
+    return [
+        (msg["seq"], msg)
+        for msg in chat_history[:cutoff]
+        if msg.get("seq", 0) > upto
+    ]
+
+
+def format_conversation(messages, nickname):
+    lines = []
+    for msg in messages:
+        role = "妈妈" if msg["role"] == "user" else nickname
+        lines.append(f"{role}: {msg['content']}")
+    return "\n".join(lines)
+
+
+def update_summary(summary, chat_history, nickname, complete_fn,
+                   recent_window=RECENT_WINDOW, chunk_size=CHUNK_SIZE, max_chunks=MAX_CHUNKS):
+    """
+    把新离开窗口的消息压缩进摘要，返回新的摘要；没有需要处理的内容时返回 None
+    complete_fn(prompt) -> str：调用大模型生成摘要
+    """
+    summary = dict(summary or empty_summary())
+    summary["chunks"] = list(summary.get("chunks", []))
+    pending = pending_messages(chat_history, summary, recent_window)
+    if len(pending) < chunk_size:
+        return None
+
+    # 1️⃣ 新离开窗口的消息按块压缩（不足一块的留到下次）
+    while len(pending) >= chunk_size:
+        chunk, pending = pending[:chunk_size], pending[chunk_size:]
+        conversation = format_conversation([msg for _, msg in chunk], nickname)
+        summary["chunks"].append(complete_fn(CHUNK_PROMPT.format(conversation=conversation)).strip())
+        summary["upto"] = chunk[-1][0]
+
+    # 2️⃣ 摘要块太多时，最老的几块合并进长期摘要
+    if len(summary["chunks"]) > max_chunks:
+        fold = summary["chunks"][:-max_chunks]
+        summary["long_term"] = complete_fn(LONG_TERM_PROMPT.format(
+            long_term=summary.get("long_term") or "（暂无）",
+            chunks="\n".join(f"- {c}" for c in fold)
+        )).strip()
+        summary["chunks"] = summary["chunks"][-max_chunks:]
+
+    return summary
+
+
+def format_summary(summary):
+    """将摘要格式化为 prompt 里的文本"""
+    if not summary or not (summary.get("long_term") or summary.get("chunks")):
+        return "（暂无）"
+    parts = []
+    if summary.get("long_term"):
+        parts.append(summary["long_term"])
+    parts.extend(f"- {c}" for c in summary.get("chunks", []))
+    return "\n".join(parts)
+
+
+class SummaryWorker:
+    """后台更新摘要：不阻塞聊天回复，同一用户同时只跑一个任务"""
+
+    def __init__(self, complete_fn, on_update, max_workers=2):
+        """
+        complete_fn(username, prompt) -> str：调用大模型（在工作线程里调用，按用户排队）
+        on_update(username, fields)：摘要更新后回调，只保存 {"summary": ...} 这一个字段
+        （在库里最新的用户信息上改，摘要生成期间保存的设置、记忆不会被覆盖）
+        """
+        self._complete_fn = complete_fn
+        self._on_update = on_update
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summary")
+        self._lock = threading.Lock()
+        self._running = set()
+
+    def schedule(self, username, chat_history, child_profile):
+        """有足够多的新旧消息时才提交任务，否则什么也不做"""
+        summary = child_profile.get("summary")
+        if len(pending_messages(chat_history, summary)) < CHUNK_SIZE:
+            return False
+        with self._lock:
+            if username in self._running:
+                return False
+            self._running.add(username)
+        self._executor.submit(self._run, username, list(chat_history), child_profile)
+        return True
+
+    def _run(self, username, chat_history, child_profile):
+        try:
+            summary = update_summary(
+                child_profile.get("summary"),
+                chat_history,
+                child_profile.get("nickname", "孩子"),
+                lambda prompt: self._complete_fn(username, prompt)
+            )
+            if summary is not None:
+                child_profile["summary"] = summary
+                self._on_update(username, {"summary": summary})
+                logger.info(f"Summary updated for {username} up to seq {summary['upto']}")
+        except Exception as e:
+            logger.error(f"Summary update failed for {username}: {e}")
+        finally:
+            with self._lock:
+                self._running.discard(username)
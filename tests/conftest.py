@@ -0,0 +1,40 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_supabase import FakeSupabase
+
+
+@pytest.fixture(scope="session")
+def app():
+    """
+    导入 app（配置在导入时读取，先设置好环境变量）：
+    模型用 loadtest.py 里的假模型，WAL、检索索引放到临时目录
+    """
+    from loadtest import FakeLLMConfig, start_fake_llm
+
+    server, base_url = start_fake_llm(FakeLLMConfig(latency=0.01, jitter=0, token_rate=2000))
+    workdir = tempfile.mkdtemp(prefix="ai-kid-tests-")
+    os.environ.update({
+        "DEEPSEEK_API_KEY": "test",
+        "DEEPSEEK_BASE_URL": base_url,
+        "STORAGE_BACKEND": "memory",
+        "HISTORY_WAL_DIR": workdir,
+        "RETRIEVAL_INDEX_DIR": os.path.join(workdir, "retrieval"),
+        "STARTUP_WARMUP": "0",
+    })
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    import app as app_module
+
+    yield app_module
+    server.shutdown()
+
+
+@pytest.fixture
+def fake_supabase():
+    return FakeSupabase()
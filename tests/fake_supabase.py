@@ -0,0 +1,251 @@
+import copy
+import itertools
+import threading
+
+# =====================
+# 假的 Supabase 客户端（测试用）
+# =====================
+# 在内存里模拟 storage.SupabaseStore 用到的 PostgREST 查询和 schema.sql 里的数据库函数，
+# 每次 .execute() 算一次往返：select 算读，upsert / insert / delete / rpc 算写
+
+# 每个表的主键（upsert 的 on_conflict）
+PRIMARY_KEYS = {
+    "users": ("username",),
+    "chats": ("username",),
+    "weekly_reports": ("username",),
+    "chat_messages": ("username", "seq"),
+    "chat_log_messages": ("username", "seq"),
+}
+
+
+class Result:
+    def __init__(self, data):
+        self.data = data
+
+
+def _split_columns(columns):
+    """按顶层逗号拆开 select 的列（嵌套查询的括号里的逗号不拆）"""
+    parts, depth, current = [], 0, ""
+    for char in columns:
+        if char == "," and depth == 0:
+            parts.append(current.strip())
+            current = ""
+            continue
+        depth += char == "("
+        depth -= char == ")"
+        current += char
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+
+def _matches(row, op, column, value):
+    actual = row.get(column)
+    if op == "eq":
+        return actual == value
+    if op == "in":
+        return actual in value
+    if actual is None:
+        return False
+    return {"gt": actual > value, "gte": actual >= value, "lt": actual < value}[op]
+
+
+class Query:
+    def __init__(self, client, table):
+        self._client = client
+        self._table = table
+        self._action = None
+        self._payload = None
+        self._options = {}
+        self._filters = []      # (嵌套的表名或 None, op, 列, 值)
+        self._orders = {}       # 嵌套的表名 / 别名或 None -> (列, desc)
+        self._limits = {}
+
+    # ---------- 动作 ----------
+
+    def select(self, columns):
+        self._action, self._payload = "select", columns
+        return self
+
+    def upsert(self, rows, on_conflict=None, ignore_duplicates=False):
+        self._action, self._payload = "upsert", rows
+        self._options = {"ignore_duplicates": ignore_duplicates}
+        return self
+
+    def insert(self, rows):
+        self._action, self._payload = "insert", rows
+        return self
+
+    def delete(self):
+        self._action = "delete"
+        return self
+
+    # ---------- 过滤 / 排序 ----------
+
+    def _filter(self, op, column, value):
+        table, _, name = column.rpartition(".")
+        self._filters.append((table or None, op, name, value))
+        return self
+
+    def eq(self, column, value):
+        return self._filter("eq", column, value)
+
+    def gt(self, column, value):
+        return self._filter("gt", column, value)
+
+    def gte(self, column, value):
+        return self._filter("gte", column, value)
+
+    def lt(self, column, value):
+        return self._filter("lt", column, value)
+
+    def in_(self, column, values):
+        return self._filter("in", column, list(values))
+
+    def order(self, column, desc=False, foreign_table=None):
+        self._orders[foreign_table] = (column, desc)
+        return self
+
+    def limit(self, count, foreign_table=None):
+        self._limits[foreign_table] = count
+        return self
+
+    def execute(self):
+        with self._client.lock:
+            self._client.count("read" if self._action == "select" else "write")
+            return Result(getattr(self, "_" + self._action)())
+
+    # ---------- 执行 ----------
+
+    def _rows(self, table, resource):
+        rows = [row for row in self._client.tables[table]
+                if all(_matches(row, op, column, value)
+                       for target, op, column, value in self._filters if target == resource)]
+        if resource in self._orders:
+            column, desc = self._orders[resource]
+            rows.sort(key=lambda row: row[column], reverse=desc)
+        if resource in self._limits:
+            rows = rows[:self._limits[resource]]
+        return rows
+
+    def _select(self):
+        result = []
+        for row in self._rows(self._table, None):
+            out = {}
+            for column in _split_columns(self._payload):
+                if "(" not in column:
+                    out[column] = copy.deepcopy(row.get(column))
+                    continue
+                # 嵌套查询：alias:table(columns)，按 username 关联
+                name, _, inner = column.partition("(")
+                alias, _, table = name.rpartition(":")
+                alias = alias or table
+                children = [child for child in self._rows(table, alias)
+                            if child["username"] == row["username"]]
+                inner_columns = _split_columns(inner[:-1])
+                out[alias] = [{key: copy.deepcopy(child.get(key)) for key in inner_columns} for child in children]
+            result.append(out)
+        return result
+
+    def _upsert(self):
+        rows = self._payload if isinstance(self._payload, list) else [self._payload]
+        keys = PRIMARY_KEYS[self._table]
+        table = self._client.tables[self._table]
+        for new in rows:
+            existing = next((row for row in table if all(row.get(k) == new.get(k) for k in keys)), None)
+            if existing is None:
+                table.append(copy.deepcopy(new))
+            elif not self._options["ignore_duplicates"]:
+                existing.update(copy.deepcopy(new))
+        return copy.deepcopy(rows)
+
+    def _insert(self):
+        rows = self._payload if isinstance(self._payload, list) else [self._payload]
+        self._client.tables[self._table].extend(copy.deepcopy(rows))
+        return copy.deepcopy(rows)
+
+    def _delete(self):
+        table = self._client.tables[self._table]
+        keep = [row for row in table
+                if not all(_matches(row, op, column, value) for _, op, column, value in self._filters)]
+        table[:] = keep
+        return []
+
+
+class Rpc:
+    def __init__(self, client, name, params):
+        self._client = client
+        self._name = name
+        self._params = copy.deepcopy(params)
+
+    def execute(self):
+        with self._client.lock:
+            self._client.count("write")
+            return Result(getattr(self._client, "_rpc_" + self._name)(**self._params))
+
+
+class FakeSupabase:
+    def __init__(self):
+        self.tables = {name: [] for name in PRIMARY_KEYS}
+        self.lock = threading.RLock()
+        self.reads = 0
+        self.writes = 0
+
+    def count(self, kind):
+        if kind == "read":
+            self.reads += 1
+        else:
+            self.writes += 1
+
+    def round_trips(self):
+        return self.reads, self.writes
+
+    def table(self, name):
+        return Query(self, name)
+
+    def rpc(self, name, params):
+        return Rpc(self, name, params)
+
+    # ---------- schema.sql 里的数据库函数 ----------
+
+    def _user(self, username):
+        return next((row for row in self.tables["users"] if row["username"] == username), None)
+
+    def _rpc_save_user_data(self, p_username, p_password=None, p_child_profile=None, p_messages=None,
+                            p_chat_history=None, p_revision=None):
+        user = self._user(p_username)
+        if user is None:
+            user = {"username": p_username, "password": "", "child_profile": {}}
+            self.tables["users"].append(user)
+        if p_child_profile is not None:
+            user["child_profile"] = p_child_profile
+            if p_password is not None:
+                user["password"] = p_password
+
+        if p_messages is not None:
+            messages = self.tables["chat_messages"]
+            last_seq = max((row["seq"] for row in messages if row["username"] == p_username), default=0)
+            known = {row["msg_key"] for row in messages if row["username"] == p_username}
+            seqs = itertools.count(last_seq + 1)
+            for message in p_messages:
+                if message["msg_key"] in known:
+                    continue
+                known.add(message["msg_key"])
+                messages.append(dict(message, username=p_username, seq=next(seqs)))
+
+        if p_chat_history is not None:
+            chat = next((row for row in self.tables["chats"] if row["username"] == p_username), None)
+            if chat is None:
+                self.tables["chats"].append({"username": p_username, "chat_history": p_chat_history, "revision": 1})
+                return 1
+            if p_revision is None or p_revision != chat["revision"]:
+                return None
+            chat["chat_history"] = p_chat_history
+            chat["revision"] += 1
+            return chat["revision"]
+        return 0
+
+    def _rpc_update_profile_fields(self, p_username, p_fields):
+        user = self._user(p_username)
+        if user is not None:
+            user["child_profile"] = dict(user["child_profile"] or {}, **p_fields)
@@ -0,0 +1,157 @@
+import os
+import threading
+
+import pytest
+from fake_supabase import FakeSupabase
+
+from cache import merge_histories
+from persistence import WriteBehindQueue
+from retrieval import exchanges
+from storage import MemoryStore, SQLiteStore, SupabaseStore
+from summarizer import pending_messages
+
+USERNAME = "mom"
+TURNS = 20
+
+
+def base_history():
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"base{i}", "ts": 100.0 + i}
+            for i in range(4)]
+
+
+def new_message(writer, i):
+    # 两个会话的时间戳交错，按时间排不出谁先谁后
+    return {"role": "user", "content": f"{writer}{i}", "ts": 1000.0 + i * 2 + (writer == "B")}
+
+
+@pytest.fixture(params=["memory", "sqlite", "supabase-append", "supabase-blob"])
+def stores(request, tmp_path):
+    """两个写入方各自的存储（相当于两个进程），背后是同一个数据库；返回 (first, second, 重新读用的 store)"""
+    if request.param == "memory":
+        # 内存后端只在一个进程里：两个标签页共用一个 store
+        store = MemoryStore()
+        return store, store, store
+    if request.param == "sqlite":
+        path = os.path.join(tmp_path, "ai_kid.db")
+        return SQLiteStore(path), SQLiteStore(path), SQLiteStore(path)
+    client = FakeSupabase()
+    mode = request.param.split("-")[1]
+    return (SupabaseStore(client=client, mode=mode), SupabaseStore(client=client, mode=mode),
+            SupabaseStore(client=client, mode=mode))
+
+
+def assert_each_message_once(store):
+    chat_history = store.load_messages(USERNAME)
+    contents = [msg["content"] for msg in chat_history]
+    expected = [f"base{i}" for i in range(4)] + [f"{w}{i}" for w in "AB" for i in range(TURNS)]
+    assert sorted(contents) == sorted(expected)
+    # 每个会话自己的消息顺序不变
+    for writer in "AB":
+        assert [c for c in contents if c.startswith(writer)] == [f"{writer}{i}" for i in range(TURNS)]
+    if "seq" in chat_history[0]:
+        assert [msg["seq"] for msg in chat_history] == list(range(1, len(expected) + 1))
+
+
+def test_alternating_saves_keep_every_message(stores):
+    first, second, reader = stores
+    first.save_user(USERNAME, base_history(), {"password": "pw"})
+
+    # 两个会话都从同一份记录开始，轮流各加一条消息、保存整段会话
+    sessions = {"A": (first, first.load_user(USERNAME)[1]), "B": (second, second.load_user(USERNAME)[1])}
+    for i in range(TURNS):
+        for writer, (store, session) in sessions.items():
+            session.append(new_message(writer, i))
+            store.save_user(USERNAME, list(session))
+
+    assert_each_message_once(reader)
+
+
+def test_concurrent_saves_keep_every_message(stores, monkeypatch):
+    first, second, reader = stores
+    first.save_user(USERNAME, base_history(), {"password": "pw"})
+    start = threading.Barrier(2)
+    errors = []
+    # 写入线程里抛出的异常（比如 WriteConflict）记下来，在主线程里检查
+    monkeypatch.setattr(threading, "excepthook", errors.append)
+
+    def writer(name, store):
+        session = store.load_user(USERNAME)[1]
+        start.wait()
+        for i in range(TURNS):
+            session.append(new_message(name, i))
+            store.save_user(USERNAME, list(session))
+
+    threads = [threading.Thread(target=writer, args=("A", first)), threading.Thread(target=writer, args=("B", second))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert_each_message_once(reader)
+
+
+def test_write_behind_queues_and_wal_replay_keep_every_message(stores, tmp_path):
+    """两个进程各有一个后台写入队列；其中一个重启后回放 WAL，再保存一次也不会重复"""
+    first, second, reader = stores
+    first.save_user(USERNAME, base_history(), {"password": "pw"})
+
+    def write_fn(store):
+        return lambda username, chat_history, child_profile, update_user: store.save_user(username, chat_history)
+
+    queues = {}
+    sessions = {}
+    for name, store in (("A", first), ("B", second)):
+        queues[name] = WriteBehindQueue(write_fn(store), os.path.join(tmp_path, f"{name}.wal"),
+                                        merge_history=merge_histories)
+        queues[name].start()
+        sessions[name] = store.load_user(USERNAME)[1]
+
+    for i in range(TURNS):
+        for name in "AB":
+            sessions[name].append(new_message(name, i))
+            queues[name].submit(USERNAME, sessions[name])
+    for queue in queues.values():
+        assert queue.flush(10)
+        queue.stop()
+
+    # A 的 WAL 已经写空；模拟 B 崩溃前留下的 WAL（最后一轮原样再记一遍），
+    # 由重启后的新进程（不知道哪些已经写过）回放：靠数据库去重 / 合并，不会重复
+    crashed = WriteBehindQueue(write_fn(second), os.path.join(tmp_path, "B-crashed.wal"),
+                               merge_history=merge_histories)
+    crashed.submit(USERNAME, sessions["B"])
+    crashed.stop(0)
+    restarted = WriteBehindQueue(write_fn(reader), os.path.join(tmp_path, "B-crashed.wal"),
+                                 merge_history=merge_histories)
+    restarted.start()
+    assert restarted.flush(10)
+    assert restarted.stats()["written"] == 1
+    restarted.stop()
+
+    assert os.path.getsize(os.path.join(tmp_path, "A.wal")) == 0
+    assert_each_message_once(reader)
+
+
+def test_only_database_seqs_are_used_as_ids(stores):
+    """两个会话交错写入后，各自本地编的 seq 和库里的对不上：检索索引、摘要水位只用库里分配的 seq"""
+    first, second, reader = stores
+    first.save_user(USERNAME, base_history(), {"password": "pw"})
+    sessions = {"A": (first, first.load_user(USERNAME)[1]), "B": (second, second.load_user(USERNAME)[1])}
+    for i in range(3):
+        for writer, (store, session) in sessions.items():
+            question = new_message(writer, i)
+            session.extend([question, {"role": "assistant", "content": f"re-{question['content']}",
+                                       "ts": question["ts"] + 0.5}])
+            store.save_user(USERNAME, list(session))
+
+    for _, session in sessions.values():
+        assert [seq for seq, _, _ in exchanges(session)] == [1, 3]
+        assert [msg["content"] for _, msg in pending_messages(session, None, recent_window=0)] == \
+            [f"base{i}" for i in range(4)]
+
+    # 从库里读出来以后，每轮对话的 seq 都能读回同一轮对话
+    stored = exchanges(reader.load_messages(USERNAME))
+    assert len(stored) == 2 + 2 * 3
+    for seq, last_seq, text in stored:
+        loaded = reader.load_messages_by_seq(USERNAME, [seq, last_seq])
+        assert "\n".join(msg["content"] for msg in loaded) == text
@@ -0,0 +1,31 @@
+import os
+import threading
+
+from retrieval import BM25Index, ChatRetriever
+
+
+def test_concurrent_index_writes_use_separate_temp_files(tmp_path):
+    """几个进程（这里用线程模拟）同时保存同一个用户的索引：都能写完，不留下临时文件"""
+    writers = [ChatRetriever(lambda username: [], index_dir=str(tmp_path)) for _ in range(4)]
+    index = BM25Index()
+    index.add(1, "今天天气不错，我去公园散步了", 2)
+    path = writers[0]._path("mom")
+    errors = []
+
+    def save(retriever):
+        for _ in range(50):
+            try:
+                retriever._write(path, index)
+            except OSError as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=save, args=(retriever,)) for retriever in writers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert os.listdir(tmp_path) == [os.path.basename(path)]
+    with open(path, "rb") as f:
+        assert f.read() == index.to_bytes()
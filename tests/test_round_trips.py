@@ -0,0 +1,165 @@
+import asyncio
+import time
+
+import pytest
+
+from cache import CachedStore, TTLCache
+from metrics import TimedStore
+from storage import SupabaseStore
+
+TIMEZONE = "UTC+8（北京、上海、香港）"
+
+
+def run_steps(app, client, username):
+    """顺序跑一个用户的注册 → 填写设置 → 登录 → 聊一轮 → 子女看周报，返回 {操作: (读次数, 写次数)}"""
+
+    def settle():
+        app.history_writer.flush(30)
+        while app.retriever.stats()["loading"]:
+            time.sleep(0.01)
+
+    async def chat(session):
+        async for _ in app.call_gpt("今天天气不错，我去公园散步了", session[4], session[5], username):
+            pass
+
+    async def weekly_report():
+        async for _ in app.child_login(username):
+            pass
+
+    results = {}
+
+    def step(name, fn):
+        settle()
+        reads, writes = client.round_trips()
+        result = fn()
+        settle()
+        results[name] = (client.reads - reads, client.writes - writes)
+        return result
+
+    step("register", lambda: app.handle_register(username, "pw"))
+    step("save_profile", lambda: app.save_profile(username, "女", "大学生", "小明", "在外地读书", None,
+                                                  TIMEZONE, TIMEZONE))
+    # 登录时在后台建检索索引（第一次要读全部聊天记录），先建好，不算在登录里
+    app.retriever.preload(username)
+    session = step("login", lambda: app.handle_login(username, "pw"))
+    step("chat_turn", lambda: asyncio.run(chat(session)))
+    step("weekly_report", lambda: asyncio.run(weekly_report()))
+    return results
+
+
+@pytest.mark.parametrize("mode", ["append", "blob"])
+def test_each_handler_makes_one_read_and_one_write(app, fake_supabase, monkeypatch, mode):
+    store = CachedStore(TimedStore(SupabaseStore(client=fake_supabase, mode=mode)), TTLCache())
+    monkeypatch.setattr(app, "store", store)
+
+    results = run_steps(app, fake_supabase, f"round-trips-{mode}")
+
+    assert results == {
+        "register": (1, 1),
+        "save_profile": (1, 1),
+        "login": (1, 0),
+        "chat_turn": (0, 1),
+        "weekly_report": (1, 1),
+    }
+    # 聊天记录和周报确实写进去了
+    if mode == "append":
+        assert len(fake_supabase.tables["chat_messages"]) == 2
+    else:
+        assert len(fake_supabase.tables["chats"][0]["chat_history"]) == 2
+    assert fake_supabase.tables["weekly_reports"][0]["username"] == f"round-trips-{mode}"
+
+
+def test_load_user_reads_profile_and_messages_in_one_select(fake_supabase):
+    store = SupabaseStore(client=fake_supabase, mode="append")
+    store.save_user("u", [{"role": "user", "content": f"m{i}", "ts": 1000.0 + i} for i in range(5)],
+                    {"password": "pw", "nickname": "小明"})
+
+    before = fake_supabase.round_trips()
+    child_profile, chat_history = store.load_user("u", limit=3)
+
+    assert fake_supabase.round_trips() == (before[0] + 1, before[1])
+    assert child_profile["nickname"] == "小明"
+    assert [msg["content"] for msg in chat_history] == ["m2", "m3", "m4"]
+    assert [msg["seq"] for msg in chat_history] == [3, 4, 5]
+
+
+def test_load_report_inputs_reads_range_recent_and_report_in_one_select(fake_supabase):
+    store = SupabaseStore(client=fake_supabase, mode="append")
+    old = [{"role": "user", "content": f"old{i}"} for i in range(3)]
+    new = [{"role": "user", "content": f"new{i}", "ts": 2000.0 + i} for i in range(3)]
+    store.save_user("u", old + new, {"password": "pw"})
+    store.save_report("u", "w1", "上周的周报")
+
+    before = fake_supabase.round_trips()
+    child_profile, chat_history, recent, cached = store.load_report_inputs("u", 2001.0, 10, recent_limit=4)
+
+    assert fake_supabase.round_trips() == (before[0] + 1, before[1])
+    assert child_profile["password"] == "pw"
+    assert [msg["content"] for msg in chat_history] == ["new1", "new2"]
+    assert [msg["content"] for msg in recent] == ["old2", "new0", "new1", "new2"]
+    assert cached == {"watermark": "w1", "report": "上周的周报"}
+
+
+def test_save_user_is_one_rpc(fake_supabase):
+    store = SupabaseStore(client=fake_supabase, mode="append")
+    history = [{"role": "user", "content": "你好", "ts": 1.0}]
+
+    store.save_user("u", history, {"password": "pw"})
+    assert fake_supabase.round_trips() == (0, 1)
+
+    # 再保存一次同样的记录（WAL 回放、重试）：还是一次往返，不重复写
+    store.save_user("u", history + [{"role": "assistant", "content": "妈", "ts": 2.0}])
+    assert fake_supabase.round_trips() == (0, 2)
+    assert [row["seq"] for row in fake_supabase.tables["chat_messages"]] == [1, 2]
+
+
+def test_blob_conflict_reloads_and_merges(fake_supabase):
+    first = SupabaseStore(client=fake_supabase, mode="blob")
+    second = SupabaseStore(client=fake_supabase, mode="blob")
+    base = [{"role": "user", "content": "早上好", "ts": 1.0}]
+    first.save_user("u", base, {"password": "pw"})
+    _, session = second.load_user("u")
+
+    first.save_user("u", base + [{"role": "user", "content": "A", "ts": 2.0}])
+    before = fake_supabase.round_trips()
+    # second 手里的版本号已经过期：写入失败 → 重新读 chats → 合并后再写
+    second.save_user("u", session + [{"role": "user", "content": "B", "ts": 3.0}])
+
+    assert fake_supabase.round_trips() == (before[0] + 1, before[1] + 2)
+    chat = fake_supabase.tables["chats"][0]
+    assert [msg["content"] for msg in chat["chat_history"]] == ["早上好", "A", "B"]
+    assert chat["revision"] == 3
+
+
+def test_load_report_inputs_falls_back_to_unmigrated_blob(fake_supabase):
+    # 整段存储时保存的旧用户，换成按行存储后还没保存过（chat_messages 里还没有这个用户的消息）
+    old = [{"role": "user", "content": f"old{i}"} for i in range(3)]
+    SupabaseStore(client=fake_supabase, mode="blob").save_user("u", old, {"password": "pw"})
+    store = SupabaseStore(client=fake_supabase, mode="append")
+
+    child_profile, chat_history, recent, cached = store.load_report_inputs("u", 2000.0, 10, recent_limit=20)
+
+    assert child_profile["password"] == "pw"
+    assert chat_history == []
+    assert [msg["content"] for msg in recent] == ["old0", "old1", "old2"]
+    assert cached is None
+    # 和 load_user、load_messages 读到的一样
+    assert [msg["content"] for msg in store.load_user("u")[1]] == ["old0", "old1", "old2"]
+    assert [msg["content"] for msg in store.load_messages("u", 20)] == ["old0", "old1", "old2"]
+
+
+def test_blob_positions_are_seqs_and_not_stored(fake_supabase):
+    store = SupabaseStore(client=fake_supabase, mode="blob")
+    store.save_user("u", [{"role": "user", "content": f"m{i}", "ts": 1.0 + i} for i in range(3)], {"password": "pw"})
+
+    _, chat_history = store.load_user("u")
+    assert [msg["seq"] for msg in chat_history] == [1, 2, 3]
+    store.save_user("u", chat_history + [{"role": "assistant", "content": "m3", "ts": 4.0}])
+    assert all("seq" not in msg for msg in fake_supabase.tables["chats"][0]["chat_history"])
+    assert [msg["content"] for msg in store.load_messages_by_seq("u", [2, 4])] == ["m1", "m3"]
+
+    # 换成按行存储后第一次保存：整段记录按原来的顺序迁移过去
+    append = SupabaseStore(client=fake_supabase, mode="append")
+    append.save_user("u", append.load_user("u")[1])
+    assert [(row["seq"], row["content"]) for row in fake_supabase.tables["chat_messages"]] == \
+        [(1, "m0"), (2, "m1"), (3, "m2"), (4, "m3")]
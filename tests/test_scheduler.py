@@ -0,0 +1,82 @@
+import asyncio
+import threading
+
+import pytest
+
+from scheduler import PRIORITY_CHAT, LLMScheduler, SchedulerBusy
+
+
+@pytest.fixture
+def loop():
+    """在另一个线程里跑的事件循环（相当于网页进程的主循环）"""
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield loop
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def on_loop(loop, fn):
+    async def call():
+        return fn()
+    return asyncio.run_coroutine_threadsafe(call(), loop).result()
+
+
+def test_background_call_waits_for_a_free_slot(loop):
+    scheduler = LLMScheduler(max_concurrency=1)
+    chat = on_loop(loop, lambda: scheduler.enqueue("mom", PRIORITY_CHAT))
+    called = threading.Event()
+    result = []
+
+    def summarize():
+        called.set()
+        return "摘要"
+
+    worker = threading.Thread(target=lambda: result.append(scheduler.run_in_thread("mom", summarize)))
+    worker.start()
+    # 聊天占着唯一的名额：后台任务排队，不调用
+    assert not called.wait(0.2)
+    assert on_loop(loop, scheduler.stats)["batch"]["waiting"] == 1
+
+    loop.call_soon_threadsafe(chat.release)
+    worker.join(5)
+    assert called.is_set()
+    assert result == ["摘要"]
+    stats = on_loop(loop, scheduler.stats)
+    assert stats["active"] == 0
+    assert stats["batch"]["admitted"] == 1
+
+
+def test_background_call_gives_up_after_timeout(loop):
+    scheduler = LLMScheduler(max_concurrency=1)
+    chat = on_loop(loop, lambda: scheduler.enqueue("mom", PRIORITY_CHAT))
+
+    with pytest.raises(SchedulerBusy):
+        scheduler.run_in_thread("mom", lambda: pytest.fail("should not be called"), timeout=0.1)
+
+    stats = on_loop(loop, scheduler.stats)
+    assert stats["waiting"] == 0
+    assert stats["batch"]["cancelled"] == 1
+    loop.call_soon_threadsafe(chat.release)
+
+
+def test_memories_are_extracted_only_from_saved_turns(app, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(app.memory_pipeline, "submit", lambda username, text, child_profile: submitted.append(text))
+
+    async def chat(text):
+        outputs = [output async for output in app.call_gpt(text, [], {"nickname": "小明"}, "memory-mom")]
+        return outputs[-1]
+
+    # 排队已满被拒绝：这一轮不保存，也不提取记忆
+    monkeypatch.setattr(app, "llm_scheduler", LLMScheduler(max_queue=0))
+    _, _, kept_input = asyncio.run(chat("我明天去医院复查"))
+    assert kept_input == "我明天去医院复查"
+    assert submitted == []
+
+    monkeypatch.setattr(app, "llm_scheduler", LLMScheduler())
+    _, chat_history, _ = asyncio.run(chat("我明天去医院复查"))
+    assert [msg["role"] for msg in chat_history] == ["user", "assistant"]
+    assert submitted == ["我明天去医院复查"]